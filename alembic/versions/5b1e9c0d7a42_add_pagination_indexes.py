@@ -0,0 +1,27 @@
+"""add pagination indexes
+
+Revision ID: 5b1e9c0d7a42
+Revises: a81253cd1fac
+Create Date: 2026-10-18 10:12:31.408215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e9c0d7a42'
+down_revision = 'a81253cd1fac'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Keyset pagination of GET /tickets/ and GET /projects/ walks (created_at, id)
+    op.create_index('tickets_created_at_id_idx', 'tickets', ['created_at', 'id'])
+    op.create_index('projects_created_at_id_idx', 'projects', ['created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('projects_created_at_id_idx', table_name='projects')
+    op.drop_index('tickets_created_at_id_idx', table_name='tickets')
@@ -0,0 +1,27 @@
+"""add comments/users pagination indexes
+
+Revision ID: 7a2d9e4c1f60
+Revises: e8d4b6f21c93
+Create Date: 2026-10-18 14:05:47.193520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a2d9e4c1f60'
+down_revision = 'e8d4b6f21c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Keyset pagination (and NDJSON export) of GET /comments/ and GET /users/ walks (created_at, id)
+    op.create_index('comments_created_at_id_idx', 'comments', ['created_at', 'id'])
+    op.create_index('users_created_at_id_idx', 'users', ['created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('users_created_at_id_idx', table_name='users')
+    op.drop_index('comments_created_at_id_idx', table_name='comments')
@@ -0,0 +1,104 @@
+"""partition update history by month
+
+Revision ID: a3c9e5f0b7d4
+Revises: f1b7c4e8a5d2
+Create Date: 2026-10-18 20:41:37.206518
+
+"""
+from datetime import datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9e5f0b7d4'
+down_revision = 'f1b7c4e8a5d2'
+branch_labels = None
+depends_on = None
+
+# History table, its foreign key and the referenced table, whether it has personnel_change
+HISTORIES = [
+    ('ticket_updates', 'ticket_id', 'tickets', False),
+    ('project_updates', 'project_id', 'projects', True),
+]
+
+# Months after the current one that get a partition right away; later ones are created by `python -m app.partitions create`
+AHEAD = 2
+
+
+def month(value, offset=0):
+    index = value.year * 12 + value.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def table_items(table, key, parent, personnel):
+    items = [
+        sa.Column('id', sa.Integer(), server_default=sa.text(f"nextval('{table}_id_seq'::regclass)"), nullable=False),
+        sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column(key, sa.Integer(), nullable=False),
+        sa.Column('editor_id', sa.Integer(), nullable=False),
+    ]
+    if personnel:
+        items.append(sa.Column('personnel_change', sa.String(), nullable=True))
+    items.append(sa.Column('changes', postgresql.JSONB(), server_default=sa.text("'{}'::jsonb"), nullable=False))
+    items.append(sa.ForeignKeyConstraint([key], [f'{parent}.id'], name=f'{table}_{parent}_fk', ondelete='CASCADE'))
+    items.append(sa.ForeignKeyConstraint(['editor_id'], ['users.id'], name=f'{table}_users_fk', ondelete='CASCADE'))
+    return items
+
+
+def indexes(table, key):
+    return [(f'{table}_{key}_updated_at_idx', [key, 'updated_at']), (f'{table}_editor_id_idx', ['editor_id'])]
+
+
+def copy(source, target, key, personnel):
+    columns = ', '.join(['id', 'updated_at', key, 'editor_id', 'changes'] + (['personnel_change'] if personnel else []))
+    op.execute(f'INSERT INTO {target} ({columns}) SELECT {columns} FROM {source}')
+
+
+def upgrade() -> None:
+    # The primary key has to include the partition key; ids keep coming from the same sequence.
+    # Every month from the oldest row on gets its partition, rows outside of them go to the default one
+    bind = op.get_bind()
+    now = datetime.now(timezone.utc)
+    for table, key, parent, personnel in HISTORIES:
+        op.rename_table(table, f'{table}_unpartitioned')
+        op.execute(f'ALTER TABLE {table}_unpartitioned RENAME CONSTRAINT {table}_pkey TO {table}_unpartitioned_pkey')
+        for name, _ in indexes(table, key):
+            op.drop_index(name, table_name=f'{table}_unpartitioned')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY NONE')
+
+        op.create_table(table, *table_items(table, key, parent, personnel),
+                        sa.PrimaryKeyConstraint('id', 'updated_at', name=f'{table}_pkey'),
+                        postgresql_partition_by='RANGE (updated_at)')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+        op.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+
+        oldest = bind.execute(sa.text(f'SELECT min(updated_at) FROM {table}_unpartitioned')).scalar()
+        start = month(min(oldest or now, now))
+        while start < month(now, AHEAD + 1):
+            end = month(start, 1)
+            op.execute(f"CREATE TABLE {table}_y{start:%Y}m{start:%m} PARTITION OF {table} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+            start = end
+
+        copy(f'{table}_unpartitioned', table, key, personnel)
+        op.drop_table(f'{table}_unpartitioned')
+        for name, columns in indexes(table, key):
+            op.create_index(name, table, columns)
+
+
+def downgrade() -> None:
+    # Rows of archived partitions are not restored
+    for table, key, parent, personnel in HISTORIES:
+        op.create_table(f'{table}_unpartitioned', *table_items(table, key, parent, personnel),
+                        sa.PrimaryKeyConstraint('id', name=f'{table}_unpartitioned_pkey'))
+        copy(table, f'{table}_unpartitioned', key, personnel)
+
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY NONE')
+        # Drops the partitions with it
+        op.drop_table(table)
+        op.rename_table(f'{table}_unpartitioned', table)
+        op.execute(f'ALTER TABLE {table} RENAME CONSTRAINT {table}_unpartitioned_pkey TO {table}_pkey')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+        for name, columns in indexes(table, key):
+            op.create_index(name, table, columns)
@@ -0,0 +1,27 @@
+"""add project/ticket versions
+
+Revision ID: b93e5c2a7d18
+Revises: d41f7b0e93a6
+Create Date: 2026-10-18 17:03:41.287904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b93e5c2a7d18'
+down_revision = 'd41f7b0e93a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Version stamps behind the ETags of project/ticket pages
+    op.add_column('projects', sa.Column('version', sa.Integer(), server_default=sa.text('1'), nullable=False))
+    op.add_column('tickets', sa.Column('version', sa.Integer(), server_default=sa.text('1'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('tickets', 'version')
+    op.drop_column('projects', 'version')
@@ -0,0 +1,36 @@
+"""add search vectors
+
+Revision ID: c3f7a2e91b05
+Revises: 5b1e9c0d7a42
+Create Date: 2026-10-18 11:02:47.115630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f7a2e91b05'
+down_revision = '5b1e9c0d7a42'
+branch_labels = None
+depends_on = None
+
+# Has to match SEARCH_CONFIG and models.search_vector
+VECTORS = {
+    'tickets': "setweight(to_tsvector('simple', coalesce(caption, '')), 'A') || setweight(to_tsvector('simple', coalesce(description, '')), 'B')",
+    'projects': "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || setweight(to_tsvector('simple', coalesce(description, '')), 'B')",
+    'comments': "setweight(to_tsvector('simple', coalesce(body_text, '')), 'A')",
+}
+
+
+def upgrade() -> None:
+    for table, expression in VECTORS.items():
+        op.add_column(table, sa.Column('search_vector', TSVECTOR, sa.Computed(expression, persisted=True)))
+        op.create_index(f'{table}_search_idx', table, ['search_vector'], postgresql_using='gin')
+
+
+def downgrade() -> None:
+    for table in VECTORS:
+        op.drop_index(f'{table}_search_idx', table_name=table)
+        op.drop_column(table, 'search_vector')
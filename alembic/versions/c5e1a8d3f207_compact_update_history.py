@@ -0,0 +1,65 @@
+"""compact update history
+
+Revision ID: c5e1a8d3f207
+Revises: b93e5c2a7d18
+Create Date: 2026-10-18 18:12:09.514730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e1a8d3f207'
+down_revision = 'b93e5c2a7d18'
+branch_labels = None
+depends_on = None
+
+# History table, entity table and foreign key, tracked fields with the SQL turning a legacy column into the entity's type
+HISTORIES = [
+    ('ticket_updates', 'tickets', 'ticket_id', {
+        'caption': '{}', 'description': '{}', 'priority': '{}::integer', 'status': '{}', 'category': '{}',
+    }),
+    ('project_updates', 'projects', 'project_id', {
+        'name': '{}', 'description': '{}', 'start': '{}::date', 'deadline': '{}::date', 'status': '{}',
+    }),
+]
+
+
+def upgrade() -> None:
+    # Only fields whose old and new values differ are kept, as {"field": [old, new]}.
+    # The dropped columns' space is reused by new rows; VACUUM FULL returns it to the OS right away
+    for table, _, _, fields in HISTORIES:
+        op.add_column(table, sa.Column('changes', postgresql.JSONB(), server_default=sa.text("'{}'::jsonb"), nullable=False))
+
+        pairs = []
+        for field, cast in fields.items():
+            old, new = cast.format(f'old_{field}'), cast.format(f'new_{field}')
+            pairs.append(f"'{field}', CASE WHEN {old} IS DISTINCT FROM {new} THEN jsonb_build_array({old}, {new}) END")
+        op.execute(f"UPDATE {table} SET changes = jsonb_strip_nulls(jsonb_build_object({', '.join(pairs)}))")
+
+        for field in fields:
+            op.drop_column(table, f'old_{field}')
+            op.drop_column(table, f'new_{field}')
+
+
+def downgrade() -> None:
+    # Full old/new values again. A field's value after an update is the new value of the latest update up to it that
+    # changed the field, otherwise the old value of the first later update that changed it, otherwise the entity's value
+    for table, entity, key, fields in HISTORIES:
+        for field, cast in fields.items():
+            for prefix in ('old', 'new'):
+                op.add_column(table, sa.Column(f'{prefix}_{field}', sa.String(), server_default=None))
+            for prefix, up_to, later in (('old', '<', '>='), ('new', '<=', '>')):
+                value = f"""COALESCE(
+                    (SELECT h.changes->'{field}'->1 FROM {table} h WHERE h.{key} = {table}.{key} AND h.id {up_to} {table}.id AND h.changes ? '{field}' ORDER BY h.id DESC LIMIT 1),
+                    (SELECT h.changes->'{field}'->0 FROM {table} h WHERE h.{key} = {table}.{key} AND h.id {later} {table}.id AND h.changes ? '{field}' ORDER BY h.id LIMIT 1),
+                    (SELECT to_jsonb(e.{field}) FROM {entity} e WHERE e.id = {table}.{key})
+                ) #>> '{{}}'"""
+                op.execute(f"UPDATE {table} SET {prefix}_{field} = {value}")
+            # Dates were stored as timestamps
+            if cast.endswith('::date'):
+                for prefix in ('old', 'new'):
+                    op.alter_column(table, f'{prefix}_{field}', type_=sa.TIMESTAMP(timezone=True), postgresql_using=f'{prefix}_{field}::timestamptz')
+        op.drop_column(table, 'changes')
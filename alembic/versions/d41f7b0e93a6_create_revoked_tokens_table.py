@@ -0,0 +1,31 @@
+"""create revoked_tokens table
+
+Revision ID: d41f7b0e93a6
+Revises: 7a2d9e4c1f60
+Create Date: 2026-10-18 16:22:05.618349
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f7b0e93a6'
+down_revision = '7a2d9e4c1f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # JWT ids of revoked access/refresh tokens; workers sync them into in-memory bloom filters by id
+    op.create_table('revoked_tokens',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('jti', sa.String(), nullable=False),
+                    sa.Column('expires_at', sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column('revoked_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('jti'))
+
+
+def downgrade() -> None:
+    op.drop_table('revoked_tokens')
@@ -0,0 +1,25 @@
+"""add revoked_tokens revoked_at index
+
+Revision ID: e2a6d8c4f1b9
+Revises: a3c9e5f0b7d4
+Create Date: 2026-10-19 09:14:52.381604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a6d8c4f1b9'
+down_revision = 'a3c9e5f0b7d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Revocation syncs re-read the rows revoked shortly before the previous sync
+    op.create_index('revoked_tokens_revoked_at_idx', 'revoked_tokens', ['revoked_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('revoked_tokens_revoked_at_idx', table_name='revoked_tokens')
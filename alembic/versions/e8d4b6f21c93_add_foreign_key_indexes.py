@@ -0,0 +1,40 @@
+"""add foreign key indexes
+
+Revision ID: e8d4b6f21c93
+Revises: c3f7a2e91b05
+Create Date: 2026-10-18 11:48:09.532871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8d4b6f21c93'
+down_revision = 'c3f7a2e91b05'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns); detail pages filter children by parent id and read them in chronological order
+INDEXES = [
+    ('projects_creator_id_idx', 'projects', ['creator_id']),
+    ('personnel_user_id_idx', 'personnel', ['user_id']),
+    ('tickets_project_id_created_at_idx', 'tickets', ['project_id', 'created_at']),
+    ('tickets_creator_id_idx', 'tickets', ['creator_id']),
+    ('comments_ticket_id_created_at_idx', 'comments', ['ticket_id', 'created_at']),
+    ('comments_creator_id_idx', 'comments', ['creator_id']),
+    ('ticket_updates_ticket_id_updated_at_idx', 'ticket_updates', ['ticket_id', 'updated_at']),
+    ('ticket_updates_editor_id_idx', 'ticket_updates', ['editor_id']),
+    ('project_updates_project_id_updated_at_idx', 'project_updates', ['project_id', 'updated_at']),
+    ('project_updates_editor_id_idx', 'project_updates', ['editor_id']),
+]
+
+
+def upgrade() -> None:
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade() -> None:
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
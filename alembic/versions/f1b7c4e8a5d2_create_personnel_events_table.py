@@ -0,0 +1,50 @@
+"""create personnel_events table
+
+Revision ID: f1b7c4e8a5d2
+Revises: c5e1a8d3f207
+Create Date: 2026-10-18 19:26:44.108312
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c4e8a5d2'
+down_revision = 'c5e1a8d3f207'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('personnel_events',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('project_id', sa.Integer(), sa.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False),
+                    sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+                    sa.Column('action', sa.String(), nullable=False),
+                    sa.Column('editor_id', sa.Integer(), sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+                    sa.Column('at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+    # Events from the legacy 'a;<user id>;...'/'r;<user id>;...' entries of project_updates, which are kept.
+    # Ids of users deleted since then are skipped: their events would have been deleted with them
+    op.execute("""
+        INSERT INTO personnel_events (project_id, user_id, action, editor_id, at)
+        SELECT updates.project_id, ids.user_id::integer,
+               CASE WHEN updates.personnel_change LIKE 'a;%' THEN 'assign' ELSE 'remove' END,
+               updates.editor_id, updates.updated_at
+        FROM project_updates updates
+        CROSS JOIN LATERAL unnest((string_to_array(updates.personnel_change, ';'))[2:]) WITH ORDINALITY AS ids(user_id, position)
+        WHERE updates.personnel_change ~ '^[ar](;[0-9]+)+$'
+          AND EXISTS (SELECT 1 FROM users WHERE users.id = ids.user_id::integer)
+        ORDER BY updates.id, ids.position
+    """)
+
+    # Indexes are built after the backfill
+    op.create_index('personnel_events_user_id_at_id_idx', 'personnel_events', ['user_id', 'at', 'id'])
+    op.create_index('personnel_events_project_id_at_id_idx', 'personnel_events', ['project_id', 'at', 'id'])
+    op.create_index('personnel_events_editor_id_idx', 'personnel_events', ['editor_id'])
+
+
+def downgrade() -> None:
+    op.drop_table('personnel_events')
@@ -0,0 +1,70 @@
+# IN-PROCESS CACHES
+# Bounded by size (least recently used entries are evicted first) and by age (entries expire `ttl` seconds after
+# being set). Every worker process has its own copy, so an entry changed in another worker is stale until it expires
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    # Cached value or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.store(key, value, ttl)
+
+    # Value stored for key, setting it to `value` first if there is none
+    def setdefault(self, key, value, ttl: float = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+            if self.enabled:
+                self.store(key, value, ttl)
+            return value
+
+    def store(self, key, value, ttl):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -3,8 +3,12 @@ CHANGABLE_USER_ENTRIES = ['name', 'surname', 'username', 'email', 'access']
 CHANGABLE_TICKET_ENTRIES = ['caption', 'description', 'priority', 'status', 'category']
 CHANGABLE_COMMENT_ENTRIES = ['body_text']
 
+# Text search configuration used by the search_vector columns; 'simple' doesn't stem, so prefix queries behave predictably
+SEARCH_CONFIG = 'simple'
+
 # FETCH PYDANTIC SETTINGS FROM .env
 from pydantic import BaseSettings
+from typing import Literal
 
 class Settings(BaseSettings):
     database_hostname: str
@@ -18,6 +22,52 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    refresh_token_expire_days: int = 30
+
+    # Revoked token ids are synced from the db into every worker's bloom filter at most this many seconds apart
+    revocation_sync_interval: int = 5
+    # Seconds a revoking transaction may take to commit and still be picked up by the next sync (covers clock skew too)
+    revocation_sync_margin: int = 60
+    revocation_bloom_capacity: int = 100000
+
+    # Serve requests through AsyncSession/asyncpg instead of the sync psycopg2 session
+    database_async: bool = False
+
+    # Connection pool; 'null' opens a connection per checkout and leaves pooling to a transaction-mode pgbouncer
+    database_pool_mode: Literal['queue', 'null'] = 'queue'
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: int = 30
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
+    # Milliseconds, 0 disables the limit
+    database_statement_timeout: int = 0
+
+    # Authenticated users cached per worker; seconds, 0 disables the cache
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 60
+
+    # Rendered detail responses (GET /projects/{id}, ...), per worker or shared through a Redis-protocol server at
+    # response_cache_url; endpoints is a comma separated list of projects, tickets, users and comments. Seconds, 0 disables the cache
+    response_cache_backend: Literal['memory', 'redis'] = 'memory'
+    response_cache_url: str = 'redis://localhost:6379/0'
+    response_cache_size: int = 10000
+    response_cache_ttl: int = 60
+    response_cache_endpoints: str = 'projects,tickets,users,comments'
+
+    # Password hashing: bcrypt cost, worker processes and the most hashes queued or running before /login answers 503
+    bcrypt_rounds: int = 12
+    password_workers: int = 2
+    password_queue_size: int = 32
+
+    # Per route latency, database time/queries, serialization time and response size at /metrics, and Server-Timing headers
+    metrics_enabled: bool = False
+
+    # Monthly history partitions (python -m app.partitions): created this many months ahead; archive keeps this many full months
+    # and writes older ones to history_archive_dir as gzipped CSV before dropping them
+    history_partitions_ahead: int = 2
+    history_retention_months: int = 24
+    history_archive_dir: str = 'archive'
 
     class Config:
         env_file = ".env"
@@ -1,22 +1,194 @@
-# Initialize sqlalchemy through psycopg2
+# Initialize sqlalchemy through psycopg2 (sync) or asyncpg (async)
 
-from sqlalchemy import create_engine
+import functools
+import threading
+import time
+from sqlalchemy import create_engine, event, exc, any_, literal, update, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import create_async_engine, async_session, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+from starlette.concurrency import run_in_threadpool
 from .config import settings
+from . import metrics
 
 SQLALCHEMY_DATABASE_URL = f'postgresql+psycopg2://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
+ASYNC_DATABASE_URL = f'postgresql+asyncpg://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# ===================================================================================================================================
+# CONNECTION POOL
+# ===================================================================================================================================
+# Time spent waiting for a connection at checkout (includes opening a new one when the pool isn't full yet)
+class CheckoutMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    def observe(self, seconds: float, timed_out: bool = False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+checkout_metrics = CheckoutMetrics()
+
+class TimedCheckout:
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            checkout_metrics.observe(time.perf_counter() - start, timed_out)
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+def engine_options(is_async: bool):
+    if settings.database_pool_mode == 'null':
+        # Behind a transaction-pooling pgbouncer: no client-side pool, no server-side prepared statements
+        options = {'poolclass': NullPool}
+        if is_async:
+            options['connect_args'] = {'statement_cache_size': 0, 'prepared_statement_cache_size': 0}
+        return options
+
+    return {
+        'poolclass': TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        'pool_size': settings.database_pool_size,
+        'max_overflow': settings.database_max_overflow,
+        'pool_timeout': settings.database_pool_timeout,
+        'pool_recycle': settings.database_pool_recycle,
+        'pool_pre_ping': settings.database_pool_pre_ping,
+    }
+
+# statement_timeout for every connection (pooled) or every transaction (pgbouncer reassigns server connections per transaction)
+def set_statement_timeout(engine):
+    timeout = settings.database_statement_timeout
+    if not timeout:
+        return
+
+    if settings.database_pool_mode == 'null':
+        @event.listens_for(engine, "begin")
+        def set_local_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+    else:
+        @event.listens_for(engine, "connect")
+        def set_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {int(timeout)}")
+            cursor.close()
+
+def pool_status():
+    engine_pool = (async_engine.sync_engine if async_engine else engine).pool
+    status = {'mode': settings.database_pool_mode}
+    if isinstance(engine_pool, QueuePool):
+        status.update(size=engine_pool.size(), checked_out=engine_pool.checkedout(), overflow=engine_pool.overflow())
+    status.update(checkouts=checkout_metrics.checkouts, timeouts=checkout_metrics.timeouts,
+                  wait_seconds_total=checkout_metrics.wait_total, wait_seconds_max=checkout_metrics.wait_max)
+    return status
+# ===================================================================================================================================
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(is_async=False))
+set_statement_timeout(engine)
+if settings.metrics_enabled:
+    metrics.instrument(engine)
+
+# Objects are serialized after the route returns (outside of the session's greenlet in async mode), so a commit doesn't expire them;
+# otherwise serializing them would select every committed row again
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(is_async=True)) if settings.database_async else None
+if async_engine:
+    set_statement_timeout(async_engine.sync_engine)
+    if settings.metrics_enabled:
+        metrics.instrument(async_engine.sync_engine)
+AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
 
 Base = declarative_base()
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+if settings.database_async:
+    async def get_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+else:
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+# Runs fn(session, *args, **kwargs) without blocking the event loop.
+# AsyncSession: inside run_sync(), where every DB wait is an await on asyncpg
+# Session: in the threadpool, like a regular sync route
+async def run(db, fn, *args, **kwargs):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
+
+# Turns a sync route/dependency with a `db` parameter into an async one that runs its body through run().
+# Bodies keep using the regular Session API, so the same code serves both database modes
+def session_route(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await run(kwargs['db'], lambda db: fn(*args, **{**kwargs, 'db': db}))
+        finally:
+            # Work the body left for after its transaction (session.info['after_route']), e.g. dropping cached responses
+            session = getattr(kwargs['db'], 'sync_session', kwargs['db'])
+            for hook in session.info.pop('after_route', []):
+                await hook()
+    return wrapper
+
+# Entities of an ORM query read through a server-side cursor, `size` rows at a time, so memory stays flat however many rows match.
+# Iterated after the route body has returned (get_db closes the session only once the response is sent);
+# a Session proxied by an AsyncSession is streamed through the AsyncSession, giving an async iterator
+def stream(db, query, size: int = 1000):
+    statement = query.statement.execution_options(yield_per=size)
+    proxy = async_session(db)
+    if proxy is not None:
+        async def entities():
+            result = await proxy.stream(statement)
+            async for entity in result.scalars():
+                yield entity
+        return entities()
+    return iter(db.execute(statement).scalars())
+
+# column = ANY(:ids); the whole list is sent as one array parameter, so the statement is the same for any number of ids
+def any_of(column, ids: list):
+    return column == any_(literal(list(ids), ARRAY(Integer)))
+
+# UPDATE ... RETURNING for a loaded (usually locked) object; the stored values are applied to it as committed state,
+# so it can be serialized without selecting it again
+def update_returning(db, obj, values: dict):
+    table = obj.__table__
+    statement = update(table).where(*[col == getattr(obj, col.key) for col in table.primary_key])
+    row = db.execute(statement.values(values).returning(*[table.c[key] for key in values])).one()
+    for key in values:
+        set_committed_value(obj, key, row._mapping[table.c[key]])
+    return obj
+
+# Foreign keys without an index whose leading columns are the FK columns.
+# Every FK here is used for lookups (and for ON DELETE CASCADE), so each one needs a covering index
+def uncovered_foreign_keys(metadata):
+    uncovered = []
+    for table in metadata.sorted_tables:
+        leading = [list(table.primary_key.columns)] + [list(index.columns) for index in table.indexes]
+        for fk in table.foreign_key_constraints:
+            columns = set(fk.columns)
+            if not any(set(cols[:len(columns)]) == columns for cols in leading):
+                uncovered.append(f"{table.name}({', '.join(col.name for col in fk.columns)})")
+    return uncovered
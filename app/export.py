@@ -0,0 +1,18 @@
+# NDJSON EXPORT
+# One JSON object per line, written while the rows are still being read (see database.stream),
+# so exporting a whole table costs as much memory as one batch of rows
+from fastapi.responses import StreamingResponse
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+def ndjson(entities, schema):
+    if hasattr(entities, '__aiter__'):
+        async def lines():
+            async for entity in entities:
+                yield schema.from_orm(entity).json() + '\n'
+    else:
+        def lines():
+            for entity in entities:
+                yield schema.from_orm(entity).json() + '\n'
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
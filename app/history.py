@@ -0,0 +1,104 @@
+# COMPACT UPDATE HISTORY
+# ticket_updates/project_updates rows store only the fields an update changed, as {"field": [old, new]} in `changes`.
+# Responses keep the old_*/new_* shape with every field: values a row didn't change are rebuilt from the entity's
+# current values by undoing the changes of newer rows, newest first. Ids give the order updates were applied in,
+# since an edit keeps the entity row locked until its history row is committed
+from datetime import date, datetime, time, timezone
+from fastapi import HTTPException, status
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by, insert
+from . import models, pagination, projection, serializers
+from .config import CHANGABLE_PROJECT_ENTRIES, CHANGABLE_TICKET_ENTRIES
+
+# History model: entity model, the history's foreign key to it, tracked fields
+HISTORIES = {
+    models.TicketUpdateHistory: (models.Ticket, models.TicketUpdateHistory.ticket_id, CHANGABLE_TICKET_ENTRIES),
+    models.ProjectUpdateHistory: (models.Project, models.ProjectUpdateHistory.project_id, CHANGABLE_PROJECT_ENTRIES),
+}
+
+# JSON value of a field
+def encode(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+# Response value of a field; history responses have always shown dates as timestamps
+def decode(model, field: str, value):
+    if value is not None and model.__table__.c[field].type.python_type is date:
+        return datetime.combine(date.fromisoformat(value), time.min, timezone.utc)
+    return value
+
+# `changes` of an update from the field values before and after it
+def diff(old: dict, new: dict):
+    return {field: [encode(old[field]), encode(value)] for field, value in new.items() if old[field] != value}
+
+# Response dicts (schemas.*UpdateHistoryResponse) of history rows of one entity, with their editors loaded
+def rebuild(db, history_model, entity_id: int, rows: list):
+    if not rows:
+        return []
+    model, foreign_key, fields = HISTORIES[history_model]
+
+    # Current values and the changes of every row from the oldest one on, newest first; one statement, so they match
+    changes = func.jsonb_agg(aggregate_order_by(func.jsonb_build_array(history_model.id, history_model.changes), history_model.id.desc()), type_=JSONB)
+    newer = select(changes).where(foreign_key == model.id, history_model.id >= min(row.id for row in rows)).scalar_subquery()
+    current = db.query(*[getattr(model, field) for field in fields], newer.label('changes')).filter(model.id == entity_id).one()
+
+    page = {row.id for row in rows}
+    states = {}
+    state = {field: encode(getattr(current, field)) for field in fields}
+    for id, changed in current.changes or []:
+        after = dict(state)
+        for field, (old, new) in changed.items():
+            state[field] = old
+        if id in page:
+            states[id] = (dict(state), after)
+
+    result = []
+    for row in rows:
+        before, after = states[row.id]
+        entry = {'id': row.id, 'updated_at': row.updated_at, 'editor': row.editor}
+        for field in fields:
+            entry[f'old_{field}'] = decode(model, field, before[field])
+            entry[f'new_{field}'] = decode(model, field, after[field])
+        if 'personnel_change' in history_model.__table__.c:
+            entry['personnel_change'] = row.personnel_change
+        result.append(entry)
+    return result
+
+# ===================================================================================================================================
+# PERSONNEL EVENTS
+# ===================================================================================================================================
+# Events of one personnel change, (project_id, user_id) pairs, in one INSERT
+def record_personnel(db, action: str, editor_id: int, pairs: list):
+    if pairs:
+        rows = [{'project_id': project_id, 'user_id': user_id, 'action': action, 'editor_id': editor_id} for project_id, user_id in pairs]
+        db.execute(insert(models.PersonnelEvent).values(rows))
+
+# Events with column == id (user_id or project_id), optionally of one action within [since, until)
+def personnel_events(db, column, id: int, action: str = None, since: datetime = None, until: datetime = None):
+    events = db.query(models.PersonnelEvent).filter(column == id)
+    if action:
+        events = events.filter(models.PersonnelEvent.action == action)
+    if since:
+        events = events.filter(models.PersonnelEvent.at >= since)
+    if until:
+        events = events.filter(models.PersonnelEvent.at < until)
+    return events
+
+# Owner model of a personnel history: the events' column pointing at it
+PERSONNEL_OWNERS = {
+    models.Project: models.PersonnelEvent.project_id,
+    models.User: models.PersonnelEvent.user_id,
+}
+
+# Response of a page of the owner's (project or user) personnel history, oldest first; the cursor of the next page is sent
+# in the X-Next-Cursor header. Rows are shaped like the response schema straight from SQL
+def personnel_page(db, owner, id: int, limit: int, cursor: str = None, action: str = None, since: datetime = None, until: datetime = None):
+    events = personnel_events(db, PERSONNEL_OWNERS[owner], id, action, since, until)
+    keys = [(models.PersonnelEvent.at, False), (models.PersonnelEvent.id, False)]
+    events, next_cursor = pagination.paginate(serializers.PERSONNEL_EVENT.select(events), keys, limit, cursor)
+
+    # Telling an unknown owner from one without events only when there are none
+    if not events and not db.query(db.query(owner).filter(owner.id == id).exists()).scalar():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{owner.__name__} {id} doesn't exist")
+
+    return projection.respond(serializers.PERSONNEL_EVENT.dicts(events), next_cursor)
+# ===================================================================================================================================
@@ -0,0 +1,24 @@
+# EAGER LOADING STRATEGIES
+# One set of loader options per response schema so that serializing a row never triggers a lazy load.
+# Every nested object is a many-to-one over a NOT NULL foreign key, so it's joined into the main query (INNER JOIN);
+# the number of queries per request doesn't depend on the number of rows
+from sqlalchemy.orm import joinedload
+from . import models
+
+# schemas.ProjectResponse
+PROJECT = [joinedload(models.Project.creator, innerjoin=True)]
+
+# schemas.TicketResponse
+TICKET = [
+    joinedload(models.Ticket.project, innerjoin=True).joinedload(models.Project.creator, innerjoin=True),
+    joinedload(models.Ticket.creator, innerjoin=True),
+]
+
+# schemas.CommentResponse
+COMMENT = [joinedload(models.Comment.creator, innerjoin=True)]
+
+# schemas.ProjectUpdateHistoryResponse
+PROJECT_UPDATE = [joinedload(models.ProjectUpdateHistory.editor, innerjoin=True)]
+
+# schemas.TicketUpdateHistoryResponse
+TICKET_UPDATE = [joinedload(models.TicketUpdateHistory.editor, innerjoin=True)]
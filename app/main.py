@@ -1,9 +1,11 @@
 # To connect to venv use command:
 # source venv/bin/activate
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response, status as http_status
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import projects, tickets, users, auth, comments
+from . import metrics
+from .routers import projects, tickets, users, auth, comments, search, status
 # Modules needed for creating tables through sqlqlchemy; Drop if using alembic
 # from . import models
 # from .database import engine
@@ -11,7 +13,9 @@ from .routers import projects, tickets, users, auth, comments
 # Set domains that are able to access this API
 # Origins is a white-list for domains
 origins = []
-app = FastAPI()
+
+# orjson encodes responses several times faster than the standard json module
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -19,6 +23,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so its timings include the other middleware; does nothing unless METRICS_ENABLED
+app.add_middleware(metrics.MetricsMiddleware)
+app.router.route_class = metrics.TimedRoute
 
 # Routers
 app.include_router(projects.router)
@@ -26,6 +33,8 @@ app.include_router(tickets.router)
 app.include_router(users.router)
 app.include_router(auth.router)
 app.include_router(comments.router)
+app.include_router(search.router)
+app.include_router(status.router)
 
 # Create tables using sqlalchemy; Drop it if you use alembic
 # models.Base.metadata.create_all(bind=engine)
@@ -35,6 +44,13 @@ app.include_router(comments.router)
 def test_message():
     return {"message": "successfully deployed from CI/CD pipeline"}
 
+# Request metrics of this worker per route, in the Prometheus text format
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    if not metrics.collector.enabled:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return Response(metrics.collector.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 
 
@@ -0,0 +1,201 @@
+# REQUEST METRICS
+# With METRICS_ENABLED, MetricsMiddleware times every HTTP request: latency until the last byte of the response,
+# time spent in database queries and their number (cursor events of the instrumented engines), serialization (from
+# the endpoint returning until the response starts, which covers response_model validation and rendering; endpoints
+# rendering their own Response, like the cached detail ones, count it as endpoint time) and the response size.
+# Totals per route are served in the Prometheus text format at /metrics; every response carries its own figures in
+# a Server-Timing header. Routes are labeled by their path template, so /projects/1 and /projects/2 add up
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from .config import settings
+
+# Upper bounds (seconds) of the latency histogram's buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Requests not handled by a TimedRoute (404s, the docs) share one label
+OTHER_ROUTE = 'other'
+
+# Figures of the request being handled; the context is copied into threadpool threads and SQLAlchemy's greenlets
+class RequestTimings:
+    __slots__ = ('route', 'db', 'queries', 'handled_at')
+
+    def __init__(self):
+        self.route = None
+        self.db = 0.0
+        self.queries = 0
+        self.handled_at = None
+
+current = contextvars.ContextVar('request_timings', default=None)
+
+# ===================================================================================================================================
+# DATABASE TIME
+# ===================================================================================================================================
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current.get() is not None:
+        context.metrics_started_at = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current.get()
+    started_at = getattr(context, 'metrics_started_at', None)
+    if timings is not None and started_at is not None:
+        timings.db += time.perf_counter() - started_at
+        timings.queries += 1
+
+# Sync engine (async_engine.sync_engine in async mode)
+def instrument(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+# ===================================================================================================================================
+
+# ===================================================================================================================================
+# ROUTES
+# ===================================================================================================================================
+# Labels requests with the route's path template and notes when its endpoint returns; routers use it as their route_class
+class TimedRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        # FastAPI calls the endpoint through dependant.call, in the threadpool unless it's a coroutine function
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed(*args, **kwargs):
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    handled()
+        else:
+            @functools.wraps(endpoint)
+            def timed(*args, **kwargs):
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    handled()
+        super().__init__(path, timed, **kwargs)
+
+    async def handle(self, scope, receive, send):
+        timings = current.get()
+        if timings is not None:
+            timings.route = self.path
+        await super().handle(scope, receive, send)
+
+def handled():
+    timings = current.get()
+    if timings is not None:
+        timings.handled_at = time.perf_counter()
+# ===================================================================================================================================
+
+class RouteStats:
+    __slots__ = ('buckets', 'count', 'duration', 'db', 'queries', 'serialization', 'size')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.db = 0.0
+        self.queries = 0
+        self.serialization = 0.0
+        self.size = 0
+
+def labels(method: str, route: str, status: int, **extra):
+    values = {'method': method, 'route': route, 'status': str(status), **extra}
+    escaped = {name: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in values.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+class Metrics:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def observe(self, method: str, route: str, status: int, duration: float, timings: RequestTimings, serialization: float, size: int):
+        with self.lock:
+            stats = self.routes.get((method, route, status))
+            if stats is None:
+                stats = self.routes[(method, route, status)] = RouteStats()
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats.buckets[i] += 1
+                    break
+            stats.count += 1
+            stats.duration += duration
+            stats.db += timings.db
+            stats.queries += timings.queries
+            stats.serialization += serialization or 0.0
+            stats.size += size
+
+    def clear(self):
+        with self.lock:
+            self.routes = {}
+
+    # Prometheus text exposition format (version 0.0.4)
+    def render(self):
+        with self.lock:
+            routes = sorted(self.routes.items())
+
+        lines = ['# HELP http_request_duration_seconds Time from receiving a request to sending the last byte of its response',
+                 '# TYPE http_request_duration_seconds histogram']
+        for key, stats in routes:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{labels(*key, le=str(bound))} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{labels(*key, le="+Inf")} {stats.count}')
+            lines.append(f'http_request_duration_seconds_sum{labels(*key)} {stats.duration}')
+            lines.append(f'http_request_duration_seconds_count{labels(*key)} {stats.count}')
+
+        counters = [
+            ('http_request_db_seconds_total', 'Time spent in database queries', 'db'),
+            ('http_request_db_queries_total', 'Database queries', 'queries'),
+            ('http_request_serialization_seconds_total', 'Time from the endpoint returning to the response starting', 'serialization'),
+            ('http_response_size_bytes_total', 'Bytes of response bodies', 'size'),
+        ]
+        for name, description, attribute in counters:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            lines += [f'{name}{labels(*key)} {getattr(stats, attribute)}' for key, stats in routes]
+        return '\n'.join(lines) + '\n'
+
+collector = Metrics(settings.metrics_enabled)
+
+def server_timing(timings: RequestTimings, serialization: float, total: float):
+    entries = [f'db;dur={timings.db * 1000:.2f};desc="{timings.queries} queries"']
+    if serialization is not None:
+        entries.append(f'serialize;dur={serialization * 1000:.2f}')
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+# Pure ASGI, so routes run in the middleware's context and see its RequestTimings
+class MetricsMiddleware:
+    def __init__(self, app, metrics: Metrics = collector):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.metrics.enabled:
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = current.set(timings)
+        started_at = time.perf_counter()
+        status, size, serialization = 500, 0, None
+
+        async def send_timed(message):
+            nonlocal status, size, serialization
+            if message['type'] == 'http.response.start':
+                now = time.perf_counter()
+                status = message['status']
+                if timings.handled_at is not None:
+                    serialization = now - timings.handled_at
+                MutableHeaders(scope=message).append('Server-Timing', server_timing(timings, serialization, now - started_at))
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current.reset(token)
+            self.metrics.observe(scope['method'], timings.route or OTHER_ROUTE, status, time.perf_counter() - started_at, timings, serialization, size)
@@ -1,9 +1,24 @@
 from .database import Base
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, ARRAY
-from sqlalchemy.orm import relationship
+from .config import SEARCH_CONFIG
+from sqlalchemy import Column, Integer, BigInteger, String, Date, ForeignKey, ARRAY, Index, Computed, DDL, event
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.expression import text
 
+# Generated tsvector column for full-text search; first column is weighted above the second.
+# Deferred so that regular queries never fetch it
+def search_vector(primary: str, secondary: str = None):
+    expression = f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({primary}, '')), 'A')"
+    if secondary:
+        expression += f" || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({secondary}, '')), 'B')"
+    return deferred(Column(TSVECTOR, Computed(expression, persisted=True)))
+
+# History tables are partitioned by month of updated_at (see app/partitions.py); rows of months without
+# a partition go to <table>_default, created along with the table
+def partitioned_by_month(cls):
+    event.listen(cls.__table__, 'after_create', DDL('CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT'))
+    return cls
 
 # SQLAlchemy model for 'projects' table in postgresql
 class User(Base):
@@ -18,6 +33,9 @@ class User(Base):
     access = Column(String, server_default='user', nullable = False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
 
+    # Keyset pagination order
+    __table_args__ = (Index('users_created_at_id_idx', 'created_at', 'id'),)
+
 class Project(Base):
     __tablename__ = "projects"
 
@@ -29,10 +47,20 @@ class Project(Base):
     status = Column(String, server_default='ongoing', nullable = False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     creator_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    search_vector = search_vector('name', 'description')
+    # Bumped by every change shown on the project's page (see versioning)
+    version = Column(Integer, nullable=False, server_default=text('1'))
 
     # Fetch user object for given creator_id
     creator = relationship("User")
 
+    __table_args__ = (
+        # Keyset pagination order
+        Index('projects_created_at_id_idx', 'created_at', 'id'),
+        Index('projects_search_idx', 'search_vector', postgresql_using='gin'),
+        Index('projects_creator_id_idx', 'creator_id'),
+    )
+
 class Personnel(Base):
     __tablename__ = "personnel"
 
@@ -40,6 +68,9 @@ class Personnel(Base):
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, primary_key=True)
     assigned_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
 
+    # project_id is covered by the primary key
+    __table_args__ = (Index('personnel_user_id_idx', 'user_id'),)
+
 class Ticket(Base):
     __tablename__ = "tickets"
 
@@ -52,11 +83,22 @@ class Ticket(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     creator_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    search_vector = search_vector('caption', 'description')
+    # Bumped by every change shown on the ticket's page (see versioning)
+    version = Column(Integer, nullable=False, server_default=text('1'))
 
     # Fetch creator/project connected to the ticket
     project = relationship("Project")
     creator = relationship("User")
 
+    __table_args__ = (
+        # Keyset pagination order
+        Index('tickets_created_at_id_idx', 'created_at', 'id'),
+        Index('tickets_search_idx', 'search_vector', postgresql_using='gin'),
+        Index('tickets_project_id_created_at_idx', 'project_id', 'created_at'),
+        Index('tickets_creator_id_idx', 'creator_id'),
+    )
+
 class Comment(Base):
     __tablename__ = "comments"
 
@@ -65,57 +107,98 @@ class Comment(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     creator_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     ticket_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), nullable=False)
+    search_vector = search_vector('body_text')
 
     # Fetch user object for given creator_id
     creator = relationship("User")
     ticket = relationship("Ticket")
 
+    __table_args__ = (
+        # Keyset pagination order
+        Index('comments_created_at_id_idx', 'created_at', 'id'),
+        Index('comments_search_idx', 'search_vector', postgresql_using='gin'),
+        Index('comments_ticket_id_created_at_idx', 'ticket_id', 'created_at'),
+        Index('comments_creator_id_idx', 'creator_id'),
+    )
+
+@partitioned_by_month
 class TicketUpdateHistory(Base):
     __tablename__ = "ticket_updates"
 
-    id = Column(Integer, primary_key=True, nullable=False)
-    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    # The partition key has to be part of the primary key; ids alone stay unique, they come from one sequence
+    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False, server_default=text('now()'))
     editor_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     ticket_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), nullable=False)
-     
-    old_caption = Column(String, server_default=None)
-    old_description = Column(String, server_default=None)
-    old_priority = Column(String, server_default=None)
-    old_status = Column(String, server_default=None)
-    old_category = Column(String, server_default=None)
-
-    new_caption = Column(String, server_default=None)
-    new_description = Column(String, server_default=None)
-    new_priority = Column(String, server_default=None)
-    new_status = Column(String, server_default=None)
-    new_category = Column(String, server_default=None)
+
+    # Fields the update changed, {"field": [old, new]}; see app/history.py
+    changes = Column(JSONB, nullable=False, server_default=text("'{}'::jsonb"))
 
     # Fetch user object for given creator_id
     editor = relationship("User")
     ticket = relationship("Ticket")
 
+    __table_args__ = (
+        Index('ticket_updates_ticket_id_updated_at_idx', 'ticket_id', 'updated_at'),
+        Index('ticket_updates_editor_id_idx', 'editor_id'),
+        {'postgresql_partition_by': 'RANGE (updated_at)'},
+    )
+
+@partitioned_by_month
 class ProjectUpdateHistory(Base):
     __tablename__ = "project_updates"
 
-    id = Column(Integer, primary_key=True, nullable=False)
-    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+    # The partition key has to be part of the primary key; ids alone stay unique, they come from one sequence
+    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False, server_default=text('now()'))
     editor_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
-    
-    old_name = Column(String, server_default=None)
-    old_description = Column(String, server_default=None)
-    old_start = Column(TIMESTAMP(timezone=True), server_default=None)
-    old_deadline = Column(TIMESTAMP(timezone=True), server_default=None)
-    old_status = Column(String, server_default=None)
-
-    new_name = Column(String, server_default=None)
-    new_description = Column(String, server_default=None)
-    new_start = Column(TIMESTAMP(timezone=True), server_default=None)
-    new_deadline = Column(TIMESTAMP(timezone=True), server_default=None)
-    new_status = Column(String, server_default=None)
+
+    # Fields the update changed, {"field": [old, new]}; see app/history.py
+    changes = Column(JSONB, nullable=False, server_default=text("'{}'::jsonb"))
 
     personnel_change = Column(String, server_default='')
 
     # Fetch user, project objects for given editor_id
     editor = relationship("User")
-    project = relationship("Project")
\ No newline at end of file
+    project = relationship("Project")
+
+    __table_args__ = (
+        Index('project_updates_project_id_updated_at_idx', 'project_id', 'updated_at'),
+        Index('project_updates_editor_id_idx', 'editor_id'),
+        {'postgresql_partition_by': 'RANGE (updated_at)'},
+    )
+
+# Assignments to/removals from projects, one row per user and project; written alongside the personnel_change
+# entries of project_updates, queryable by user or project without parsing them
+class PersonnelEvent(Base):
+    __tablename__ = "personnel_events"
+
+    id = Column(BigInteger, primary_key=True, nullable=False)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # 'assign' or 'remove'
+    action = Column(String, nullable=False)
+    editor_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+    # Keyset pagination order of a user's/project's events
+    __table_args__ = (
+        Index('personnel_events_user_id_at_id_idx', 'user_id', 'at', 'id'),
+        Index('personnel_events_project_id_at_id_idx', 'project_id', 'at', 'id'),
+        Index('personnel_events_editor_id_idx', 'editor_id'),
+    )
+
+# JWT ids of revoked access/refresh tokens; rows past expires_at can be dropped, the tokens are invalid anyway
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    id = Column(BigInteger, primary_key=True, nullable=False)
+    jti = Column(String, nullable=False, unique=True)
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    revoked_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+    # Syncs re-read recently revoked rows (see app/revocation.py)
+    __table_args__ = (
+        Index('revoked_tokens_revoked_at_idx', 'revoked_at'),
+    )
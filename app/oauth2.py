@@ -1,6 +1,8 @@
+import uuid
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from . import schemas, database, models
+from . import schemas, database, models, cache
+from .revocation import revocations
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
@@ -12,35 +14,73 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 SECRET_KEY=settings.secret_key
 ALGORITHM=settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+REFRESH_TOKEN_EXPIRE_DAYS = settings.refresh_token_expire_days
 
-def create_access_token(data: dict):
+# Every token carries its own id (jti) so it can be revoked, and its type, so a refresh token can't be used as an
+# access token and vice versa
+def create_token(data: dict, token_type: str, expires_in: timedelta):
     to_encode = data.copy()
 
-    expire = datetime.utcnow() + timedelta(minutes = ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({'exp': expire})
+    expire = datetime.utcnow() + expires_in
+    to_encode.update({'exp': expire, 'jti': uuid.uuid4().hex, 'type': token_type})
 
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
     return encoded_jwt
 
-def verify_access_token(token: str, credentials_exception):
+def create_access_token(data: dict):
+    return create_token(data, 'access', timedelta(minutes = ACCESS_TOKEN_EXPIRE_MINUTES))
+
+# Long-lived; exchanged at /token/refresh for a new access token without going through bcrypt again
+def create_refresh_token(data: dict):
+    return create_token(data, 'refresh', timedelta(days = REFRESH_TOKEN_EXPIRE_DAYS))
+
+# Claims of a valid token of the given type; tokens issued before types existed count as access tokens
+def decode_token(token: str, token_type: str, credentials_exception):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        id: str = payload.get("user_id")
-
-        if id is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(id=id)
     except JWTError:
         raise credentials_exception
 
-    return token_data
+    if payload.get("user_id") is None or payload.get("type", 'access') != token_type:
+        raise credentials_exception
+    return payload
+
+def verify_access_token(token: str, credentials_exception):
+    payload = decode_token(token, 'access', credentials_exception)
+    return schemas.TokenData(id=payload.get("user_id"), jti=payload.get("jti"))
+
+# Users by id for get_current_user, the lookup behind every authenticated request.
+# Entries hold column values (no password); edit_user/delete_user invalidate them
+user_cache = cache.TTLCache(settings.user_cache_size, settings.user_cache_ttl)
+USER_COLUMNS = [col.key for col in models.User.__table__.columns if col.key != 'password']
+
+def load_user(db: Session, id: int):
+    user = db.query(models.User).filter(models.User.id == id).first()
+    if not user:
+        return None
+    return {key: getattr(user, key) for key in USER_COLUMNS}
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                                           detail="Couldn't Validate Credentials", 
                                           headers={'WWW-Authenticate': "Bearer"})
     token = verify_access_token(token, credentials_exception)
-    user = db.query(models.User).filter(models.User.id == token.id).first()
 
-    return user
+    # Revoked tokens; the db is only asked about ids the bloom filter reports
+    if revocations.stale():
+        await database.run(db, revocations.sync)
+    if token.jti and revocations.might_be_revoked(token.jti):
+        if await database.run(db, revocations.is_revoked, token.jti):
+            raise credentials_exception
+
+    # The database is only queried on a cache miss; deleted users are logged off
+    user = user_cache.get(token.id)
+    if user is None:
+        user = await database.run(db, load_user, token.id)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(token.id, user)
+
+    # Every request gets its own (detached) User
+    return models.User(**user)
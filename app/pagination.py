@@ -0,0 +1,97 @@
+# KEYSET (CURSOR) PAGINATION
+# Pages are addressed by the sort key of the last row the client has seen instead of an offset,
+# so fetching page N costs the same as fetching page 1 as long as the sort key is indexed
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.types import DateTime
+
+# Upper bound for every ?limit= on paginated endpoints
+MAX_PAGE_SIZE = 1000
+
+# Response header carrying the cursor of the next page; absent on the last page
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+# Keys are lists of (column, descending) pairs, most significant first.
+# The last key has to be unique (usually the primary key) for the ordering to be stable
+
+def encode_cursor(values: list):
+    values = [val.isoformat() if isinstance(val, datetime) else val for val in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# Cursor value as the column's type; values of any other type are rejected here rather than by postgres
+def restore(value, col):
+    # Restoring types lost in JSON
+    if isinstance(col.type, DateTime):
+        return datetime.fromisoformat(value)
+    expected = col.type.python_type
+    if expected is float and type(value) is int:
+        return float(value)
+    if type(value) is not expected:
+        raise ValueError
+    return value
+
+def decode_cursor(cursor: str, keys: list):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError
+        return [restore(val, col) for val, (col, _) in zip(values, keys)]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def ordering(keys: list):
+    return [col.desc() if descending else col.asc() for col, descending in keys]
+
+def after(keys: list, values: list):
+    # Row comparison lets postgres walk a composite index directly
+    if len({descending for _, descending in keys}) == 1:
+        columns = tuple_(*[col for col, _ in keys])
+        if keys[0][1]:
+            return columns < tuple_(*values)
+        return columns > tuple_(*values)
+
+    # Mixed directions: (a > x) OR (a = x AND b < y) OR ...
+    conditions = []
+    for i, (col, descending) in enumerate(keys):
+        previous = [prev_col == val for (prev_col, _), val in zip(keys[:i], values[:i])]
+        conditions.append(and_(*previous, col < values[i] if descending else col > values[i]))
+    return or_(*conditions)
+
+# Every row after the cursor (all rows without one), in keyset order
+def seek(query, keys: list, cursor: str = None):
+    query = query.order_by(*ordering(keys))
+    if cursor:
+        query = query.filter(after(keys, decode_cursor(cursor, keys)))
+    return query
+
+def paginate(query, keys: list, limit: int, cursor: str = None, row_keys=None):
+    # Returns the requested page and the cursor of the next one (None on the last page)
+    if row_keys is None:
+        row_keys = lambda row: [getattr(row, col.key) for col, _ in keys]
+
+    query = seek(query, keys, cursor)
+
+    # Fetching one extra row tells whether there is a next page without a COUNT
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(row_keys(rows[-1]))
+
+# Sub-collections of detail endpoints (a project's tickets, ...) are paginated one by one.
+# ?include=a,b selects the collections (all of them by default), ?limit= applies to each one and the response's
+# next_cursors holds the cursor of every collection with more rows. A cursor continues a single collection,
+# so it's accepted only together with exactly one included collection
+def included(include: str, collections: list, cursor: str = None):
+    names = [name.strip() for name in include.split(',') if name.strip()] or list(collections)
+    for name in names:
+        if name not in collections:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Can't include '{name}'; available collections: {', '.join(collections)}")
+
+    if cursor and len(names) != 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A cursor continues one collection; include exactly one")
+    return names
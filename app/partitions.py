@@ -0,0 +1,105 @@
+# MONTHLY HISTORY PARTITIONS
+# ticket_updates and project_updates are partitioned by month of updated_at (UTC): reads of recent history touch small
+# partitions, and old months leave as whole tables instead of row by row DELETEs that vacuum has to clean up after.
+# Rows of months without a partition go to <table>_default; creating the month's partition moves them out of it.
+#
+#   python -m app.partitions create [months]    partitions up to `months` ahead (HISTORY_PARTITIONS_AHEAD); run monthly
+#   python -m app.partitions archive [months]   keeps the last `months` (HISTORY_RETENTION_MONTHS) full months; older
+#                                               partitions are detached, written to HISTORY_ARCHIVE_DIR/<partition>.csv.gz and dropped
+import gzip
+import os
+import sys
+from datetime import datetime, timezone
+from sqlalchemy import text
+from . import database, models
+from .config import settings
+
+TABLES = [models.TicketUpdateHistory.__table__, models.ProjectUpdateHistory.__table__]
+
+# First moment of the month `offset` months from the one of `value`
+def month(value: datetime, offset: int = 0):
+    index = value.year * 12 + value.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_name(table, start: datetime):
+    return f'{table.name}_y{start:%Y}m{start:%m}'
+
+# Monthly partitions of the table by name: (first moment of the month, attached). A detached one was left by an archive run that didn't finish
+def partitions(connection, table):
+    rows = connection.execute(text("SELECT relname, relispartition FROM pg_class WHERE relkind = 'r' AND relname ~ :pattern AND pg_table_is_visible(oid)"),
+                              {'pattern': f'^{table.name}_y[0-9]{{4}}m[0-9]{{2}}$'})
+    return {row.relname: (datetime(int(row.relname[-7:-3]), int(row.relname[-2:]), 1, tzinfo=timezone.utc), row.relispartition) for row in rows}
+
+# Partition of the month starting at `start`, holding the month's rows the default partition had.
+# Inserts into the default partition wait until the transaction is over, so none of them can end up in the wrong partition
+def create(connection, table, start: datetime):
+    name, end = partition_name(table, start), month(start, 1)
+    columns = ', '.join(column.name for column in table.columns)
+    connection.exec_driver_sql(f'LOCK TABLE {table.name}_default IN EXCLUSIVE MODE')
+    connection.exec_driver_sql(f'CREATE TABLE {name} (LIKE {table.name} INCLUDING DEFAULTS)')
+    connection.execute(text(f"""WITH moved AS (DELETE FROM {table.name}_default WHERE updated_at >= :start AND updated_at < :end RETURNING {columns})
+                                INSERT INTO {name} ({columns}) SELECT {columns} FROM moved"""), {'start': start, 'end': end})
+    # Attaching adds the parent's indexes, primary key and foreign keys
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+    return name
+
+# Partitions of this month, the next `ahead` ones and every month the default partition has rows of; one transaction each
+def create_partitions(engine, ahead: int):
+    now = datetime.now(timezone.utc)
+    created = []
+    for table in TABLES:
+        with engine.connect() as connection:
+            existing = partitions(connection, table)
+            stray = connection.execute(text(f"SELECT DISTINCT date_trunc('month', updated_at AT TIME ZONE 'UTC') AS start FROM {table.name}_default")).scalars().all()
+
+        starts = {month(now, offset) for offset in range(ahead + 1)} | {start.replace(tzinfo=timezone.utc) for start in stray}
+        for start in sorted(starts):
+            if partition_name(table, start) not in existing:
+                with engine.begin() as connection:
+                    created.append(create(connection, table, start))
+    return created
+
+# Rows of a (detached) partition as a gzipped CSV with a header; written under a temporary name and synced
+# before it's renamed, so a file with the final name is always complete
+def export(engine, name: str, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.csv.gz')
+    with engine.connect() as connection, open(f'{path}.part', 'wb') as file:
+        with gzip.GzipFile(filename=f'{name}.csv', mode='wb', fileobj=file) as archive:
+            connection.connection.cursor().copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{path}.part', path)
+    return path
+
+# Partitions of months before the last `keep` full ones are detached, exported and dropped, one at a time; a run that
+# stops halfway is finished by the next one. Rows left in the default partition are never archived
+def archive_partitions(engine, keep: int, directory: str):
+    cutoff = month(datetime.now(timezone.utc), -keep)
+    archived = []
+    for table in TABLES:
+        with engine.connect() as connection:
+            old = sorted((start, name, attached) for name, (start, attached) in partitions(connection, table).items() if month(start, 1) <= cutoff)
+
+        for _, name, attached in old:
+            if attached:
+                with engine.begin() as connection:
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} DETACH PARTITION {name}')
+            archived.append(export(engine, name, directory))
+            with engine.begin() as connection:
+                connection.exec_driver_sql(f'DROP TABLE {name}')
+    return archived
+
+def main(command: str = None, months: str = None):
+    if command == 'create':
+        names = create_partitions(database.engine, settings.history_partitions_ahead if months is None else int(months))
+    elif command == 'archive':
+        names = archive_partitions(database.engine, settings.history_retention_months if months is None else int(months), settings.history_archive_dir)
+    else:
+        sys.exit('usage: python -m app.partitions create|archive [months]')
+
+    for name in names:
+        print(name)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,60 @@
+# SPARSE FIELDSETS AND COMPACT VIEW OF LIST ENDPOINTS
+# ?fields=a,b returns only the listed columns of every row.
+# ?view=compact returns rows referencing their project/creator by id, plus 'projects' and 'users' dictionaries
+# holding every referenced entity once, instead of nesting full copies into each row.
+# Both select just the needed columns (no ORM objects, no joined relationships) and skip response model validation;
+# values are converted like the full view's (ids as strings, validators) by serializers.converter
+from fastapi import HTTPException, status
+from fastapi.responses import ORJSONResponse
+from . import models, schemas, pagination, serializers
+from .database import any_of
+
+# Columns of a model that are part of its response schema (so never users.password)
+def schema_columns(model, schema):
+    return [name for name in schema.__fields__ if name in model.__table__.c]
+
+# Requested columns (all schema columns by default); compact rows always carry the ids of the entities they reference
+def columns(model, schema, fields: str, view: str, references: list = ()):
+    available = schema_columns(model, schema)
+    names = [name.strip() for name in fields.split(',') if name.strip()] or available
+    for name in names:
+        if name not in available:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown field '{name}'; available fields: {', '.join(available)}")
+
+    if view == 'compact':
+        names += [name for name in references if name not in names]
+    return names
+
+# Replaces the query's entity with the requested columns, plus the pagination keys that aren't requested
+def select_columns(query, model, names: list, keys: list):
+    selected = names + [col.key for col, _ in keys if col.key not in names]
+    return query.with_entities(*[getattr(model, name) for name in selected])
+
+# Serialized value of each column, as the schema's field would give it
+def converters(model, schema, names: list):
+    return {name: serializers.converter(schema, schema.__fields__[name], model.__table__.c[name]) for name in names}
+
+def as_dicts(rows, model, schema, names: list):
+    convert = converters(model, schema, names)
+    return [{name: convert[name](getattr(row, name)) for name in names} for row in rows]
+
+# Every referenced project/user once, keyed by id; projects reference their creators in turn
+def side_load(db, project_ids: set = (), user_ids: set = ()):
+    user_ids = set(user_ids)
+    loaded = {}
+
+    if project_ids:
+        names = schema_columns(models.Project, schemas.ProjectResponse)
+        rows = db.query(*[getattr(models.Project, name) for name in names]).filter(any_of(models.Project.id, project_ids)).all()
+        loaded['projects'] = {row.id: item for row, item in zip(rows, as_dicts(rows, models.Project, schemas.ProjectResponse, names))}
+        user_ids |= {row.creator_id for row in rows}
+
+    names = schema_columns(models.User, schemas.UserResponse)
+    rows = db.query(*[getattr(models.User, name) for name in names]).filter(any_of(models.User.id, user_ids)).all() if user_ids else []
+    loaded['users'] = {row.id: item for row, item in zip(rows, as_dicts(rows, models.User, schemas.UserResponse, names))}
+    return loaded
+
+# Returned as is: the rows are plain dicts already (dates and datetimes are encoded by orjson)
+def respond(content, next_cursor: str = None):
+    headers = {pagination.NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return ORJSONResponse(content=content, headers=headers)
@@ -0,0 +1,302 @@
+# RESPONSE CACHE (detail endpoints)
+# Rendered responses of GET /projects/{id}, /tickets/{id}, /users/{id} and /comments/{id}, one entry per query string,
+# kept in this worker (memory backend) or in a Redis-protocol server shared by every worker (redis backend).
+# Invalidation is generation based: an entry's key is made of the current generations of the tags its response
+# depends on (project:1, users, ...). Routes changing data drop the generations of the tags they touch once their
+# transaction is over (see database.session_route), so entries rendered from older data are never found again and
+# just age out. Generations are read before the database is, so a response read while a change commits is stored
+# under the generations the change drops.
+# With the memory backend, generations are dropped only in the worker that handled the change: under several
+# uvicorn workers, the others keep serving the old body and ETag for up to RESPONSE_CACHE_TTL seconds, including to
+# the editor when their next request lands on another worker. Use the redis backend to run more than one worker
+import functools
+import hashlib
+import queue
+import secrets
+import socket
+import threading
+from urllib.parse import urlsplit
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from . import cache, versioning
+from .config import settings
+
+# Tags an endpoint's entries depend on. Per id tags are dropped by changes shown on that page only (a new comment
+# drops its ticket:<id>), type-wide ones by changes to rows nested in other pages (an edited project is nested in its tickets)
+TAGS = {
+    'projects': lambda id: [f'project:{id}', 'users'],
+    'tickets': lambda id: [f'ticket:{id}', 'projects', 'users'],
+    'users': lambda id: [f'user:{id}', 'projects', 'tickets', 'users'],
+    'comments': lambda id: [f'comment:{id}', 'tickets', 'projects', 'users'],
+}
+
+# Generations outlive the entries keyed with them; one that is evicted anyway is replaced by a new one, dropping those entries
+GENERATION_LIFETIME = 10
+
+# ===================================================================================================================================
+# REDIS PROTOCOL (RESP) CLIENT
+# ===================================================================================================================================
+class RESPError(Exception):
+    pass
+
+def encode(command):
+    args = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in command]
+    return b'*%d\r\n' % len(args) + b''.join(b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in args)
+
+# One reply (or command, which is an array of bulk strings); error replies are returned, not raised,
+# so the rest of a pipeline is still read off the connection
+def read(stream):
+    line = stream.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed by the server')
+    kind, data = line[:1], line[1:-2]
+    if kind == b'+':
+        return data.decode()
+    if kind == b'-':
+        return RESPError(data.decode())
+    if kind == b':':
+        return int(data)
+    if kind == b'$':
+        if int(data) < 0:
+            return None
+        value = stream.read(int(data) + 2)
+        if len(value) != int(data) + 2:
+            raise ConnectionError('connection closed by the server')
+        return value[:-2]
+    if kind == b'*':
+        return None if int(data) < 0 else [read(stream) for _ in range(int(data))]
+    raise RESPError(f'unexpected reply {line!r}')
+
+# Blocking client with a pool of idle connections (redis://[:password@]host[:port][/db])
+class RESPClient:
+    def __init__(self, url: str, timeout: float = 1.0):
+        parts = urlsplit(url)
+        self.address = (parts.hostname or 'localhost', parts.port or 6379)
+        self.password = parts.password
+        self.database = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile('rb'))
+        setup = ([('AUTH', self.password)] if self.password else []) + ([('SELECT', self.database)] if self.database else [])
+        if setup:
+            errors = [reply for reply in self.send(connection, setup) if isinstance(reply, RESPError)]
+            if errors:
+                sock.close()
+                raise errors[0]
+        return connection
+
+    def send(self, connection, commands):
+        connection[0].sendall(b''.join(encode(command) for command in commands))
+        return [read(connection[1]) for _ in commands]
+
+    # Replies to the commands, sent together in one write (pipelining)
+    def execute(self, *commands):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+        try:
+            replies = self.send(connection, commands)
+        except BaseException:
+            connection[0].close()
+            raise
+        self.idle.put(connection)
+
+        errors = [reply for reply in replies if isinstance(reply, RESPError)]
+        if errors:
+            raise errors[0]
+        return replies
+
+# Backend failures are cache misses; the request is served from the database
+BACKEND_ERRORS = (OSError, RESPError)
+# ===================================================================================================================================
+
+# ===================================================================================================================================
+# BACKENDS
+# ===================================================================================================================================
+# Least recently used entries are evicted once there are `maxsize` of them
+class MemoryBackend:
+    name = 'memory'
+    blocking = False
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.entries = cache.TTLCache(maxsize, ttl)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def get_many(self, keys):
+        return [self.entries.get(key) for key in keys]
+
+    # Values stored for the keys, setting the missing ones first
+    def setdefault_many(self, values: dict, ttl: int):
+        return [self.entries.setdefault(key, value, ttl) for key, value in values.items()]
+
+    def set(self, key, value, ttl: int):
+        self.entries.set(key, value, ttl)
+
+    def delete(self, keys):
+        for key in keys:
+            self.entries.invalidate(key)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        stats = self.entries.stats()
+        return {'backend': self.name, 'size': stats['size'], 'maxsize': stats['maxsize'], 'evictions': stats['evictions']}
+
+# Eviction is left to the server's maxmemory policy
+class RedisBackend:
+    name = 'redis'
+    blocking = True
+
+    def __init__(self, client: RESPClient):
+        self.client = client
+
+    def get(self, key):
+        return self.client.execute(('GET', key))[0]
+
+    def get_many(self, keys):
+        return self.client.execute(('MGET', *keys))[0]
+
+    def setdefault_many(self, values: dict, ttl: int):
+        commands = [('SET', key, value, 'EX', ttl, 'NX') for key, value in values.items()]
+        return self.client.execute(*commands, ('MGET', *values))[-1]
+
+    def set(self, key, value, ttl: int):
+        self.client.execute(('SET', key, value, 'EX', ttl))
+
+    def delete(self, keys):
+        self.client.execute(('DEL', *keys))
+
+    # Drops every key of the server's database (tests)
+    def clear(self):
+        self.client.execute(('FLUSHDB',))
+
+    def stats(self):
+        return {'backend': self.name}
+# ===================================================================================================================================
+
+class ResponseCache:
+    def __init__(self, backend, ttl: int, endpoints):
+        unknown = set(endpoints) - set(TAGS)
+        if unknown:
+            raise ValueError(f"unknown cached endpoints: {', '.join(sorted(unknown))}")
+
+        self.backend = backend
+        self.ttl = ttl
+        self.endpoints = set(endpoints) if ttl > 0 else set()
+        self.lock = threading.Lock()
+        self.counters = {endpoint: {'hits': 0, 'misses': 0, 'errors': 0} for endpoint in TAGS}
+        self.invalidation_errors = 0
+
+    # Backend calls; the redis one waits on a socket, so it runs in the threadpool
+    async def call(self, fn, *args):
+        if self.backend.blocking:
+            return await run_in_threadpool(fn, *args)
+        return fn(*args)
+
+    def count(self, endpoint: str, counter: str):
+        with self.lock:
+            self.counters[endpoint][counter] += 1
+
+    # Key of a request's entry under the current generations of its tags, and the entry if there is one
+    def lookup(self, endpoint: str, id: int, query: str):
+        names = [f'generation:{tag}' for tag in TAGS[endpoint](id)]
+        generations = self.backend.get_many(names)
+
+        missing = {name: secrets.token_hex(4) for name, generation in zip(names, generations) if generation is None}
+        if missing:
+            created = dict(zip(missing, self.backend.setdefault_many(missing, self.ttl * GENERATION_LIFETIME)))
+            generations = [created.get(name, generation) for name, generation in zip(names, generations)]
+
+        generations = [generation.decode() if isinstance(generation, bytes) else generation for generation in generations]
+        digest = hashlib.blake2b(query.encode(), digest_size=8).hexdigest()
+        key = f"response:{endpoint}:{id}:{'.'.join(generations)}:{digest}"
+        return key, self.backend.get(key)
+
+    # Serves a detail route from the cache. The route takes `id`, `request` and `response`; its ETag, if it sets one,
+    # is cached with the body, so polls with a matching If-None-Match are answered without the database
+    def cached(self, endpoint: str, schema):
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if endpoint not in self.endpoints:
+                    return await fn(*args, **kwargs)
+
+                request = kwargs['request']
+                try:
+                    key, entry = await self.call(self.lookup, endpoint, kwargs['id'], request.url.query)
+                except BACKEND_ERRORS:
+                    self.count(endpoint, 'errors')
+                    return await fn(*args, **kwargs)
+
+                # Entries are the ETag and the body, separated by a newline
+                if entry is not None:
+                    self.count(endpoint, 'hits')
+                    tag, body = entry.split(b'\n', 1)
+                    tag = tag.decode()
+                    if tag and versioning.matches(request, tag):
+                        return versioning.not_modified(tag)
+                    return Response(body, media_type=ORJSONResponse.media_type, headers={'ETag': tag} if tag else None)
+
+                self.count(endpoint, 'misses')
+                result = await fn(*args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+
+                # Rendering the response like FastAPI would, so the body can be stored
+                tag = kwargs['response'].headers.get('etag', '')
+                rendered = ORJSONResponse(jsonable_encoder(schema.validate(result)), headers={'ETag': tag} if tag else None)
+                try:
+                    await self.call(self.backend.set, key, tag.encode() + b'\n' + rendered.body, self.ttl)
+                except BACKEND_ERRORS:
+                    self.count(endpoint, 'errors')
+                return rendered
+            return wrapper
+        return decorator
+
+    # Drops the tags' generations once the route's transaction is over; call it next to the changes
+    def invalidate(self, db, *tags):
+        if self.ttl <= 0:
+            return
+        pending = db.info.get('invalidated_tags')
+        if pending is None:
+            pending = db.info['invalidated_tags'] = set()
+            db.info.setdefault('after_route', []).append(functools.partial(self.drop, db))
+        pending.update(tags)
+
+    async def drop(self, db):
+        tags = db.info.pop('invalidated_tags', ())
+        try:
+            await self.call(self.backend.delete, [f'generation:{tag}' for tag in tags])
+        except BACKEND_ERRORS:
+            # Entries of these tags are served until they expire
+            with self.lock:
+                self.invalidation_errors += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        endpoints = {}
+        for endpoint, counters in self.counters.items():
+            lookups = counters['hits'] + counters['misses']
+            endpoints[endpoint] = {'enabled': endpoint in self.endpoints, **counters,
+                                   'hit_rate': counters['hits'] / lookups if lookups else None}
+        return {**self.backend.stats(), 'ttl': self.ttl, 'invalidation_errors': self.invalidation_errors, 'endpoints': endpoints}
+
+def create_backend():
+    if settings.response_cache_backend == 'redis':
+        return RedisBackend(RESPClient(settings.response_cache_url))
+    return MemoryBackend(settings.response_cache_size, settings.response_cache_ttl)
+
+detail_cache = ResponseCache(create_backend(), settings.response_cache_ttl,
+                             [name.strip() for name in settings.response_cache_endpoints.split(',') if name.strip()])
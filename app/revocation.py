@@ -0,0 +1,110 @@
+# TOKEN REVOCATION LIST
+# Revoked JWT ids live in the revoked_tokens table. Every worker keeps a bloom filter of them, synced at most
+# REVOCATION_SYNC_INTERVAL seconds apart, so checking a token costs no query: only ids the filter reports as present
+# (revoked, or a rare false positive) are confirmed in the db. Tokens revoked in this worker are added right away;
+# revocations made by other workers apply after their next sync. Ids are handed out before their transactions commit,
+# so they can commit out of order: each sync also re-reads the rows revoked within REVOCATION_SYNC_MARGIN seconds
+# before the previous one, picking up rows with lower ids that committed after it
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+from . import models
+from .config import settings
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # Double hashing: k positions from two 64-bit halves of one digest
+    def positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+class RevocationList:
+    def __init__(self, capacity: int, interval: float, margin: float):
+        self.capacity = capacity
+        self.interval = interval
+        self.margin = timedelta(seconds=margin)
+        # lock guards the filter (held only for in-memory work), syncing lets one request at a time query the db
+        self.lock = threading.Lock()
+        self.syncing = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.bloom = BloomFilter(self.capacity)
+            self.bloom_capacity = self.capacity
+            self.count = 0
+            self.last_id = 0
+            self.synced_at = None
+            self.last_sync_started = None
+
+    def stale(self):
+        return self.synced_at is None or time.monotonic() - self.synced_at >= self.interval
+
+    # Adds rows revoked since the last sync; rebuilds the filter from unexpired rows once it's over capacity, sized
+    # for twice as many rows as there are, so it isn't rebuilt again on the next sync.
+    # Requests arriving during a sync go on with the current filter instead of waiting
+    def sync(self, db):
+        if not self.syncing.acquire(blocking=False):
+            return
+        try:
+            if not self.stale():
+                return
+            started = datetime.now(timezone.utc)
+            rebuild = self.count >= self.bloom_capacity
+            rows = db.query(models.RevokedToken.id, models.RevokedToken.jti)
+            if rebuild:
+                rows = rows.filter(models.RevokedToken.expires_at > func.now())
+            elif self.last_sync_started is not None:
+                rows = rows.filter(or_(models.RevokedToken.id > self.last_id,
+                                       models.RevokedToken.revoked_at > self.last_sync_started - self.margin))
+            rows = rows.order_by(models.RevokedToken.id).all()
+
+            with self.lock:
+                if rebuild:
+                    self.bloom_capacity = max(self.capacity, 2 * len(rows))
+                    self.bloom, self.count = BloomFilter(self.bloom_capacity), 0
+                for row in rows:
+                    self.bloom.add(row.jti)
+                    # Re-read rows were counted already; late ones below last_id aren't, the count is an estimate
+                    if rebuild or row.id > self.last_id:
+                        self.count += 1
+                    self.last_id = max(self.last_id, row.id)
+                self.synced_at = time.monotonic()
+                self.last_sync_started = started
+        finally:
+            self.syncing.release()
+
+    def might_be_revoked(self, jti: str):
+        return jti in self.bloom
+
+    def is_revoked(self, db, jti: str):
+        return db.query(db.query(models.RevokedToken).filter(models.RevokedToken.jti == jti).exists()).scalar()
+
+    # Commits. False if the token had been revoked already, so concurrent requests can't both use up one token
+    def revoke(self, db, jti: str, expires: int):
+        expires_at = datetime.fromtimestamp(expires, timezone.utc)
+        statement = insert(models.RevokedToken).values(jti=jti, expires_at=expires_at).on_conflict_do_nothing()
+        revoked = db.execute(statement.returning(models.RevokedToken.id)).first() is not None
+        db.commit()
+        # Counted by the sync that reads it back
+        with self.lock:
+            self.bloom.add(jti)
+        return revoked
+
+revocations = RevocationList(settings.revocation_bloom_capacity, settings.revocation_sync_interval, settings.revocation_sync_margin)
@@ -1,37 +1,95 @@
-from fastapi import APIRouter, Depends, status, HTTPException
+from fastapi import APIRouter, Depends, status, HTTPException, Response
 from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy import or_
+from ..database import get_db, run
 from .. import schemas, models, utils, oauth2
+from ..revocation import revocations
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from typing import Optional
+from ..metrics import TimedRoute
 
 
 router = APIRouter(
-    tags=["Authentication"]
+    tags=["Authentication"],
+    route_class=TimedRoute
 )
 
+# Login and signup are async: the database work goes through run() and bcrypt through the password pool,
+# so neither blocks the event loop nor holds a threadpool slot while hashing
+
+# Email or username in one query (both are unique, so both are indexed); an email match wins
+# if the login is one user's email and another one's username
+def find_user(db: Session, login: str):
+    by_email = models.User.email == login
+    return db.query(models.User).filter(or_(by_email, models.User.username == login)).order_by(by_email.desc()).first()
+
+def update_password(db: Session, id: int, hashed_pwd: str):
+    db.query(models.User).filter(models.User.id == id).update({'password': hashed_pwd}, synchronize_session=False)
+    db.commit()
+
 @router.post("/login", response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
 
-    user = db.query(models.User).filter(models.User.email == user_credentials.username).first()
+    user = await run(db, find_user, user_credentials.username)
     if not user:
-        user = db.query(models.User).filter(models.User.username == user_credentials.username).first()
-        if not user:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
+        # Verifying anyway, so the response time doesn't tell whether the account exists
+        await utils.verify_unknown(user_credentials.password)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
-    if not utils.verify(user_credentials.password, user.password):
+    valid, new_hash = await utils.password_pool.run(utils.verify_and_update, user_credentials.password, user.password)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
+    # Rehashing with the current bcrypt cost
+    if new_hash:
+        await run(db, update_password, user.id, new_hash)
+
     access_token = oauth2.create_access_token(data = {"user_id": user.id})
-    return {"access_token": access_token, "token_type": "bearer"}
-    
-# Create a new user
-@router.post("/signup", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
-def create_user(user_info: schemas.RequestUserSignup, db: Session = Depends(get_db)):
-    
-    # Hash the password and store it in user_info
-    hashed_pwd = utils.hash(user_info.password)
-    user_info.password = hashed_pwd
+    refresh_token = oauth2.create_refresh_token(data = {"user_id": user.id})
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+# Refresh tokens are single use: each one is revoked when exchanged, unless the user has been deleted in the meantime
+def use_refresh_token(db: Session, claims: dict):
+    if not db.query(models.User.id).filter(models.User.id == int(claims['user_id'])).first():
+        return False
+    return revocations.revoke(db, claims['jti'], claims['exp'])
 
+# New access and refresh tokens for a refresh token; no password, so no bcrypt
+@router.post("/token/refresh", response_model=schemas.Token)
+async def refresh(token_info: schemas.RequestTokenRefresh, db: Session = Depends(get_db)):
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token",
+                                          headers={'WWW-Authenticate': "Bearer"})
+    claims = oauth2.decode_token(token_info.refresh_token, 'refresh', credentials_exception)
+    if not claims.get('jti') or not await run(db, use_refresh_token, claims):
+        raise credentials_exception
+
+    access_token = oauth2.create_access_token(data = {"user_id": claims['user_id']})
+    refresh_token = oauth2.create_refresh_token(data = {"user_id": claims['user_id']})
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+def revoke_tokens(db: Session, tokens: list):
+    for claims in tokens:
+        revocations.revoke(db, claims['jti'], claims['exp'])
+
+# Revokes the access token (and the user's refresh token, if sent)
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(logout_info: Optional[schemas.RequestLogout] = None,
+                 token: str = Depends(oauth2.oauth2_scheme),
+                 db: Session = Depends(get_db),
+                 current_user: models.User = Depends(oauth2.get_current_user)):
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+
+    tokens = [oauth2.decode_token(token, 'access', credentials_exception)]
+    if logout_info and logout_info.refresh_token:
+        claims = oauth2.decode_token(logout_info.refresh_token, 'refresh', credentials_exception)
+        if int(claims['user_id']) != current_user.id:
+            raise credentials_exception
+        tokens.append(claims)
+
+    await run(db, revoke_tokens, [claims for claims in tokens if claims.get('jti')])
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+def save_user(db: Session, user_info: schemas.RequestUserSignup):
     user = models.User(**user_info.dict())
     
     # A way to create the first admin account
@@ -42,4 +100,14 @@ def create_user(user_info: schemas.RequestUserSignup, db: Session = Depends(get_
     db.commit()
     db.refresh(user)
 
-    return user
\ No newline at end of file
+    return user
+    
+# Create a new user
+@router.post("/signup", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
+async def create_user(user_info: schemas.RequestUserSignup, db: Session = Depends(get_db)):
+    
+    # Hash the password and store it in user_info
+    hashed_pwd = await utils.password_pool.run(utils.hash, user_info.password)
+    user_info.password = hashed_pwd
+
+    return await run(db, save_user, user_info)
@@ -1,47 +1,68 @@
-from fastapi import status, HTTPException, Response, Depends, APIRouter
+from fastapi import status, HTTPException, Request, Response, Depends, APIRouter, Query
 from sqlalchemy.orm import Session
-from .. import models, schemas, oauth2
-from ..database import get_db
+from .. import models, schemas, oauth2, pagination, projection, serializers, loaders, versioning, export
+from ..database import get_db, session_route, update_returning, stream
+from ..response_cache import detail_cache
 from ..config import CHANGABLE_COMMENT_ENTRIES
-from typing import List
+from typing import List, Literal, Optional
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix="/comments",
-    tags=["Comments"]
+    tags=["Comments"],
+    route_class=TimedRoute
 )
 
 # Get all comments
 @router.get("/", response_model=List[schemas.CommentResponse])
-def get_all_users(db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+@session_route
+def get_all_users(db: Session = Depends(get_db),
+                  current_user: models.User = Depends(oauth2.get_current_user),
+                  limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                  cursor: Optional[str] = None,
+                  format: Literal['json', 'ndjson'] = 'json'):
 
-    comments = db.query(models.Comment).all()
-    return comments
+    comments = db.query(models.Comment)
+
+    # Oldest first; the cursor of the next page is sent in the X-Next-Cursor header
+    keys = [(models.Comment.created_at, False), (models.Comment.id, False)]
+
+    # Export: every comment after the cursor, one JSON object per line, streamed from a server-side cursor (no limit)
+    if format == 'ndjson':
+        return export.ndjson(stream(db, pagination.seek(comments.options(*loaders.COMMENT), keys, cursor)), schemas.CommentResponse)
+
+    # Rows shaped like the response schema straight from SQL
+    comments, next_cursor = pagination.paginate(serializers.COMMENT.select(comments), keys, limit, cursor)
+    return projection.respond(serializers.COMMENT.dicts(comments), next_cursor)
 
 # Get one Comment
 @router.get("/{id}", response_model=schemas.CommentOut)
-def get_a_comment(id: int, db: Session = Depends(get_db)):
+@detail_cache.cached('comments', schemas.CommentOut)
+@session_route
+def get_a_comment(id: int, request: Request, response: Response, db: Session = Depends(get_db)):
 
     # Retrieve comment
-    comment = db.query(models.Comment).filter(models.Comment.id == id).first()
+    comment = db.query(models.Comment).options(*loaders.COMMENT).filter(models.Comment.id == id).first()
     if not comment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"comment {id} doesn't exist")
     
     # Retrieve ticket
-    ticket = db.query(models.Ticket).filter(models.Ticket.id == comment.ticket_id).first()
+    ticket = db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.id == comment.ticket_id).first()
 
     result = {"comment": comment, "ticket": ticket}
     return result
 
 # Edit Comment
 @router.put("/{id}", status_code=status.HTTP_205_RESET_CONTENT, response_model=schemas.CommentResponse)
-def edit_comment(id: str, user_request: schemas.RequestCommentUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+@session_route
+def edit_comment(id: int, user_request: schemas.RequestCommentUpdate, response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # ===================================================================================================================================
     # CHECKING THE POSSIBILY OF UPDATE
     # ===================================================================================================================================
-    # Checking if the comment exists by fetching it from the DB
-    comment_q = db.query(models.Comment).filter(models.Comment.id == id)
-    comment = comment_q.first()
+    # Checking if the comment exists by fetching it from the DB; the row stays locked until commit so concurrent edits are applied one after another
+    comment_q = db.query(models.Comment).options(*loaders.COMMENT).filter(models.Comment.id == id)
+    comment = comment_q.with_for_update(of=models.Comment).first()
     if not comment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Comment {id} doesn't exist")
    
@@ -63,15 +84,24 @@ def edit_comment(id: str, user_request: schemas.RequestCommentUpdate, db: Sessio
     # Updating comment_data with user_request data
     updated_data = {key: user_request.get(key, comment_data[key]) for key in comment_data.keys()}
 
-    # Commit changes in the DB
-    comment_q.update(updated_data, synchronize_session=False)   
+    # Nothing to change: no UPDATE, no history row; ending the read-only transaction releases the lock
+    if updated_data == comment_data:
+        db.commit()
+        response.headers['X-Unchanged'] = 'true'
+        return comment
+
+    # Updating the row; RETURNING refreshes the loaded comment in the same round trip
+    update_returning(db, comment, updated_data)
+    versioning.bump(db, models.Ticket, [comment.ticket_id])
+    detail_cache.invalidate(db, f'comment:{id}', f'ticket:{comment.ticket_id}')
     db.commit()
     # ===================================================================================================================================
 
-    return comment_q.first()
+    return comment
 
 # Delete Comment
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def delete_ticket(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # Checking if the ticket exists
@@ -86,5 +116,7 @@ def delete_ticket(id: int, db: Session = Depends(get_db), current_user: models.U
 
     # Deleting the comment from db
     comment_q.delete(synchronize_session=False)
+    versioning.bump(db, models.Ticket, [comment.ticket_id])
+    detail_cache.invalidate(db, f'comment:{id}', f'ticket:{comment.ticket_id}')
     db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
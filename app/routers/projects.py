@@ -1,22 +1,31 @@
-from fastapi import status, HTTPException, Response, Depends, APIRouter
+from fastapi import status, HTTPException, Request, Response, Depends, APIRouter, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from .. import models, schemas, oauth2
-from ..database import get_db
+from sqlalchemy import and_, delete
+from sqlalchemy.dialects.postgresql import insert
+from .. import models, schemas, oauth2, pagination, projection, serializers, loaders, versioning, history, search as search_engine
+from ..database import get_db, session_route, update_returning, any_of
+from ..response_cache import detail_cache
 from ..config import CHANGABLE_PROJECT_ENTRIES
-from typing import List, Optional
+from typing import List, Literal, Optional
+from datetime import datetime
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix="/projects",
-    tags=["Projects"]
+    tags=["Projects"],
+    route_class=TimedRoute
 )
 
 # Get all Projects
 @router.get('/', response_model=List[schemas.ProjectResponse])
+@session_route
 def get_projects(db: Session = Depends(get_db), 
-                limit: Optional[int] = 10,
+                limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                cursor: Optional[str] = None,
                 search: Optional[str] = "",
                 status: Optional[str] = "",
+                fields: Optional[str] = "",
+                view: Literal['full', 'compact'] = 'full',
                 ):
 
     projects = db.query(models.Project)
@@ -25,42 +34,95 @@ def get_projects(db: Session = Depends(get_db),
     if status != '':
         projects = projects.filter(models.Project.status == status)
 
+    # Oldest first (best matches first when searching); the cursor of the next page is sent in the X-Next-Cursor header
+    keys = [(models.Project.created_at, False), (models.Project.id, False)]
+    row_keys = None
+
+    # Sparse fieldset/compact view: selecting only the needed columns instead of projects with nested creators
+    projected = fields != '' or view == 'compact'
+    if projected:
+        names = projection.columns(models.Project, schemas.ProjectResponse, fields, view, ['creator_id'])
+        projects = projection.select_columns(projects, models.Project, names, keys)
+    else:
+        # Full view: rows shaped like the response schema straight from SQL, nested objects joined in
+        projects = serializers.PROJECT.select(projects)
+
     # Search
     if search != '':
-        projects_by_descr = projects.filter(func.lower(models.Project.description).contains(search.lower())).limit(limit).all()
-        projects_by_name = projects.filter(func.lower(models.Project.name).contains(search.lower())).limit(limit).all()
+        # Full-text search over the indexed name/description vector; name matches weigh more
+        query = search_engine.ts_query(search)
+        rank = search_engine.rank(models.Project, query)
 
-        result = list(set(projects_by_descr + projects_by_name))
+        projects = projects.add_columns(rank.label('rank')).filter(search_engine.match(models.Project, query))
+        keys = [(rank, True)] + keys
+        row_keys = lambda row: [row.rank, row.created_at, row.id]
 
-        return result
+    projects, next_cursor = pagination.paginate(projects, keys, limit, cursor, row_keys)
 
+    if projected:
+        items = projection.as_dicts(projects, models.Project, schemas.ProjectResponse, names)
+        if view == 'compact':
+            side_loaded = projection.side_load(db, user_ids={row.creator_id for row in projects})
+            return projection.respond({"items": items, **side_loaded}, next_cursor)
+        return projection.respond(items, next_cursor)
 
-    return projects.limit(limit).all()
+    return projection.respond(serializers.PROJECT.dicts(projects), next_cursor)
 
 # Get one Project
 @router.get("/{id}", response_model=schemas.ProjectOut)
-def select_project(id: int, db: Session = Depends(get_db)):
+@detail_cache.cached('projects', schemas.ProjectOut)
+@session_route
+def select_project(id: int,
+                   request: Request,
+                   response: Response,
+                   db: Session = Depends(get_db),
+                   include: Optional[str] = "",
+                   limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                   cursor: Optional[str] = None):
+
+    # Sub-collections to return; each one is paginated separately
+    include = pagination.included(include, ['tickets', 'personnel', 'update_history'], cursor)
+
+    # Answering a poll of an unchanged project after looking up its version only
+    if request.headers.get('if-none-match'):
+        version = db.query(models.Project.version).filter(models.Project.id == id).scalar()
+        if version is not None and versioning.matches(request, versioning.etag(request, version)):
+            return versioning.not_modified(versioning.etag(request, version))
 
     # Retrieving project
-    project = db.query(models.Project).filter(models.Project.id == id).first()
+    project = db.query(models.Project).options(*loaders.PROJECT).filter(models.Project.id == id).first()
 
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"project {id} doesn't exist")
 
-    # Retrieving all the tickets connected to the project
-    tickets = db.query(models.Ticket).filter(models.Ticket.project_id == id).all()
+    # Sub-collections are read after the version, so they are never older than the ETag says
+    response.headers['ETag'] = versioning.etag(request, project.version)
+    result = {"project": project, "next_cursors": {}}
+
+    # Retrieving the tickets connected to the project
+    if 'tickets' in include:
+        tickets = db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.project_id == id)
+        keys = [(models.Ticket.created_at, False), (models.Ticket.id, False)]
+        result["tickets"], result["next_cursors"]["tickets"] = pagination.paginate(tickets, keys, limit, cursor)
 
-    # Retrieving all the users connected to the project
-    personnel = db.query(models.User).join(models.Personnel, models.Personnel.user_id == models.User.id).filter(models.Personnel.project_id == id).all()
+    # Retrieving the users connected to the project
+    if 'personnel' in include:
+        personnel = db.query(models.User).join(models.Personnel, models.Personnel.user_id == models.User.id).filter(models.Personnel.project_id == id)
+        keys = [(models.User.id, False)]
+        result["personnel"], result["next_cursors"]["personnel"] = pagination.paginate(personnel, keys, limit, cursor)
 
     # Retrieving update history
-    update_history = db.query(models.ProjectUpdateHistory).filter(models.ProjectUpdateHistory.project_id == id).all()
+    if 'update_history' in include:
+        update_history = db.query(models.ProjectUpdateHistory).options(*loaders.PROJECT_UPDATE).filter(models.ProjectUpdateHistory.project_id == id)
+        keys = [(models.ProjectUpdateHistory.updated_at, False), (models.ProjectUpdateHistory.id, False)]
+        update_history, result["next_cursors"]["update_history"] = pagination.paginate(update_history, keys, limit, cursor)
+        result["update_history"] = history.rebuild(db, models.ProjectUpdateHistory, id, update_history)
 
-    result = {"project": project, "tickets": tickets, "personnel": personnel, "update_history": update_history}
     return result
 
 # Create a new Project
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.ProjectResponse)
+@session_route
 def new_project(project_info: schemas.RequestProject, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     project = models.Project(creator_id=current_user.id, **project_info.dict())
@@ -72,19 +134,22 @@ def new_project(project_info: schemas.RequestProject, db: Session = Depends(get_
     db.add(personnel)
     db.commit()
     db.refresh(personnel)
+    # The creator's page lists the projects they are assigned to
+    detail_cache.invalidate(db, f'user:{current_user.id}')
 
-    return project
+    return db.query(models.Project).options(*loaders.PROJECT).filter(models.Project.id == project.id).first()
 
 # Edit Project
 @router.put("/{id}", status_code=status.HTTP_205_RESET_CONTENT, response_model=schemas.ProjectResponse)
-def edit_project(id: str, user_request: schemas.RequestProjectUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+@session_route
+def edit_project(id: int, user_request: schemas.RequestProjectUpdate, response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # ===================================================================================================================================
     # CHECKING THE POSSIBILY OF UPDATE
     # ===================================================================================================================================
-    # Checking if the project exists by fetching it from the DB
-    project_q = db.query(models.Project).filter(models.Project.id == id)
-    project = project_q.first()
+    # Checking if the project exists by fetching it from the DB; the row stays locked until commit so concurrent edits can't log inconsistent history
+    project_q = db.query(models.Project).options(*loaders.PROJECT).filter(models.Project.id == id)
+    project = project_q.with_for_update(of=models.Project).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Project {id} doesn't exist")
    
@@ -106,31 +171,33 @@ def edit_project(id: str, user_request: schemas.RequestProjectUpdate, db: Sessio
     # Updating project_data with user_request data
     updated_data = {key: user_request.get(key, project_data[key]) for key in project_data.keys()}
 
-    # Commit changes in the DB
-    project_q.update(updated_data, synchronize_session=False)   
-    db.commit()
+    # Nothing to change: no UPDATE, no history row; ending the read-only transaction releases the lock
+    if updated_data == project_data:
+        db.commit()
+        response.headers['X-Unchanged'] = 'true'
+        return project
+
+    # Updating the row; RETURNING refreshes the loaded project in the same round trip
+    update_returning(db, project, {**updated_data, 'version': models.Project.version + 1})
+    detail_cache.invalidate(db, f'project:{id}', 'projects')
     # ===================================================================================================================================
 
     # ===================================================================================================================================
     # SAVING CHANGES IN THE ProjectUpdateHistory
     # ===================================================================================================================================
-    # Updating naming so dictionaries can be properly unpacked into the ProjectUpdateHistory object
-    entries_old = [f"old_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    project_data = dict(zip(entries_old, list(project_data.values())))
-    entries_new = [f"new_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    updated_data = dict(zip(entries_new, list(updated_data.values())))
-    
-    # Creating a new ProjectUpdateHistory entry
-    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, **project_data, **updated_data, personnel_change = '')
+    # Creating a new ProjectUpdateHistory entry holding the changed fields only
+    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, changes = history.diff(project_data, updated_data), personnel_change = '')
     db.add(history_update)
+
+    # Update and history are committed together
     db.commit()
-    db.refresh(history_update)
     # ===================================================================================================================================
 
-    return project_q.first()
+    return project
 
 # Delete Project
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def delete_project(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # Checking if the project exists
@@ -145,11 +212,13 @@ def delete_project(id: int, db: Session = Depends(get_db), current_user: models.
 
     project_q.delete(synchronize_session=False)
     db.commit()
+    detail_cache.invalidate(db, f'project:{id}', 'projects')
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # Create a new Ticket 
 @router.post("/{id}/newticket", status_code=status.HTTP_201_CREATED, response_model=schemas.TicketResponse)
+@session_route
 def new_ticket(id: int, ticket_info: schemas.RequestTicket, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # Check if project exists
@@ -159,15 +228,18 @@ def new_ticket(id: int, ticket_info: schemas.RequestTicket, db: Session = Depend
 
     ticket = models.Ticket(creator_id=current_user.id, project_id=id, **ticket_info.dict())
     db.add(ticket)
+    versioning.bump(db, models.Project, [id])
+    detail_cache.invalidate(db, f'project:{id}', f'user:{current_user.id}')
     db.commit()
     db.refresh(ticket)
 
-    return ticket
+    return db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.id == ticket.id).first()
 
 # PERSONNEL
 # Assign personnel
 """It's probably possible to use URL encoding to fetch user ids instead"""
 @router.post("/{id}/addpersonnel", status_code=status.HTTP_201_CREATED)
+@session_route
 def assign_user(id: int, users: schemas.RequestAssignedUsers, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     
     # ===================================================================================================================================
@@ -185,49 +257,50 @@ def assign_user(id: int, users: schemas.RequestAssignedUsers, db: Session = Depe
         if project.creator_id != current_user.id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Users can only assign personnel to their own projects")
 
+    # Duplicate ids would violate the personnel primary key
+    user_ids = list(dict.fromkeys(users.ids))
+
+    # Fetching requested users together with their current assignment to the project
+    connections = db.query(models.User.id, models.Personnel.user_id.label('assigned')) \
+        .outerjoin(models.Personnel, and_(models.Personnel.user_id == models.User.id, models.Personnel.project_id == id)) \
+        .filter(any_of(models.User.id, user_ids)).all()
+    existing_users = {row.id for row in connections}
+    assigned = {row.assigned for row in connections if row.assigned is not None}
+
     # Check if users with the specified IDs exist
-    for user_id in users.ids:
-        target_user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not target_user:
+    for user_id in user_ids:
+        if user_id not in existing_users:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User (ID:{user_id}) doesn't exist")
 
     # Check if connection has already been made
-    for user_id in users.ids:
-        connection = db.query(models.Personnel).filter(models.Personnel.project_id == id, models.Personnel.user_id == user_id).first()
-        if connection:
+    for user_id in user_ids:
+        if user_id in assigned:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{user_id}) is already assigned to the project (ID:{id})')
     # ===================================================================================================================================
 
-    # Add personnel to the project
-    personnel_change_entry = 'a;' # Logging
-    for user_id in users.ids:
-        personnel_change_entry += str(user_id) + ';' # Logging
-        personnel = models.Personnel(user_id=user_id, project_id=id)
-        db.add(personnel)
-        db.commit()
-        db.refresh(personnel)
-    
+    # Add personnel to the project in one statement; ON CONFLICT catches assignments made concurrently since the check above
+    if user_ids:
+        statement = insert(models.Personnel).values([{'user_id': user_id, 'project_id': id} for user_id in user_ids])
+        statement = statement.on_conflict_do_nothing().returning(models.Personnel.user_id)
+        inserted = {row.user_id for row in db.execute(statement)}
+        for user_id in user_ids:
+            if user_id not in inserted:
+                db.rollback()
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{user_id}) is already assigned to the project (ID:{id})')
+
     # ===================================================================================================================================
     # SAVING CHANGES IN THE ProjectUpdateHistory
     # ===================================================================================================================================
-    # Fixing log format
-    personnel_change_entry = personnel_change_entry[:-1]
-
-    # Logging event into project_updates table
-    # Fetching current project data without unchangable keys
-    project_data = {col.name: getattr(project, col.name) for col in project.__table__.columns if col.name in CHANGABLE_PROJECT_ENTRIES}
+    personnel_change_entry = ';'.join(['a'] + [str(user_id) for user_id in user_ids]) # Logging
 
-    # Updating naming so dictionaries can be properly unpacked into the ProjectUpdateHistory object
-    entries_old = [f"old_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    entries_new = [f"new_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    updated_data = dict(zip(entries_new, list(project_data.values())))
-    project_data = dict(zip(entries_old, list(project_data.values())))
-    
-    # Creating a new ProjectUpdateHistory entry
-    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, **project_data, **updated_data, personnel_change = personnel_change_entry)
+    # Logging event into project_updates table; project data is unchanged
+    # Creating a new ProjectUpdateHistory entry; committed together with the personnel rows
+    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, personnel_change = personnel_change_entry)
     db.add(history_update)
+    history.record_personnel(db, 'assign', current_user.id, [(id, user_id) for user_id in user_ids])
+    versioning.bump(db, models.Project, [id])
+    detail_cache.invalidate(db, f'project:{id}', *[f'user:{user_id}' for user_id in user_ids])
     db.commit()
-    db.refresh(history_update)
     # ===================================================================================================================================
 
     return Response(status_code=status.HTTP_201_CREATED)
@@ -235,6 +308,7 @@ def assign_user(id: int, users: schemas.RequestAssignedUsers, db: Session = Depe
 # Remove personnel
 """I can use URL encoding to fetch user ids instead"""
 @router.post("/{id}/removepersonnel", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def assign_user(id: int, users: schemas.RequestAssignedUsers, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     
     # ===================================================================================================================================
@@ -252,50 +326,62 @@ def assign_user(id: int, users: schemas.RequestAssignedUsers, db: Session = Depe
         if project.creator_id != current_user.id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Users can only remove personnel from their own projects")
 
+    # Duplicate ids are removed once
+    user_ids = list(dict.fromkeys(users.ids))
+
+    # Fetching requested users together with their current assignment to the project
+    connections = db.query(models.User.id, models.Personnel.user_id.label('assigned')) \
+        .outerjoin(models.Personnel, and_(models.Personnel.user_id == models.User.id, models.Personnel.project_id == id)) \
+        .filter(any_of(models.User.id, user_ids)).all()
+    existing_users = {row.id for row in connections}
+    assigned = {row.assigned for row in connections if row.assigned is not None}
+
     # Check if users with the specified IDs exist
-    for user_id in users.ids:
-        target_user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not target_user:
+    for user_id in user_ids:
+        if user_id not in existing_users:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User (ID:{user_id}) doesn't exist")
 
     # Check if users were never assigned
-    for user_id in users.ids:
-        connection = db.query(models.Personnel).filter(models.Personnel.project_id == id, models.Personnel.user_id == user_id).first()
-        if not connection:
+    for user_id in user_ids:
+        if user_id not in assigned:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'user (ID:{user_id}) is not assigned to the project (ID:{id})')
     # ===================================================================================================================================
 
-    # Remove personnel from the project
-    personnel_change_entry = 'r;' # Logging
-    for user_id in users.ids:
-        personnel_change_entry += str(user_id) + ';' # Logging
-        personnel_q = db.query(models.Personnel).filter(models.Personnel.user_id == user_id, models.Personnel.project_id == id)
-        personnel_q.delete(synchronize_session=False)
-        db.commit()
+    # Remove personnel from the project in one statement; RETURNING catches removals made concurrently since the check above
+    if user_ids:
+        statement = delete(models.Personnel).where(models.Personnel.project_id == id, any_of(models.Personnel.user_id, user_ids))
+        removed = {row.user_id for row in db.execute(statement.returning(models.Personnel.user_id), execution_options={'synchronize_session': False})}
+        for user_id in user_ids:
+            if user_id not in removed:
+                db.rollback()
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'user (ID:{user_id}) is not assigned to the project (ID:{id})')
 
     # ===================================================================================================================================
     # SAVING CHANGES IN THE ProjectUpdateHistory
     # ===================================================================================================================================
-    # Fixing log format
-    personnel_change_entry = personnel_change_entry[:-1]
+    personnel_change_entry = ';'.join(['r'] + [str(user_id) for user_id in user_ids]) # Logging
 
-    # Logging event into project_updates table
-    # Fetching current project data without unchangable keys
-    project_data = {col.name: getattr(project, col.name) for col in project.__table__.columns if col.name in CHANGABLE_PROJECT_ENTRIES}
-
-    # Updating naming so dictionaries can be properly unpacked into the ProjectUpdateHistory object
-    entries_old = [f"old_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    entries_new = [f"new_{x}" for x in CHANGABLE_PROJECT_ENTRIES]
-    updated_data = dict(zip(entries_new, list(project_data.values())))
-    project_data = dict(zip(entries_old, list(project_data.values())))
-    
-    # Creating a new ProjectUpdateHistory entry
-    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, **project_data, **updated_data, personnel_change = personnel_change_entry)
+    # Logging event into project_updates table; project data is unchanged
+    # Creating a new ProjectUpdateHistory entry; committed together with the removal
+    history_update = models.ProjectUpdateHistory(editor_id = current_user.id, project_id = id, personnel_change = personnel_change_entry)
     db.add(history_update)
+    history.record_personnel(db, 'remove', current_user.id, [(id, user_id) for user_id in user_ids])
+    versioning.bump(db, models.Project, [id])
+    detail_cache.invalidate(db, f'project:{id}', *[f'user:{user_id}' for user_id in user_ids])
     db.commit()
-    db.refresh(history_update)
     # ===================================================================================================================================
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-
+# Assignments to and removals from the project, oldest first
+@router.get("/{id}/personnel-history", response_model=List[schemas.PersonnelEventResponse])
+@session_route
+def get_personnel_history(id: int,
+                          db: Session = Depends(get_db),
+                          limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                          cursor: Optional[str] = None,
+                          action: Optional[Literal['assign', 'remove']] = None,
+                          since: Optional[datetime] = None,
+                          until: Optional[datetime] = None):
+
+    return history.personnel_page(db, models.Project, id, limit, cursor, action, since, until)
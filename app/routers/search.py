@@ -0,0 +1,29 @@
+from fastapi import status, HTTPException, Depends, APIRouter, Query
+from sqlalchemy.orm import Session
+from .. import models, schemas, oauth2, search as search_engine
+from ..database import get_db, session_route
+from typing import List, Optional
+from ..metrics import TimedRoute
+
+router = APIRouter(
+    prefix="/search",
+    tags=["Search"],
+    route_class=TimedRoute
+)
+
+# Search tickets, projects and comments
+@router.get("/", response_model=List[schemas.SearchResult])
+@session_route
+def search(q: str,
+           db: Session = Depends(get_db),
+           current_user: models.User = Depends(oauth2.get_current_user),
+           types: Optional[str] = ",".join(search_engine.SEARCHABLE),
+           limit: int = Query(10, ge=1, le=100)):
+
+    # Comma separated list of entity types
+    types = [kind.strip() for kind in types.split(',') if kind.strip()] or list(search_engine.SEARCHABLE)
+    for kind in types:
+        if kind not in search_engine.SEARCHABLE:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Can't search '{kind}'; available types: {', '.join(search_engine.SEARCHABLE)}")
+
+    return search_engine.search(db, q, types, limit)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from .. import database, oauth2, response_cache
+from ..metrics import TimedRoute
+
+router = APIRouter(
+    prefix="/status",
+    tags=["Status"],
+    route_class=TimedRoute
+)
+
+# Connection pool usage and checkout wait times of this worker
+@router.get("/pool")
+def pool_status():
+    return database.pool_status()
+
+# Hits/misses of this worker's authenticated user cache and detail response cache
+@router.get("/cache")
+def cache_status():
+    return {"users": oauth2.user_cache.stats(), "responses": response_cache.detail_cache.stats()}
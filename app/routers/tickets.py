@@ -1,24 +1,30 @@
-from fastapi import status, HTTPException, Response, Depends, APIRouter
+from fastapi import status, HTTPException, Request, Response, Depends, APIRouter, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from .. import models, schemas, oauth2
-from ..database import get_db
+from .. import models, schemas, oauth2, pagination, projection, serializers, loaders, versioning, history, search as search_engine
+from ..database import get_db, session_route, update_returning
+from ..response_cache import detail_cache
 from ..config import CHANGABLE_TICKET_ENTRIES
-from typing import List, Optional
+from typing import List, Literal, Optional
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix="/tickets",
-    tags=["Tickets"]
+    tags=["Tickets"],
+    route_class=TimedRoute
 )
 
 # Get all Tickets
 @router.get('/', response_model=List[schemas.TicketResponse])
+@session_route
 def get_tickets(db: Session = Depends(get_db), 
-                limit: int = 10, 
+                limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE), 
+                cursor: Optional[str] = None,
                 priority: Optional[int] = '', 
                 category: Optional[str] = '',
                 status: Optional[str] = '', 
-                search: Optional[str] = ''):
+                search: Optional[str] = '',
+                fields: Optional[str] = '',
+                view: Literal['full', 'compact'] = 'full'):
 
     tickets = db.query(models.Ticket)
 
@@ -34,45 +40,96 @@ def get_tickets(db: Session = Depends(get_db),
     if status != '':
         tickets = tickets.filter(models.Ticket.status == status)
 
+    # Oldest first (best matches first when searching); the cursor of the next page is sent in the X-Next-Cursor header
+    keys = [(models.Ticket.created_at, False), (models.Ticket.id, False)]
+    row_keys = None
+
+    # Sparse fieldset/compact view: selecting only the needed columns instead of tickets with nested projects and creators
+    projected = fields != '' or view == 'compact'
+    if projected:
+        names = projection.columns(models.Ticket, schemas.TicketResponse, fields, view, ['project_id', 'creator_id'])
+        tickets = projection.select_columns(tickets, models.Ticket, names, keys)
+    else:
+        # Full view: rows shaped like the response schema straight from SQL, nested objects joined in
+        tickets = serializers.TICKET.select(tickets)
+
     # Search
     if search != '':
-        tickets_by_descr = tickets.filter(func.lower(models.Ticket.description).contains(search.lower())).limit(limit).all()
-        tickets_by_capt = tickets.filter(func.lower(models.Ticket.caption).contains(search.lower())).limit(limit).all()
+        # Full-text search over the indexed caption/description vector; caption matches weigh more
+        query = search_engine.ts_query(search)
+        rank = search_engine.rank(models.Ticket, query)
+
+        tickets = tickets.add_columns(rank.label('rank')).filter(search_engine.match(models.Ticket, query))
+        keys = [(rank, True)] + keys
+        row_keys = lambda row: [row.rank, row.created_at, row.id]
 
-        result = list(set(tickets_by_descr + tickets_by_capt))
+    tickets, next_cursor = pagination.paginate(tickets, keys, limit, cursor, row_keys)
 
-        return result
+    if projected:
+        items = projection.as_dicts(tickets, models.Ticket, schemas.TicketResponse, names)
+        if view == 'compact':
+            side_loaded = projection.side_load(db, {row.project_id for row in tickets}, {row.creator_id for row in tickets})
+            return projection.respond({"items": items, **side_loaded}, next_cursor)
+        return projection.respond(items, next_cursor)
 
-    return tickets.limit(limit).all()
+    return projection.respond(serializers.TICKET.dicts(tickets), next_cursor)
 
 # Get one Ticket
 @router.get("/{id}", response_model=schemas.TicketOut)
-def get_a_ticket(id: int, db: Session = Depends(get_db)):
+@detail_cache.cached('tickets', schemas.TicketOut)
+@session_route
+def get_a_ticket(id: int,
+                 request: Request,
+                 response: Response,
+                 db: Session = Depends(get_db),
+                 include: Optional[str] = "",
+                 limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                 cursor: Optional[str] = None):
+
+    # Sub-collections to return; each one is paginated separately
+    include = pagination.included(include, ['comments', 'update_history'], cursor)
+
+    # Answering a poll of an unchanged ticket after looking up its (and its project's) version only
+    if request.headers.get('if-none-match'):
+        versions = db.query(models.Ticket.version, models.Project.version).join(models.Project, models.Project.id == models.Ticket.project_id).filter(models.Ticket.id == id).first()
+        if versions is not None and versioning.matches(request, versioning.etag(request, *versions)):
+            return versioning.not_modified(versioning.etag(request, *versions))
 
     # Retrieve ticket
-    ticket = db.query(models.Ticket).filter(models.Ticket.id == id).first()
+    ticket = db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.id == id).first()
     if not ticket:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"project {id} doesn't exist")
 
+    # The ticket page shows the ticket's project too
+    response.headers['ETag'] = versioning.etag(request, ticket.version, ticket.project.version)
+    result = {"ticket": ticket, "next_cursors": {}}
+
     # Retrieve comments
-    comments = db.query(models.Comment).filter(models.Comment.ticket_id == id).all()
+    if 'comments' in include:
+        comments = db.query(models.Comment).options(*loaders.COMMENT).filter(models.Comment.ticket_id == id)
+        keys = [(models.Comment.created_at, False), (models.Comment.id, False)]
+        result["comments"], result["next_cursors"]["comments"] = pagination.paginate(comments, keys, limit, cursor)
 
     # Retrieving update history
-    update_history = db.query(models.TicketUpdateHistory).filter(models.TicketUpdateHistory.ticket_id == id).all()
+    if 'update_history' in include:
+        update_history = db.query(models.TicketUpdateHistory).options(*loaders.TICKET_UPDATE).filter(models.TicketUpdateHistory.ticket_id == id)
+        keys = [(models.TicketUpdateHistory.updated_at, False), (models.TicketUpdateHistory.id, False)]
+        update_history, result["next_cursors"]["update_history"] = pagination.paginate(update_history, keys, limit, cursor)
+        result["update_history"] = history.rebuild(db, models.TicketUpdateHistory, id, update_history)
 
-    result = {"ticket": ticket, "comments": comments, "update_history": update_history}
     return result
 
 # Edit Ticket
 @router.put("/{id}", status_code=status.HTTP_205_RESET_CONTENT, response_model=schemas.TicketResponse)
-def edit_ticket(id: str, user_request: schemas.RequestTicketUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+@session_route
+def edit_ticket(id: int, user_request: schemas.RequestTicketUpdate, response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # ===================================================================================================================================
     # CHECKING THE POSSIBILY OF UPDATE
     # ===================================================================================================================================
-    # Checking if the ticket exists by fetching it from the DB
-    ticket_q = db.query(models.Ticket).filter(models.Ticket.id == id)
-    ticket = ticket_q.first()
+    # Checking if the ticket exists by fetching it from the DB; the row stays locked until commit so concurrent edits can't log inconsistent history
+    ticket_q = db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.id == id)
+    ticket = ticket_q.with_for_update(of=models.Ticket).first()
     if not ticket:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Ticket {id} doesn't exist")
    
@@ -94,30 +151,35 @@ def edit_ticket(id: str, user_request: schemas.RequestTicketUpdate, db: Session
     # Updating ticket_data with user_request data
     updated_data = {key: user_request.get(key, ticket_data[key]) for key in ticket_data.keys()}
 
-    # Commit changes in the DB
-    ticket_q.update(updated_data, synchronize_session=False)   
-    db.commit()
+    # Nothing to change: no UPDATE, no history row; ending the read-only transaction releases the lock
+    if updated_data == ticket_data:
+        db.commit()
+        response.headers['X-Unchanged'] = 'true'
+        return ticket
+
+    # Updating the row; RETURNING refreshes the loaded ticket in the same round trip.
+    # The ticket is listed on its project's page too
+    update_returning(db, ticket, {**updated_data, 'version': models.Ticket.version + 1})
+    versioning.bump(db, models.Project, [ticket.project_id])
+    detail_cache.invalidate(db, f'ticket:{id}', f'project:{ticket.project_id}', 'tickets')
     # ===================================================================================================================================
 
     # ===================================================================================================================================
     # SAVING CHANGES IN THE TicketUpdateHistory
     # ===================================================================================================================================
-    #Updating naming so dictionaries can be properly unpacked into the TicketUpdateHistory object
-    entries_old = [f"old_{x}" for x in CHANGABLE_TICKET_ENTRIES]
-    ticket_data = dict(zip(entries_old, list(ticket_data.values())))
-    entries_new = [f"new_{x}" for x in CHANGABLE_TICKET_ENTRIES]
-    updated_data = dict(zip(entries_new, list(updated_data.values())))
-
-    # Creating a new ProjectUpdateHistory entry
-    history_update = models.TicketUpdateHistory(editor_id = current_user.id, ticket_id = id, **ticket_data, **updated_data)
+    # Creating a new TicketUpdateHistory entry holding the changed fields only
+    history_update = models.TicketUpdateHistory(editor_id = current_user.id, ticket_id = id, changes = history.diff(ticket_data, updated_data))
     db.add(history_update)
+
+    # Update and history are committed together
     db.commit()
-    db.refresh(history_update)
     # ===================================================================================================================================
-    return ticket_q.first()
+
+    return ticket
 
 # Delete Ticket
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def delete_ticket(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # Checking if the ticket exists
@@ -132,11 +194,14 @@ def delete_ticket(id: int, db: Session = Depends(get_db), current_user: models.U
     
     # Deleting the ticket from db
     ticket_q.delete(synchronize_session=False)
+    versioning.bump(db, models.Project, [ticket.project_id])
+    detail_cache.invalidate(db, f'ticket:{id}', f'project:{ticket.project_id}', 'tickets')
     db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # Comment a ticket
 @router.post("/{id}/comment", status_code=status.HTTP_201_CREATED, response_model=schemas.CommentResponse)
+@session_route
 def add_comment(id: int, comment_info: schemas.RequestComment, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     
     # Checking if the ticket exists
@@ -148,7 +213,9 @@ def add_comment(id: int, comment_info: schemas.RequestComment, db: Session = Dep
     comment = models.Comment(creator_id=current_user.id, ticket_id=id, **comment_info.dict())
 
     db.add(comment)
+    versioning.bump(db, models.Ticket, [id])
+    detail_cache.invalidate(db, f'ticket:{id}')
     db.commit()
     db.refresh(comment)
 
-    return comment
\ No newline at end of file
+    return db.query(models.Comment).options(*loaders.COMMENT).filter(models.Comment.id == comment.id).first()
\ No newline at end of file
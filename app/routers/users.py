@@ -1,45 +1,83 @@
-from fastapi import status, HTTPException, Depends, APIRouter, Response
+from fastapi import status, HTTPException, Depends, APIRouter, Request, Response, Query
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from .. import models, schemas, oauth2
-from ..database import get_db
+from sqlalchemy import and_, delete, select
+from sqlalchemy.dialects.postgresql import insert
+from .. import models, schemas, oauth2, pagination, projection, serializers, loaders, versioning, history, export
+from ..database import get_db, session_route, any_of, stream
+from ..response_cache import detail_cache
 from ..config import CHANGABLE_USER_ENTRIES
-from typing import List
+from typing import List, Literal, Optional
+from datetime import datetime
+from ..metrics import TimedRoute
 
 router = APIRouter(
     prefix='/users',
-    tags=["Users"]
+    tags=["Users"],
+    route_class=TimedRoute
 )
 
 # Get all users
 @router.get("/", response_model=List[schemas.UserResponse])
-def get_all_users(db: Session = Depends(get_db)):
+@session_route
+def get_all_users(db: Session = Depends(get_db),
+                  limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                  cursor: Optional[str] = None,
+                  format: Literal['json', 'ndjson'] = 'json'):
 
-    users = db.query(models.User).all()
-    return users
+    users = db.query(models.User)
+
+    # Oldest first; the cursor of the next page is sent in the X-Next-Cursor header
+    keys = [(models.User.created_at, False), (models.User.id, False)]
+
+    # Export: every user after the cursor, one JSON object per line, streamed from a server-side cursor (no limit)
+    if format == 'ndjson':
+        return export.ndjson(stream(db, pagination.seek(users, keys, cursor)), schemas.UserResponse)
+
+    # Rows shaped like the response schema straight from SQL
+    users, next_cursor = pagination.paginate(serializers.USER.select(users), keys, limit, cursor)
+    return projection.respond(serializers.USER.dicts(users), next_cursor)
 
 # Get user
 @router.get("/{id}", response_model=schemas.UserOut)
-def get_user(id: int, db: Session = Depends(get_db)):
+@detail_cache.cached('users', schemas.UserOut)
+@session_route
+def get_user(id: int,
+             request: Request,
+             response: Response,
+             db: Session = Depends(get_db),
+             include: Optional[str] = "",
+             limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+             cursor: Optional[str] = None):
+
+    # Sub-collections to return; each one is paginated separately
+    include = pagination.included(include, ['tickets', 'projects'], cursor)
     
     # Retieving the user
     user = db.query(models.User).filter(models.User.id == id).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User {id} doesn't exist")
 
-    # Retrieving all user's tickets
-    tickets = db.query(models.Ticket).filter(models.Ticket.creator_id == id).all()
+    result = {"user": user, "next_cursors": {}}
+
+    # Retrieving user's tickets
+    if 'tickets' in include:
+        tickets = db.query(models.Ticket).options(*loaders.TICKET).filter(models.Ticket.creator_id == id)
+        keys = [(models.Ticket.created_at, False), (models.Ticket.id, False)]
+        result["tickets"], result["next_cursors"]["tickets"] = pagination.paginate(tickets, keys, limit, cursor)
    
-    # Retrieving all user's projects
-    projects = db.query(models.Project).join(models.Personnel, models.Personnel.project_id == models.Project.id).filter(models.Personnel.user_id == id).all()
-    # Retrieving all user's comments
+    # Retrieving user's projects
+    if 'projects' in include:
+        projects = db.query(models.Project).options(*loaders.PROJECT).join(models.Personnel, models.Personnel.project_id == models.Project.id).filter(models.Personnel.user_id == id)
+        keys = [(models.Project.created_at, False), (models.Project.id, False)]
+        result["projects"], result["next_cursors"]["projects"] = pagination.paginate(projects, keys, limit, cursor)
 
-    result = {"user": user, "tickets": tickets, "projects": projects}
     return result
 
 # Edit user profile
 @router.put("/{id}", status_code=status.HTTP_205_RESET_CONTENT, response_model=schemas.UserResponse)
-def edit_user(id: str, user_request: schemas.RequestUserUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
+@session_route
+def edit_user(id: int, user_request: schemas.RequestUserUpdate, response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
 
     # Check if the user exists
     user_q = db.query(models.User).filter(models.User.id == id)
@@ -68,17 +106,27 @@ def edit_user(id: str, user_request: schemas.RequestUserUpdate, db: Session = De
     # Creating a dictionary with the updated data. Writing old data changing only keys mentioned in user_request
     updated_data = {key: user_request.get(key, user_data[key]) for key in user_data.keys()}
 
+    # Nothing to change: no UPDATE
+    if updated_data == user_data:
+        response.headers['X-Unchanged'] = 'true'
+        return user
+
     try:
         user_q.update(updated_data, synchronize_session=False)
         db.commit()
     except IntegrityError:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username or Email already exists")
 
-    return user_q.first()
+    # Access changes apply to the user's next request; users are shown on every cached page
+    oauth2.user_cache.invalidate(id)
+    detail_cache.invalidate(db, 'users')
+
+    return user_q.populate_existing().first()
 
 # Delete user
-"""I have to logoff the user afterwords"""
+# The user's tokens stop working with the next request: get_current_user and /token/refresh reject deleted users
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def delete_user(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     print(current_user.id)
     
@@ -95,14 +143,37 @@ def delete_user(id: int, db: Session = Depends(get_db), current_user: models.Use
         if id != current_user.id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No permissions to delete user (ID:{project_id})")
     
+    # Projects and tickets whose pages show rows going away with the user get new versions in the same transaction
+    versioning.bump_selected(db, models.Project,
+                             select(models.Personnel.project_id).where(models.Personnel.user_id == id),
+                             select(models.Ticket.project_id).where(models.Ticket.creator_id == id),
+                             select(models.ProjectUpdateHistory.project_id).where(models.ProjectUpdateHistory.editor_id == id))
+    versioning.bump_selected(db, models.Ticket,
+                             select(models.Comment.ticket_id).where(models.Comment.creator_id == id),
+                             select(models.TicketUpdateHistory.ticket_id).where(models.TicketUpdateHistory.editor_id == id))
+
     user_q.delete(synchronize_session=False)
     db.commit()
+    oauth2.user_cache.invalidate(id)
+    detail_cache.invalidate(db, 'users')
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+# ProjectUpdateHistory rows logging a personnel change of one user in several projects; project data is unchanged
+def personnel_history(project_ids: list, editor_id: int, personnel_change: str):
+    return [{'editor_id': editor_id, 'project_id': project_id, 'personnel_change': personnel_change} for project_id in project_ids]
+
+# Requested projects with the user's current assignment to each of them, in one query
+def projects_with_assignment(db: Session, user_id: int, project_ids: list):
+    rows = db.query(models.Project, models.Personnel.user_id.label('assigned')) \
+        .outerjoin(models.Personnel, and_(models.Personnel.project_id == models.Project.id, models.Personnel.user_id == user_id)) \
+        .filter(any_of(models.Project.id, project_ids)).all()
+    return {row.Project.id: row for row in rows}
+
 # Assign to one/multiple projects
 """I can use URL encoding to fetch project ids instead"""
 @router.post("/{id}/assign", status_code=status.HTTP_201_CREATED)
+@session_route
 def assign_to_project(id: int, projects: schemas.RequestProjectIds, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     
     # Check if the user exists
@@ -111,31 +182,43 @@ def assign_to_project(id: int, projects: schemas.RequestProjectIds, db: Session
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User (ID: {id}) doesn't exist")
 
+    # Duplicate ids would violate the personnel primary key
+    project_ids = list(dict.fromkeys(projects.ids))
+    found = projects_with_assignment(db, id, project_ids)
+
     # Check if projects with the specified IDs exist
-    for project_id in projects.ids:
-        project = db.query(models.Project).filter(models.Project.id == project_id).first()
-        if not project:
+    for project_id in project_ids:
+        if project_id not in found:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Project (ID:{project_id}) doesn't exist")
 
     # Check if connection has already been made
-    for project_id in projects.ids:
-        connection = db.query(models.Personnel).filter(models.Personnel.project_id == project_id, models.Personnel.user_id == id).first()
-        if connection:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is already assigned to the project (ID:{project.id})')
+    for project_id in project_ids:
+        if found[project_id].assigned is not None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is already assigned to the project (ID:{project_id})')
 
     # CHECK IF THE USER HAS ACCESS
     # Check if the user has admin access
     if current_user.access != 'admin':
         # Check if the user created the projects
-        for project_id in projects.ids:
-            project = db.query(models.Project).filter(models.Project.id == project_id).first()
-            if project.creator_id != current_user.id:
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No permissions to assign to the project (ID:{project_id})")
-
-    # Assign the user to projects
-    for project_id in projects.ids:
-        personnel = models.Personnel(user_id=id, project_id=project_id)
-        db.add(personnel)
+        for project_id in project_ids:
+            if found[project_id].Project.creator_id != current_user.id:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"No permissions to assign to the project (ID:{project_id})")
+
+    # Assign the user to projects in one statement; ON CONFLICT catches assignments made concurrently since the check above
+    if project_ids:
+        statement = insert(models.Personnel).values([{'user_id': id, 'project_id': project_id} for project_id in project_ids])
+        statement = statement.on_conflict_do_nothing().returning(models.Personnel.project_id)
+        inserted = {row.project_id for row in db.execute(statement)}
+        for project_id in project_ids:
+            if project_id not in inserted:
+                db.rollback()
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is already assigned to the project (ID:{project_id})')
+
+        # Logging the change in every project's update history and personnel events; committed together with the personnel rows
+        db.execute(insert(models.ProjectUpdateHistory), personnel_history(project_ids, current_user.id, f'a;{id}'))
+        history.record_personnel(db, 'assign', current_user.id, [(project_id, id) for project_id in project_ids])
+        versioning.bump(db, models.Project, project_ids)
+        detail_cache.invalidate(db, f'user:{id}', *[f'project:{project_id}' for project_id in project_ids])
         db.commit()
 
     return Response(status_code=status.HTTP_201_CREATED)
@@ -143,6 +226,7 @@ def assign_to_project(id: int, projects: schemas.RequestProjectIds, db: Session
 # Remove from one/multiple projects
 """I can use URL encoding to fetch project ids instead"""
 @router.post("/{id}/remove", status_code=status.HTTP_204_NO_CONTENT)
+@session_route
 def remove_from_projects(id: int, projects: schemas.RequestProjectIds, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
     
     # Check if the user exists
@@ -151,32 +235,54 @@ def remove_from_projects(id: int, projects: schemas.RequestProjectIds, db: Sessi
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User (ID: {id}) doesn't exist")
 
+    project_ids = list(dict.fromkeys(projects.ids))
+    found = projects_with_assignment(db, id, project_ids)
+
     # Check if projects with the specified IDs exist
-    for project_id in projects.ids:
-        project = db.query(models.Project).filter(models.Project.id == project_id).first()
-        if not project:
+    for project_id in project_ids:
+        if project_id not in found:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Project (ID:{project_id}) doesn't exist")
 
     # Check if connection has already been made
-    for project_id in projects.ids:
-        connection = db.query(models.Personnel).filter(models.Personnel.project_id == project_id, models.Personnel.user_id == id).first()
-        if not connection:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is not assigned to the project (ID:{project.id})')
+    for project_id in project_ids:
+        if found[project_id].assigned is None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is not assigned to the project (ID:{project_id})')
 
     # CHECK IF THE USER HAS ACCESS
     # Check if the user has admin access
     if current_user.access != 'admin':
         # Check if the user created the projects
-        for project_id in projects.ids:
-            project = db.query(models.Project).filter(models.Project.id == project_id).first()
-            if project.creator_id != current_user.id:
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No permissions to remove from the project (ID:{project_id})")
-
-    # Remove the user from projects
-    for project_id in projects.ids:
-        personnel_q = db.query(models.Personnel).filter(models.Personnel.user_id == id, models.Personnel.project_id == project_id)
-        personnel_q.delete(synchronize_session=False)
+        for project_id in project_ids:
+            if found[project_id].Project.creator_id != current_user.id:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"No permissions to remove from the project (ID:{project_id})")
+
+    # Remove the user from projects in one statement
+    if project_ids:
+        statement = delete(models.Personnel).where(models.Personnel.user_id == id, any_of(models.Personnel.project_id, project_ids))
+        removed = {row.project_id for row in db.execute(statement.returning(models.Personnel.project_id), execution_options={'synchronize_session': False})}
+        for project_id in project_ids:
+            if project_id not in removed:
+                db.rollback()
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'user (ID:{id}) is not assigned to the project (ID:{project_id})')
+
+        # Logging the change in every project's update history and personnel events; committed together with the removal
+        db.execute(insert(models.ProjectUpdateHistory), personnel_history(project_ids, current_user.id, f'r;{id}'))
+        history.record_personnel(db, 'remove', current_user.id, [(project_id, id) for project_id in project_ids])
+        versioning.bump(db, models.Project, project_ids)
+        detail_cache.invalidate(db, f'user:{id}', *[f'project:{project_id}' for project_id in project_ids])
         db.commit()
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+# User's assignments to and removals from projects, oldest first; ?action=assign&since=... lists the projects they joined since then
+@router.get("/{id}/personnel-history", response_model=List[schemas.PersonnelEventResponse])
+@session_route
+def get_personnel_history(id: int,
+                          db: Session = Depends(get_db),
+                          limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+                          cursor: Optional[str] = None,
+                          action: Optional[Literal['assign', 'remove']] = None,
+                          since: Optional[datetime] = None,
+                          until: Optional[datetime] = None):
+
+    return history.personnel_page(db, models.User, id, limit, cursor, action, since, until)
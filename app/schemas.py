@@ -1,7 +1,7 @@
 # Pydantic schemas for defining the structure of ... 
 from pydantic import BaseModel, validator, EmailStr
 from datetime import date, datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 # REQUESTS
 class RequestUserBase(BaseModel):
@@ -108,6 +108,17 @@ class TicketResponse(BaseModel):
     class Config:
         orm_mode = True
 
+class PersonnelEventResponse(BaseModel):
+    id: int
+    project_id: int
+    user_id: int
+    action: str
+    editor_id: int
+    at: datetime
+
+    class Config:
+        orm_mode = True
+
 class CommentResponse(BaseModel):
     id: int
     body_text: str
@@ -164,27 +175,31 @@ class TicketUpdateHistoryResponse(BaseModel):
     class Config:
         orm_mode = True
 
+# Collections that weren't included are null; next_cursors maps each included collection to the cursor of its next page
 class ProjectOut(BaseModel):
     project: ProjectResponse
-    tickets: List[TicketResponse]
-    personnel: List[UserResponse]
-    update_history: List[ProjectUpdateHistoryResponse]
+    tickets: Optional[List[TicketResponse]] = None
+    personnel: Optional[List[UserResponse]] = None
+    update_history: Optional[List[ProjectUpdateHistoryResponse]] = None
+    next_cursors: Dict[str, Optional[str]] = {}
 
     class Config:
         orm_mode = True
 
 class UserOut(BaseModel):
     user: UserResponse
-    tickets: List[TicketResponse]
-    projects: List[ProjectResponse]
+    tickets: Optional[List[TicketResponse]] = None
+    projects: Optional[List[ProjectResponse]] = None
+    next_cursors: Dict[str, Optional[str]] = {}
 
     class Config:
         orm_mode = True
 
 class TicketOut(BaseModel):
     ticket: TicketResponse
-    comments: List[CommentResponse]
-    update_history: List[TicketUpdateHistoryResponse]
+    comments: Optional[List[CommentResponse]] = None
+    update_history: Optional[List[TicketUpdateHistoryResponse]] = None
+    next_cursors: Dict[str, Optional[str]] = {}
 
     class Config:
         orm_mode = True
@@ -196,6 +211,12 @@ class CommentOut(BaseModel):
     class Config:
         orm_mode = True
 
+class SearchResult(BaseModel):
+    type: str
+    id: int
+    rank: float
+    headline: str
+
 # Authentication
 class UserLogin(BaseModel):
     email: EmailStr
@@ -204,6 +225,14 @@ class UserLogin(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
 
 class TokenData(BaseModel):
     id: Optional[int] = None
+    jti: Optional[str] = None
+
+class RequestTokenRefresh(BaseModel):
+    refresh_token: str
+
+class RequestLogout(BaseModel):
+    refresh_token: Optional[str] = None
@@ -0,0 +1,67 @@
+# FULL-TEXT SEARCH
+# Backed by the generated search_vector columns and their GIN indexes (see models.search_vector)
+import re
+from sqlalchemy import func, select, literal, literal_column, union_all, cast, desc
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from . import models
+from .config import SEARCH_CONFIG
+
+# Searchable entities and the text shown in highlights
+SEARCHABLE = {
+    'tickets': (models.Ticket, models.Ticket.caption + ' ' + models.Ticket.description),
+    'projects': (models.Project, models.Project.name + ' ' + models.Project.description),
+    'comments': (models.Comment, models.Comment.body_text),
+}
+
+# Typed constant; drivers with server-side parameters (asyncpg) won't cast a varchar parameter to regconfig
+CONFIG = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+
+HEADLINE_OPTIONS = 'StartSel=<b>, StopSel=</b>, MaxFragments=2, MaxWords=20, MinWords=5'
+
+# Headlines are HTML: the stored text is escaped before the <b> markers are added, so only they are markup
+def escape_html(document):
+    for char, entity in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;')):
+        document = func.replace(document, char, entity)
+    return document
+
+# Turns user input into a to_tsquery() expression; every word is treated as a prefix so that results update while typing
+def parse(text: str):
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    return ' & '.join(f'{word}:*' for word in words)
+
+def ts_query(text: str):
+    return func.to_tsquery(CONFIG, parse(text))
+
+def match(model, query):
+    return model.search_vector.op('@@')(query)
+
+# Double precision so the rank survives a round trip through a pagination cursor unchanged
+def rank(model, query):
+    return cast(func.ts_rank(model.search_vector, query), DOUBLE_PRECISION)
+
+# Best matches across the requested entity types, with highlighted fragments
+def search(db, text: str, types: list, limit: int):
+    if parse(text) is None:
+        return []
+
+    query = ts_query(text)
+    parts = []
+    for kind in types:
+        model, document = SEARCHABLE[kind]
+
+        # Ranking first and highlighting only the top rows; ts_headline is much more expensive than the index lookup
+        ranked = select(model.id.label('id'), rank(model, query).label('rank')).where(match(model, query))
+        ranked = ranked.order_by(desc('rank'), model.id).limit(limit).subquery()
+
+        headline = func.ts_headline(CONFIG, escape_html(document), query, HEADLINE_OPTIONS)
+        parts.append(
+            select(literal(kind).label('type'), ranked.c.id, ranked.c.rank, headline.label('headline'))
+            .join_from(ranked, model, model.id == ranked.c.id)
+        )
+
+    hits = union_all(*parts).subquery()
+    statement = select(hits).order_by(hits.c.rank.desc(), hits.c.type, hits.c.id).limit(limit)
+
+    return [dict(row._mapping) for row in db.execute(statement)]
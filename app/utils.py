@@ -1,11 +1,69 @@
 # PASSWORD HASHING/VERIFYING
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from .config import settings
 
-# Setting bcrypt as hashing algorithm
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Setting bcrypt as hashing algorithm; hashes with a different cost are replaced on the next login (see verify_and_update)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
 
 def hash(pwd: str):
     return pwd_context.hash(pwd)
 
 def verify(plain_pwd, hashed_pwd):
     return pwd_context.verify(plain_pwd, hashed_pwd)
+
+# (valid, new hash or None); a new hash is returned when the stored one needs_update(), e.g. after BCRYPT_ROUNDS changed
+def verify_and_update(plain_pwd, hashed_pwd):
+    return pwd_context.verify_and_update(plain_pwd, hashed_pwd)
+
+# Every bcrypt call takes a few hundred ms of CPU. They run in a dedicated process pool instead of the event loop
+# or the threadpool shared with every other endpoint; at most `limit` calls are queued or running, the rest get a 503
+class PasswordPool:
+    def __init__(self, workers: int, limit: int):
+        self.workers = workers
+        self.limit = limit
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def acquire(self):
+        with self.lock:
+            if self.pending >= self.limit:
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def get_executor(self):
+        # Spawned rather than forked: the parent has threads, an event loop and open database connections
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    async def run(self, fn, *args):
+        if not self.acquire():
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins/signups in progress, try again later",
+                                headers={'Retry-After': '1'})
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), fn, *args)
+        finally:
+            self.release()
+
+password_pool = PasswordPool(settings.password_workers, settings.password_queue_size)
+
+# Same cost as a real login of an existing user; the dummy hash is made once, with the current bcrypt cost
+dummy_hash = None
+
+async def verify_unknown(plain_pwd):
+    global dummy_hash
+    if dummy_hash is None:
+        dummy_hash = await password_pool.run(hash, 'dummy password')
+    await password_pool.run(verify, plain_pwd, dummy_hash)
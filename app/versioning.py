@@ -0,0 +1,31 @@
+# VERSION STAMPS AND ETAGS OF DETAIL PAGES
+# Projects and tickets carry a version counter, bumped in the same transaction as every change shown on their
+# detail pages (edits, tickets of a project, comments of a ticket, personnel). The ETag of a detail page is made
+# of those versions and of the query string (?include=, ?cursor=, ... select different representations), so a
+# poll with a matching If-None-Match is answered with 304 after a single indexed lookup.
+# Edits to users shown on the pages (creators' names, ...) don't bump versions; deleting a user does, since the cascade
+# takes their personnel rows, tickets, comments and history entries off other pages
+import hashlib
+from fastapi import Request, Response, status
+from sqlalchemy import update, union
+from .database import any_of
+
+def bump(db, model, ids: list):
+    db.execute(update(model).where(any_of(model.id, ids)).values(version=model.version + 1),
+               execution_options={'synchronize_session': False})
+
+# Like bump(), for the ids any of the SELECTs return; one statement however many there are
+def bump_selected(db, model, *selects):
+    db.execute(update(model).where(model.id.in_(union(*selects))).values(version=model.version + 1),
+               execution_options={'synchronize_session': False})
+
+def etag(request: Request, *versions):
+    digest = hashlib.blake2b(request.url.query.encode(), digest_size=4).hexdigest()
+    return f'W/"{".".join(str(version) for version in versions)}-{digest}"'
+
+def matches(request: Request, tag: str):
+    tags = [value.strip() for value in request.headers.get('if-none-match', '').split(',')]
+    return tag in tags or '*' in tags
+
+def not_modified(tag: str):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': tag})
@@ -0,0 +1,52 @@
+# Serialization cost of one GET /tickets/ page: the ORM + pydantic orm_mode path (still used by detail endpoints)
+# against the row tuple fast path of the list endpoints (app/serializers.py), each encoded with json and orjson.
+# No database is needed: ORM objects and row tuples are built in memory from the same data.
+#
+#   python -m benchmarks.serialization [rows] [repeats]
+import json
+import sys
+import timeit
+from datetime import date, datetime, timezone
+import orjson
+from fastapi.encoders import jsonable_encoder
+from app import models, schemas, serializers
+
+def tickets(count: int):
+    now = datetime.now(timezone.utc)
+    users = [models.User(id=i, username=f'user{i}', email=f'user{i}@email.com', password='hash', name='name',
+                         surname=None, access='user', created_at=now) for i in range(1, 11)]
+    projects = [models.Project(id=i, name=f'project{i}', description='description', start=date(2022, 10, 17), deadline=None,
+                               status='ongoing', created_at=now, creator_id=users[i % 10].id, creator=users[i % 10]) for i in range(1, 6)]
+    return [models.Ticket(id=i, caption=f'ticket{i}', description='description ' * 10, priority=i % 3, category='bug',
+                          status='new', created_at=now, creator_id=users[i % 10].id, creator=users[i % 10],
+                          project_id=projects[i % 5].id, project=projects[i % 5]) for i in range(1, count + 1)]
+
+# The tuple a SELECT of serializer.columns returns for an object; labels are paths like project__creator__id
+def row(serializer, obj):
+    values = []
+    for column in serializer.columns:
+        value = obj
+        for name in column.key.split('__'):
+            value = getattr(value, name)
+        values.append(value)
+    return tuple(values)
+
+def main(count: int = 1000, repeats: int = 20):
+    objects = tickets(count)
+    rows = [row(serializers.TICKET, obj) for obj in objects]
+
+    paths = {
+        'pydantic + json': lambda: json.dumps(jsonable_encoder([schemas.TicketResponse.from_orm(obj) for obj in objects])),
+        'pydantic + orjson': lambda: orjson.dumps(jsonable_encoder([schemas.TicketResponse.from_orm(obj) for obj in objects])),
+        'rows + orjson': lambda: orjson.dumps(serializers.TICKET.dicts(rows)),
+    }
+
+    print(f'{count} tickets, best of {repeats}')
+    baseline = None
+    for name, path in paths.items():
+        best = min(timeit.repeat(path, number=1, repeat=repeats))
+        baseline = baseline or best
+        print(f'  {name:<20} {best * 1000:8.2f} ms  {baseline / best:5.1f}x')
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
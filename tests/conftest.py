@@ -1,36 +1,84 @@
+import os
+# Cheapest bcrypt cost for the hundreds of test signups; read by the app's settings and by the password worker processes
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from app.main import app
 from app.config import settings
 from app.database import get_db, Base
-from app.oauth2 import create_access_token
+from app.oauth2 import create_access_token, user_cache
+from app.revocation import revocations
+from app.response_cache import detail_cache
+from app import metrics
 import pytest
 
 # Setting up testing database
 SQLALCHEMY_DATABASE_URL = f'postgresql+psycopg2://{settings.database_username}:{settings.test_database_password}@{settings.test_database_hostname}:{settings.database_port}/{settings.test_database_name}'
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# Async mode (DATABASE_ASYNC=true) runs the same tests through asyncpg.
+# NullPool: TestClient runs every request in a new event loop, so connections can't be reused
+ASYNC_DATABASE_URL = f'postgresql+asyncpg://{settings.database_username}:{settings.test_database_password}@{settings.test_database_hostname}:{settings.database_port}/{settings.test_database_name}'
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool) if settings.database_async else None
+TestingAsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
+
+# Query timings of requests while metrics are enabled (tests/test_metrics.py)
+metrics.instrument(async_engine.sync_engine if settings.database_async else engine)
 
 # Drop the previous testing DB and create a new one
 @pytest.fixture()
 def session():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    # Ids are reused by every test's fresh tables
+    user_cache.clear()
+    revocations.clear()
+    detail_cache.clear()
     db = TestingSessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+# Collects SQL statements sent to the testing db inside a 'with' block:
+#   with count_queries() as queries: ...
+#   assert len(queries) == 1
+@pytest.fixture
+def count_queries():
+    @contextmanager
+    def counter():
+        queries = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        target = async_engine.sync_engine if settings.database_async else engine
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+    return counter
+
 # Use testing db instead of prod db
 @pytest.fixture()
 def client(session):
-    def override_get_db():
-        try:
-            yield session
-        finally:
-            session.close()
+    if settings.database_async:
+        async def override_get_db():
+            async with TestingAsyncSessionLocal() as db:
+                yield db
+    else:
+        def override_get_db():
+            try:
+                yield session
+            finally:
+                session.close()
     # Overriding get_db with testing db
     app.dependency_overrides[get_db] = override_get_db
 
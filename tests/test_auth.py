@@ -1,7 +1,11 @@
 # Tests should be independable of one another
 
 import pytest
-from app import schemas
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import Session
+from passlib.context import CryptContext
+from app import schemas, models, utils, oauth2
+from app.revocation import BloomFilter, revocations
 from jose import jwt
 from app.config import settings
 
@@ -36,4 +40,164 @@ def test_incorrect_login(client, email, password, status_code):
 
     assert res.status_code == status_code
 
-    
\ No newline at end of file
+    
+# Users are looked up with one query, by email or username
+@pytest.mark.parametrize("login", ['testuser1', 'test@email.com'])
+def test_login_query_count(client, test_user, count_queries, login):
+    with count_queries() as queries:
+        res = client.post("/login", data={"username": login, "password": test_user['password']})
+
+    assert res.status_code == 200
+    assert len(queries) == 1
+
+# An email match is preferred over another user's identical username
+def test_login_email_first(client, test_user):
+    res = client.post("/signup", json={"username": test_user['email'], "email": "other@email.com", "password": "other"})
+    assert res.status_code == 201
+
+    res = client.post("/login", data={"username": test_user['email'], "password": test_user['password']})
+    payload = jwt.decode(res.json()['access_token'], settings.secret_key, algorithms=[settings.algorithm])
+
+    assert str(payload.get("user_id")) == test_user['id']
+
+# Unknown users still cost a password verify
+def test_login_unknown_user_verifies(client, monkeypatch):
+    verified = []
+    async def verify_unknown(plain_pwd):
+        verified.append(plain_pwd)
+    monkeypatch.setattr(utils, 'verify_unknown', verify_unknown)
+
+    res = client.post("/login", data={"username": 'nobody', "password": 'password'})
+
+    assert res.status_code == 403
+    assert verified == ['password']
+
+# Hashes made with another bcrypt cost are replaced on login
+def test_login_rehash(client, session):
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=settings.bcrypt_rounds + 1).hash('password')
+    session.add(models.User(username='legacy', email='legacy@email.com', password=old_hash))
+    session.commit()
+
+    res = client.post("/login", data={"username": 'legacy', "password": 'password'})
+    assert res.status_code == 200
+
+    new_hash = session.query(models.User.password).filter(models.User.username == 'legacy').scalar()
+    assert new_hash != old_hash
+    assert not utils.pwd_context.needs_update(new_hash)
+
+    res = client.post("/login", data={"username": 'legacy', "password": 'password'})
+    assert res.status_code == 200
+
+# Signups/logins beyond the password pool's queue are turned away
+def test_password_pool_saturated(client, monkeypatch):
+    monkeypatch.setattr(utils.password_pool, 'limit', 0)
+    res = client.post("/signup", json={"username": "testuser1", "email": "test@email.com", "password": "password"})
+
+    assert res.status_code == 503
+    assert res.headers['Retry-After'] == '1'
+
+# Refresh tokens are exchanged for new tokens once
+def test_refresh(client, test_user):
+    tokens = client.post("/login", data={"username": test_user['username'], "password": test_user['password']}).json()
+
+    res = client.post("/token/refresh", json={'refresh_token': tokens['refresh_token']})
+    new_tokens = res.json()
+    assert res.status_code == 200
+    assert new_tokens['refresh_token'] != tokens['refresh_token']
+
+    res = client.get("/comments/", headers={"Authorization": f"Bearer {new_tokens['access_token']}"})
+    assert res.status_code == 200
+
+    res = client.post("/token/refresh", json={'refresh_token': tokens['refresh_token']})
+    assert res.status_code == 401
+
+# Access and refresh tokens aren't interchangeable
+def test_token_types(client, test_user):
+    tokens = client.post("/login", data={"username": test_user['username'], "password": test_user['password']}).json()
+
+    assert client.get("/comments/", headers={"Authorization": f"Bearer {tokens['refresh_token']}"}).status_code == 401
+    assert client.post("/token/refresh", json={'refresh_token': tokens['access_token']}).status_code == 401
+
+# Logged out tokens are rejected
+def test_logout(client, test_user):
+    tokens = client.post("/login", data={"username": test_user['username'], "password": test_user['password']}).json()
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    res = client.post("/logout", json={'refresh_token': tokens['refresh_token']}, headers=headers)
+    assert res.status_code == 204
+
+    assert client.get("/comments/", headers=headers).status_code == 401
+    assert client.post("/token/refresh", json={'refresh_token': tokens['refresh_token']}).status_code == 401
+
+# Tokens of deleted users are rejected
+def test_deleted_user_logged_off(authorized_client, test_user):
+    res = authorized_client.delete(f"/users/{test_user['id']}")
+    assert res.status_code == 204
+
+    assert authorized_client.get("/comments/").status_code == 401
+
+# Revocations made by other workers apply after the next sync, without a query per request in between
+def test_revocation_sync(authorized_client, token, session, count_queries):
+    assert authorized_client.get("/comments/").status_code == 200
+
+    claims = oauth2.decode_token(token, 'access', None)
+    session.add(models.RevokedToken(jti=claims['jti'], expires_at=datetime.fromtimestamp(claims['exp'], timezone.utc)))
+    session.commit()
+
+    with count_queries() as queries:
+        assert authorized_client.get("/comments/").status_code == 200
+    assert len(queries) == 1
+
+    revocations.synced_at = None
+    assert authorized_client.get("/comments/").status_code == 401
+
+# A revocation committing after one with a higher id has been synced is still picked up by the next sync
+def test_revocation_sync_out_of_order(session):
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+    late = Session(bind=session.get_bind())
+    try:
+        late.add(models.RevokedToken(jti='late', expires_at=expires_at))
+        late.flush()
+        session.add(models.RevokedToken(jti='early', expires_at=expires_at))
+        session.commit()
+
+        revocations.sync(session)
+        session.commit()
+        assert revocations.might_be_revoked('early')
+        assert not revocations.might_be_revoked('late')
+        late.commit()
+    finally:
+        late.close()
+
+    revocations.synced_at = None
+    revocations.sync(session)
+    session.commit()
+    assert revocations.might_be_revoked('early') and revocations.might_be_revoked('late')
+
+# A rebuilt filter is sized for the unexpired rows, so it isn't rebuilt on every sync once they outnumber the capacity
+def test_revocation_rebuild_capacity(session, monkeypatch):
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+    session.add_all([models.RevokedToken(jti=f'jti{i}', expires_at=expires_at) for i in range(30)])
+    session.commit()
+
+    monkeypatch.setattr(revocations, 'capacity', 10)
+    revocations.clear()
+    revocations.sync(session)
+    assert revocations.count == 30
+
+    revocations.synced_at = None
+    revocations.sync(session)
+    session.commit()
+    assert revocations.bloom_capacity == 60
+    assert revocations.count == 30
+    assert all(revocations.might_be_revoked(f'jti{i}') for i in range(30))
+
+# Bloom filter has no false negatives
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    keys = [f'jti{i}' for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    assert sum(f'other{i}' in bloom for i in range(1000)) < 50
@@ -0,0 +1,220 @@
+# Tests should be independable of one another
+
+import socketserver
+import threading
+import time
+import pytest
+from app import cache, response_cache
+from app.response_cache import detail_cache
+
+# Local stand-in for a Redis server: the commands the redis backend sends, over the same protocol
+class StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                command = response_cache.read(self.rfile)
+            except ConnectionError:
+                return
+            self.wfile.write(self.reply(self.server.run(command)))
+
+    def reply(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, str):
+            return b'+%s\r\n' % value.encode()
+        if isinstance(value, response_cache.RESPError):
+            return b'-%s\r\n' % str(value).encode()
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(self.reply(item) for item in value)
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        return None if expires is not None and expires < time.monotonic() else value
+
+    def run(self, command):
+        name, args = command[0].upper(), command[1:]
+        with self.lock:
+            if name == b'GET':
+                return self.get(args[0])
+            if name == b'MGET':
+                return [self.get(key) for key in args]
+            if name == b'SET':
+                options = [arg.upper() for arg in args[2:]]
+                if b'NX' in options and self.get(args[0]) is not None:
+                    return None
+                expires = time.monotonic() + int(options[options.index(b'EX') + 1]) if b'EX' in options else None
+                self.data[args[0]] = (args[1], expires)
+                return 'OK'
+            if name == b'DEL':
+                return sum(self.data.pop(key, None) is not None for key in args)
+            if name == b'FLUSHDB':
+                self.data.clear()
+                return 'OK'
+            return response_cache.RESPError(f"ERR unknown command '{name.decode()}'")
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'redis://127.0.0.1:{server.server_address[1]}/0'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def redis_cache(stand_in, monkeypatch):
+    monkeypatch.setattr(detail_cache, 'backend', response_cache.RedisBackend(response_cache.RESPClient(stand_in)))
+    return detail_cache
+
+# Least recently used entries are evicted first
+def test_lru_eviction():
+    users = cache.TTLCache(maxsize=2, ttl=60)
+    users.set(1, 'a')
+    users.set(2, 'b')
+    users.get(1)
+    users.set(3, 'c')
+
+    assert users.get(2) is None
+    assert users.get(1) == 'a' and users.get(3) == 'c'
+    assert users.stats()['evictions'] == 1
+
+# Entries expire after ttl seconds
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    users = cache.TTLCache(maxsize=10, ttl=60)
+    users.set(1, 'a')
+
+    now[0] += 59
+    assert users.get(1) == 'a'
+    now[0] += 2
+    assert users.get(1) is None
+    assert users.stats()['size'] == 0
+
+# Invalidated entries and disabled caches miss
+def test_invalidate_and_disabled():
+    users = cache.TTLCache(maxsize=10, ttl=60)
+    users.set(1, 'a')
+    users.invalidate(1)
+    disabled = cache.TTLCache(maxsize=10, ttl=0)
+    disabled.set(1, 'a')
+
+    assert users.get(1) is None and disabled.get(1) is None
+    assert users.stats()['hits'] == 0 and users.stats()['misses'] == 1
+
+# Stored values are kept until they expire; setdefault doesn't replace them
+def test_setdefault(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    entries = cache.TTLCache(maxsize=10, ttl=60)
+
+    assert entries.setdefault(1, 'a', ttl=600) == 'a'
+    assert entries.setdefault(1, 'b') == 'a'
+    now[0] += 120
+    assert entries.get(1) == 'a'
+    now[0] += 600
+    assert entries.setdefault(1, 'b') == 'b'
+
+# Commands and pipelines of the redis backend; error replies raise and leave the connection usable
+def test_resp_client(stand_in):
+    backend = response_cache.RedisBackend(response_cache.RESPClient(stand_in))
+    backend.set('a', b'1\n\r\n2', 60)
+
+    assert backend.get('a') == b'1\n\r\n2'
+    assert backend.get_many(['a', 'b']) == [b'1\n\r\n2', None]
+    assert backend.setdefault_many({'a': 'x', 'b': 'y'}, 60) == [b'1\n\r\n2', b'y']
+    with pytest.raises(response_cache.RESPError):
+        backend.client.execute(('PING',))
+    backend.delete(['a', 'b'])
+    assert backend.get_many(['a', 'b']) == [None, None]
+    assert backend.client.idle.qsize() == 1
+
+# Repeated reads are served without the database; polls with the cached ETag get a 304
+def test_detail_hits(client, dummy_tickets, count_queries):
+    first = client.get("/tickets/1?include=comments")
+    before = detail_cache.stats()['endpoints']['tickets']
+
+    with count_queries() as queries:
+        second = client.get("/tickets/1?include=comments")
+        polled = client.get("/tickets/1?include=comments", headers={'If-None-Match': first.headers['ETag']})
+
+    assert queries == []
+    assert second.status_code == 200 and second.json() == first.json()
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert polled.status_code == 304
+
+    after = detail_cache.stats()['endpoints']['tickets']
+    assert after['hits'] - before['hits'] == 2 and after['misses'] == before['misses']
+
+# Changes drop the cached pages showing them
+def test_detail_invalidation(authorized_client, dummy_comments, dummy_users):
+    pages = ["/projects/1?include=tickets,personnel", "/tickets/1?include=comments", "/comments/1", "/users/1?include=projects,tickets"]
+    for page in pages:
+        authorized_client.get(page)
+
+    authorized_client.put("/projects/1", json={'name': 'renamed'})
+    authorized_client.put("/tickets/1", json={'caption': 'recaptioned'})
+    authorized_client.put("/comments/1", json={'body_text': 'rewritten'})
+    authorized_client.post("/projects/1/addpersonnel", json={'ids': [dummy_users[0]['id']]})
+    authorized_client.put("/users/1", json={'name': 'renamed user'})
+
+    project, ticket, comment, user = [authorized_client.get(page).json() for page in pages]
+    assert project['project']['name'] == 'renamed' and project['tickets'][0]['caption'] == 'recaptioned'
+    assert len(project['personnel']) == 2 and project['project']['creator']['name'] == 'renamed user'
+    assert ticket['ticket']['project']['name'] == 'renamed' and ticket['comments'][0]['body_text'] == 'rewritten'
+    assert comment['comment']['body_text'] == 'rewritten' and comment['ticket']['caption'] == 'recaptioned'
+    assert user['user']['name'] == 'renamed user' and user['projects'][0]['name'] == 'renamed'
+
+    authorized_client.delete("/comments/1")
+    assert authorized_client.get("/comments/1").status_code == 404
+    assert authorized_client.get("/tickets/1?include=comments").json()['comments'] == []
+
+# Endpoints switched off always read the database
+def test_endpoint_switch(client, dummy_tickets, count_queries, monkeypatch):
+    monkeypatch.setattr(detail_cache, 'endpoints', {'projects'})
+    client.get("/tickets/1")
+    client.get("/projects/1")
+
+    with count_queries() as queries:
+        client.get("/tickets/1")
+    assert len(queries) > 0
+    with count_queries() as queries:
+        client.get("/projects/1")
+    assert queries == []
+    assert detail_cache.stats()['endpoints']['tickets']['enabled'] is False
+
+# Responses cached in a Redis-protocol server
+def test_redis_backend(authorized_client, dummy_tickets, redis_cache, count_queries):
+    first = authorized_client.get("/tickets/1")
+    with count_queries() as queries:
+        assert authorized_client.get("/tickets/1").json() == first.json()
+    assert queries == []
+
+    authorized_client.post("/tickets/1/comment", json={'body_text': 'new'})
+    res = authorized_client.get("/tickets/1?include=comments")
+    assert res.json()['comments'][0]['body_text'] == 'new'
+    assert authorized_client.get("/status/cache").json()['responses']['backend'] == 'redis'
+
+# An unreachable server only costs cache misses
+def test_redis_unavailable(authorized_client, dummy_tickets, monkeypatch):
+    with socketserver.TCPServer(('127.0.0.1', 0), socketserver.BaseRequestHandler) as closed:
+        url = f'redis://127.0.0.1:{closed.server_address[1]}/0'
+    monkeypatch.setattr(detail_cache, 'backend', response_cache.RedisBackend(response_cache.RESPClient(url)))
+    errors = detail_cache.stats()['endpoints']['tickets']['errors']
+
+    assert authorized_client.get("/tickets/1").status_code == 200
+    assert authorized_client.put("/tickets/1", json={'caption': 'edited'}).status_code == 205
+    assert detail_cache.stats()['endpoints']['tickets']['errors'] == errors + 1
+    assert detail_cache.stats()['invalidation_errors'] >= 1
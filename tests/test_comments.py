@@ -1,5 +1,7 @@
 # Tests should be independable of one another
 
+import json
+
 # Get all comments
 def test_get_all(dummy_comments, client):
     res = client.get('/comments/')
@@ -10,6 +12,44 @@ def test_get_all(dummy_comments, client):
     assert comments[0]['creator_id'] == dummy_comments[0]['creator_id']
     assert comments[0]['created_at'] == dummy_comments[0]['created_at']
 
+# Get all comments [paginated]
+def test_get_all_paginated(dummy_comments, client):
+    res = client.get('/comments/?limit=1')
+    cursor = res.headers['X-Next-Cursor']
+
+    assert res.status_code == 200
+    assert res.json()[0]['body_text'] == dummy_comments[0]['body_text']
+
+    res = client.get(f'/comments/?limit={len(dummy_comments)}&cursor={cursor}')
+
+    assert res.status_code == 200
+    assert [comment['body_text'] for comment in res.json()] == [comment['body_text'] for comment in dummy_comments[1:]]
+    assert 'X-Next-Cursor' not in res.headers
+
+# Get all comments [NDJSON export after a cursor]
+def test_get_all_ndjson(dummy_comments, client):
+    cursor = client.get('/comments/?limit=1').headers['X-Next-Cursor']
+    res = client.get(f'/comments/?format=ndjson&cursor={cursor}')
+    comments = [json.loads(line) for line in res.text.splitlines()]
+
+    assert res.status_code == 200
+    assert [comment['body_text'] for comment in comments] == [comment['body_text'] for comment in dummy_comments[1:]]
+    assert comments[0]['creator']['id'] == str(dummy_comments[1]['creator_id'])
+
+# Nested creator objects are loaded with the comments
+def test_query_count(dummy_comments, client, count_queries):
+    # Comments; the current user is cached since the fixture's requests
+    with count_queries() as queries:
+        res = client.get('/comments/')
+    assert res.status_code == 200
+    assert len(queries) == 1
+
+    # Comment, ticket
+    with count_queries() as queries:
+        res = client.get('/comments/1')
+    assert res.status_code == 200
+    assert len(queries) == 2
+
 # Get one comment
 def test_get_one(dummy_comments, client):
     res = client.get('/comments/1')
@@ -36,6 +76,16 @@ def test_edit(dummy_comments, authorized_client):
     assert res.status_code == 205
     assert res.json()['body_text'] == data['body_text']
 
+# Edit comment; same text
+def test_edit_unchanged(dummy_comments, authorized_client, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.put('/comments/1', json={'body_text': dummy_comments[0]['body_text']})
+
+    assert res.status_code == 205
+    assert res.headers['X-Unchanged'] == 'true'
+    assert res.json()['body_text'] == dummy_comments[0]['body_text']
+    assert not any(query.startswith('UPDATE') for query in queries)
+
 # Edit comment; wrong id
 def test_edit_wrong_id(dummy_comments, authorized_client):
     data = {
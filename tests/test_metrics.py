@@ -0,0 +1,49 @@
+# Tests should be independable of one another
+
+import pytest
+from app import metrics
+
+@pytest.fixture
+def metrics_enabled(monkeypatch):
+    monkeypatch.setattr(metrics.collector, 'enabled', True)
+    metrics.collector.clear()
+    yield metrics.collector
+    metrics.collector.clear()
+
+# Without METRICS_ENABLED there's no /metrics and no Server-Timing
+def test_metrics_disabled(client):
+    res = client.get("/metrics")
+    assert res.status_code == 404
+    assert 'Server-Timing' not in res.headers
+
+# Responses tell their database time and query count
+def test_server_timing(authorized_client, dummy_projects, metrics_enabled, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.get("/projects/1")
+    assert res.status_code == 200
+
+    timing = res.headers['Server-Timing']
+    assert f'desc="{len(queries)} queries"' in timing
+    assert 'serialize;dur=' in timing
+    assert 'total;dur=' in timing
+
+# Requests add up per route template, method and status
+def test_metrics(authorized_client, dummy_projects, metrics_enabled):
+    sizes = [len(authorized_client.get(f"/projects/{id}").content) for id in (1, 2)]
+    authorized_client.get("/projects/10")
+    authorized_client.get("/nothing/here")
+
+    res = authorized_client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers['content-type'].startswith('text/plain; version=0.0.4')
+
+    body = res.text
+    ok = 'method="GET",route="/projects/{id}",status="200"'
+    assert f'http_request_duration_seconds_bucket{{{ok},le="+Inf"}} 2' in body
+    assert f'http_request_duration_seconds_count{{{ok}}} 2' in body
+    assert f'http_response_size_bytes_total{{{ok}}} {sum(sizes)}' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/projects/{id}",status="404"} 1' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="other",status="404"} 1' in body
+
+    queries = [line for line in body.splitlines() if line.startswith(f'http_request_db_queries_total{{{ok}}}')]
+    assert len(queries) == 1 and int(queries[0].split()[-1]) > 0
@@ -0,0 +1,18 @@
+# Tests should be independable of one another
+
+from app.database import Base, uncovered_foreign_keys
+from app import models
+
+# Every foreign key has an index starting with its columns
+def test_foreign_keys_indexed():
+    assert uncovered_foreign_keys(Base.metadata) == []
+
+# Check catches FKs that aren't a leading column
+def test_foreign_keys_indexed_check():
+    table = models.Personnel.__table__
+    index = next(index for index in table.indexes if index.name == 'personnel_user_id_idx')
+    table.indexes.remove(index)
+    try:
+        assert uncovered_foreign_keys(Base.metadata) == ['personnel(user_id)']
+    finally:
+        table.indexes.add(index)
@@ -0,0 +1,63 @@
+# Tests should be independable of one another
+
+import csv
+import gzip
+from datetime import datetime, timezone
+from sqlalchemy import text
+from app import models, partitions
+
+def add_updates(session, *times):
+    for updated_at in times:
+        session.add(models.ProjectUpdateHistory(editor_id=1, project_id=1, updated_at=updated_at, personnel_change=''))
+    session.commit()
+
+def tables(session):
+    return session.execute(text("SELECT tableoid::regclass::text FROM project_updates ORDER BY id")).scalars().all()
+
+# History of months without a partition goes to the default partition; creating partitions moves it out
+def test_create_partitions(session, dummy_projects):
+    now = datetime.now(timezone.utc)
+    add_updates(session, datetime(2020, 1, 15, tzinfo=timezone.utc), now)
+    assert tables(session) == ['project_updates_default', 'project_updates_default']
+    session.commit()
+
+    created = partitions.create_partitions(session.get_bind(), 1)
+    assert 'project_updates_y2020m01' in created
+    assert f'ticket_updates_y{now:%Y}m{now:%m}' in created
+    assert partitions.partition_name(models.ProjectUpdateHistory.__table__, partitions.month(now, 1)) in created
+    assert tables(session) == ['project_updates_y2020m01', f'project_updates_y{now:%Y}m{now:%m}']
+    session.commit()
+
+    assert partitions.create_partitions(session.get_bind(), 1) == []
+
+# Old partitions are exported as gzipped CSV and dropped; recent history stays readable
+def test_archive_partitions(session, dummy_projects, authorized_client, tmp_path):
+    add_updates(session, datetime(2020, 1, 15, tzinfo=timezone.utc), datetime.now(timezone.utc))
+    partitions.create_partitions(session.get_bind(), 0)
+
+    archived = partitions.archive_partitions(session.get_bind(), 12, str(tmp_path))
+    assert archived == [str(tmp_path / 'project_updates_y2020m01.csv.gz')]
+    with gzip.open(archived[0], 'rt') as file:
+        rows = list(csv.DictReader(file))
+    assert [(row['id'], row['updated_at'], row['project_id']) for row in rows] == [('1', '2020-01-15 00:00:00+00', '1')]
+    assert not list(tmp_path.glob('*.part'))
+
+    assert len(tables(session)) == 1
+    session.commit()
+    assert session.execute(text("SELECT to_regclass('project_updates_y2020m01')")).scalar() is None
+
+    res = authorized_client.get("/projects/1")
+    assert res.status_code == 200
+    assert len(res.json()['update_history']) == 1
+
+# A partition detached by an archive run that didn't finish is archived by the next one
+def test_archive_detached_partition(session, dummy_projects, tmp_path):
+    add_updates(session, datetime(2020, 1, 15, tzinfo=timezone.utc))
+    partitions.create_partitions(session.get_bind(), 0)
+    session.execute(text("ALTER TABLE project_updates DETACH PARTITION project_updates_y2020m01"))
+    session.commit()
+
+    archived = partitions.archive_partitions(session.get_bind(), 12, str(tmp_path))
+    assert archived == [str(tmp_path / 'project_updates_y2020m01.csv.gz')]
+    session.commit()
+    assert session.execute(text("SELECT to_regclass('project_updates_y2020m01')")).scalar() is None
@@ -1,5 +1,8 @@
 # Tests should be independable of one another
 
+from app import models
+from app.response_cache import detail_cache
+
 # Get all projects
 def test_get_all(client, dummy_projects):
     
@@ -15,6 +18,44 @@ def test_get_all(client, dummy_projects):
     assert new_projects[2]['description'] == dummy_projects[2]['description']
 
 
+# Get all projects [paginated]
+def test_get_all_paginated(client, dummy_projects):
+    res = client.get("/projects/?limit=1")
+    cursor = res.headers['X-Next-Cursor']
+
+    assert res.status_code == 200
+    assert res.json()[0]['name'] == dummy_projects[0]['name']
+
+    res = client.get(f"/projects/?limit=5&cursor={cursor}")
+
+    assert res.status_code == 200
+    assert [project['name'] for project in res.json()] == [dummy_projects[1]['name'], dummy_projects[2]['name']]
+    assert 'X-Next-Cursor' not in res.headers
+
+# Get all projects [sparse fieldset]; values are serialized like in the full view
+def test_get_all_fields(client, dummy_projects):
+    res = client.get("/projects/?fields=id,name,start")
+    projects = res.json()
+
+    assert res.status_code == 200
+    assert projects == [{'id': project['id'], 'name': project['name'], 'start': project['start']} for project in dummy_projects]
+    assert projects[0] == {'id': '1', 'name': 'project1', 'start': 'not set'}
+    assert client.get("/projects/?fields=creator").status_code == 400
+
+# Get all projects [compact view]
+def test_get_all_compact(client, dummy_projects, count_queries):
+    # Projects, their creators
+    with count_queries() as queries:
+        res = client.get("/projects/?view=compact&fields=id,name")
+    body = res.json()
+
+    assert res.status_code == 200
+    assert len(queries) == 2
+    assert body['items'] == [{'id': project['id'], 'name': project['name'], 'creator_id': 1} for project in dummy_projects]
+    assert list(body['users']) == ['1']
+    assert body['users']['1']['id'] == '1'
+    assert 'password' not in body['users']['1']
+
 # Get all projects [filtered]
 def test_get_all_status_filtered(client, dummy_projects):
     res = client.get("/projects?status=finished")
@@ -29,6 +70,18 @@ def test_get_all_search(client, dummy_projects):
     assert res.status_code == 200
     assert len(res.json()) == 2
 
+# Get all projects [search; ranked]
+def test_get_all_search_ranked(client, dummy_projects):
+    res = client.get("/projects?search=weird")
+
+    assert res.status_code == 200
+    assert [project['name'] for project in res.json()] == ['project1']
+
+    res = client.get("/projects?search=project&limit=2")
+
+    assert res.status_code == 200
+    assert [project['name'] for project in res.json()] == ['project1', 'project2']
+
 # Get one project
 def test_get_one(client, dummy_projects):
     
@@ -41,6 +94,92 @@ def test_get_one(client, dummy_projects):
     assert new_project['project']['id'] == dummy_projects[0]['id']
     assert new_project['project']['creator']['id'] == str(new_project['project']['creator_id'])
 
+# Get one project [selected, paginated sub-collections]
+def test_get_one_included(authorized_client, dummy_projects, dummy_users):
+    authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 3, 4]})
+
+    res = authorized_client.get("/projects/1?include=personnel&limit=3")
+    project = res.json()
+    cursor = project['next_cursors']['personnel']
+
+    assert res.status_code == 200
+    assert project['tickets'] is None and project['update_history'] is None
+    assert [user['id'] for user in project['personnel']] == ['1', '2', '3']
+    assert list(project['next_cursors']) == ['personnel']
+
+    res = authorized_client.get(f"/projects/1?include=personnel&limit=3&cursor={cursor}")
+    project = res.json()
+
+    assert [user['id'] for user in project['personnel']] == ['4']
+    assert project['next_cursors'] == {'personnel': None}
+
+# Get one project [unknown collection; cursor for several collections]
+def test_get_one_included_wrong(client, dummy_projects):
+    assert client.get("/projects/1?include=comments").status_code == 400
+    assert client.get("/projects/1?cursor=WzFd").status_code == 400
+
+# Without the response cache, polling an unchanged project costs one query; new tickets and personnel change its ETag
+def test_get_one_etag(authorized_client, dummy_projects, dummy_users, count_queries, monkeypatch):
+    # Version lookups; cached responses are tested in test_cache
+    monkeypatch.setattr(detail_cache, 'endpoints', set())
+    etag = authorized_client.get("/projects/1").headers['ETag']
+
+    with count_queries() as queries:
+        res = authorized_client.get("/projects/1", headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert len(queries) == 1
+
+    authorized_client.post('/projects/1/newticket', json={'caption': 'ticket1', 'description': 'description1', 'priority': 0, 'category': 'bug'})
+    res = authorized_client.get("/projects/1", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    etag = res.headers['ETag']
+
+    authorized_client.post("/users/2/assign", json={'ids': [1]})
+    res = authorized_client.get("/projects/1", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert len(res.json()['personnel']) == 2
+
+# Re-sending current values (dates included) writes nothing and keeps the ETag
+def test_edit_unchanged(authorized_client, dummy_projects, session):
+    etag = authorized_client.get("/projects/3").headers['ETag']
+    res = authorized_client.put("/projects/3", json={'name': 'project3', 'start': '2022-10-17', 'deadline': '2022-11-01'})
+
+    assert res.status_code == 205
+    assert res.headers['X-Unchanged'] == 'true'
+    assert session.query(models.ProjectUpdateHistory).filter(models.ProjectUpdateHistory.project_id == 3).count() == 0
+    assert authorized_client.get("/projects/3", headers={'If-None-Match': etag}).status_code == 304
+
+# Edits and personnel changes are rebuilt into full before/after values, dates as timestamps
+def test_edit_history(authorized_client, dummy_projects, dummy_users, session):
+    authorized_client.put("/projects/3", json={'deadline': '2022-12-01'})
+    authorized_client.post("/projects/3/addpersonnel", json={'ids': [2]})
+    authorized_client.put("/projects/3", json={'name': 'renamed'})
+
+    changes = session.query(models.ProjectUpdateHistory.changes).filter(models.ProjectUpdateHistory.project_id == 3).order_by(models.ProjectUpdateHistory.id).all()
+    assert [row.changes for row in changes] == [{'deadline': ['2022-11-01', '2022-12-01']}, {}, {'name': ['project3', 'renamed']}]
+
+    history = authorized_client.get("/projects/3?include=update_history").json()['update_history']
+    assert [entry['personnel_change'] for entry in history] == ['', 'a;2', '']
+    assert [entry['new_deadline'][:10] for entry in history] == ['2022-12-01'] * 3
+    assert history[0]['old_deadline'][:10] == '2022-11-01' and history[0]['old_start'][:10] == '2022-10-17'
+    assert [(entry['old_name'], entry['new_name']) for entry in history] == [('project3', 'project3'), ('project3', 'project3'), ('project3', 'renamed')]
+
+# Nested creator objects are loaded with the projects
+def test_query_count(authorized_client, dummy_projects, dummy_users, count_queries):
+    authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 3]})
+    authorized_client.post('/projects/1/newticket', json={'caption': 'ticket1', 'description': 'description1', 'priority': 0, 'category': 'bug'})
+
+    with count_queries() as queries:
+        res = authorized_client.get("/projects/")
+    assert res.status_code == 200
+    assert len(queries) == 1
+
+    # Project, tickets, personnel, update history and the values it's rebuilt from
+    with count_queries() as queries:
+        res = authorized_client.get("/projects/1")
+    assert res.status_code == 200
+    assert len(queries) == 5
+
 # Get non-existent project
 def test_get_one_wrong_id(client, dummy_projects):
     
@@ -171,6 +310,40 @@ def test_assign_by_admin(dummy_projects, dummy_users, authorized_client_admin):
     assert project['update_history'][0]['personnel_change'] == 'a;2;3'
     assert res.status_code == 201
 
+# Assigning many users costs the same number of queries as assigning one
+def test_assign_query_count(dummy_projects, dummy_users, authorized_client, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.post("/projects/1/addpersonnel", json={'ids': [2]})
+    assert res.status_code == 201
+    single = len(queries)
+
+    with count_queries() as queries:
+        res = authorized_client.post("/projects/2/addpersonnel", json={'ids': [2, 3, 4]})
+    assert res.status_code == 201
+    assert len(queries) == single
+
+    project = authorized_client.get("/projects/2").json()
+    assert [user['id'] for user in project['personnel']] == ['1', '2', '3', '4']
+    assert project['update_history'][0]['personnel_change'] == 'a;2;3;4'
+
+# Duplicate ids are assigned once
+def test_assign_duplicate_ids(dummy_projects, dummy_users, authorized_client):
+    res = authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 2]})
+    project = authorized_client.get("/projects/1").json()
+
+    assert res.status_code == 201
+    assert len(project['personnel']) == 2
+    assert project['update_history'][0]['personnel_change'] == 'a;2'
+
+# Nothing is assigned when one of the users doesn't exist
+def test_assign_partially_wrong_users(dummy_projects, dummy_users, authorized_client):
+    res = authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 30]})
+    project = authorized_client.get("/projects/1").json()
+
+    assert res.status_code == 404
+    assert len(project['personnel']) == 1
+    assert project['update_history'] == []
+
 # User (id:1) attempts to assign users (id:2, 3) to non-existent project
 def test_assign_wrong_project_id(dummy_projects, dummy_users, authorized_client):
     data = {
@@ -271,6 +444,40 @@ def test_remove_by_admin(dummy_projects, dummy_users, authorized_client_admin):
     assert project['update_history'][1]['personnel_change'] == 'r;2;3'
     assert res.status_code == 204
 
+# Removing many users costs the same number of queries as removing one
+def test_remove_query_count(dummy_projects, dummy_users, authorized_client, count_queries):
+    assert authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 3, 4]}).status_code == 201
+
+    with count_queries() as queries:
+        res = authorized_client.post("/projects/1/removepersonnel", json={'ids': [2]})
+    assert res.status_code == 204
+    single = len(queries)
+
+    with count_queries() as queries:
+        res = authorized_client.post("/projects/1/removepersonnel", json={'ids': [3, 4]})
+    assert res.status_code == 204
+    assert len(queries) == single
+
+    project = authorized_client.get("/projects/1").json()
+    assert [user['id'] for user in project['personnel']] == ['1']
+
+# Duplicate ids are removed and logged once
+def test_remove_duplicate_ids(dummy_projects, dummy_users, authorized_client):
+    assert authorized_client.post("/projects/1/addpersonnel", json={'ids': [2]}).status_code == 201
+
+    res = authorized_client.post("/projects/1/removepersonnel", json={'ids': [3, 3]})
+    assert res.status_code == 404
+
+    res = authorized_client.post("/projects/1/removepersonnel", json={'ids': [2, 2]})
+    assert res.status_code == 204
+
+    project = authorized_client.get("/projects/1").json()
+    assert len(project['personnel']) == 1
+    assert project['update_history'][1]['personnel_change'] == 'r;2'
+
+    events = authorized_client.get("/projects/1/personnel-history?action=remove").json()
+    assert [event['user_id'] for event in events] == [2]
+
 # User (id:1) attempts to remove users (id:2, 3) from non-existent project
 def test_remove_wrong_project_id(dummy_projects, dummy_users, authorized_client):
     data = {
@@ -329,6 +536,26 @@ def test_remove_no_access(dummy_projects, dummy_users, authorized_other_client):
     res = authorized_other_client.post("/projects/1/removepersonnel", json=data)
     assert res.status_code == 403
 
+# Personnel changes of a project are listed in its personnel history, oldest first
+def test_personnel_history(authorized_client, dummy_projects, dummy_users):
+    assert authorized_client.post("/projects/1/addpersonnel", json={'ids': [2, 3]}).status_code == 201
+    assert authorized_client.post("/projects/1/removepersonnel", json={'ids': [3]}).status_code == 204
+
+    res = authorized_client.get("/projects/1/personnel-history")
+    assert res.status_code == 200
+    events = res.json()
+    assert sorted((event['action'], event['user_id']) for event in events[:2]) == [('assign', 2), ('assign', 3)]
+    assert (events[2]['action'], events[2]['user_id']) == ('remove', 3)
+    assert all(event['project_id'] == 1 and event['editor_id'] == 1 for event in events)
+
+    res = authorized_client.get("/projects/1/personnel-history?action=remove")
+    assert [event['user_id'] for event in res.json()] == [3]
+
+# Personnel history of a non-existent project
+def test_personnel_history_wrong_id(authorized_client, dummy_projects):
+    res = authorized_client.get("/projects/10/personnel-history")
+    assert res.status_code == 404
+
 # User (id:2) creates a ticket to project (id:2)
 def test_create_ticket(dummy_projects, authorized_other_client):
     data = {
@@ -0,0 +1,64 @@
+# Tests should be independable of one another
+
+# Search everything
+def test_search(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=descr")
+    hits = res.json()
+
+    assert res.status_code == 200
+    assert len(hits) == 6
+    assert {hit['type'] for hit in hits} == {'tickets', 'projects'}
+    assert all('<b>' in hit['headline'] for hit in hits)
+
+# Search; selected types
+def test_search_types(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=comment2&types=comments")
+    hits = res.json()
+
+    assert res.status_code == 200
+    assert len(hits) == 1
+    assert hits[0]['type'] == 'comments'
+    assert hits[0]['id'] == dummy_comments[1]['id']
+    assert hits[0]['headline'] == '<b>comment2</b>'
+
+# Search; markup in stored text is escaped in headlines
+def test_search_headline_escaped(dummy_projects, authorized_client):
+    data = {'caption': 'xss', 'description': '<script>alert(1)</script> findme & more', 'priority': 0, 'category': 'bug'}
+    assert authorized_client.post('/projects/1/newticket', json=data).status_code == 201
+
+    res = authorized_client.get("/search/?q=findme&types=tickets")
+    hits = res.json()
+
+    assert res.status_code == 200
+    assert len(hits) == 1
+    headline = hits[0]['headline']
+    assert '<' not in headline.replace('<b>', '').replace('</b>', '')
+    assert 'alert(1)&lt;/script&gt; <b>findme</b> &amp; more' in headline
+
+# Search; best match first
+def test_search_ranked(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=ticket1 descr&types=tickets")
+    hits = res.json()
+
+    assert res.status_code == 200
+    assert [hit['id'] for hit in hits] == [1]
+
+# Search; limit
+def test_search_limit(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=descr&limit=2")
+
+    assert res.status_code == 200
+    assert len(res.json()) == 2
+
+# Search; nothing to search for
+def test_search_empty(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=%20!")
+
+    assert res.status_code == 200
+    assert res.json() == []
+
+# Search; unknown type
+def test_search_wrong_type(dummy_comments, authorized_client):
+    res = authorized_client.get("/search/?q=descr&types=files")
+
+    assert res.status_code == 400
@@ -0,0 +1,22 @@
+# Tests should be independable of one another
+
+import orjson
+import pytest
+from fastapi.encoders import jsonable_encoder
+from app import serializers, loaders
+
+# Fast path output is the same as the response schemas'
+@pytest.mark.parametrize("serializer, loader", [
+    (serializers.PROJECT, loaders.PROJECT),
+    (serializers.TICKET, loaders.TICKET),
+    (serializers.COMMENT, loaders.COMMENT),
+    (serializers.USER, []),
+])
+def test_same_as_schema(session, dummy_comments, serializer, loader):
+    order = serializer.model.id
+    objects = session.query(serializer.model).options(*loader).order_by(order).all()
+    rows = serializer.select(session.query(serializer.model)).order_by(order).all()
+
+    assert len(rows) == len(objects) > 0
+    expected = [jsonable_encoder(serializer.schema.from_orm(obj)) for obj in objects]
+    assert orjson.loads(orjson.dumps(serializer.dicts(rows))) == expected
@@ -0,0 +1,60 @@
+# Tests should be independable of one another
+
+from sqlalchemy import create_engine, text
+from app import database
+from app.config import settings
+from tests.conftest import SQLALCHEMY_DATABASE_URL
+
+# Pool status of the app's engine
+def test_pool_status(client):
+    res = client.get("/status/pool")
+    status = res.json()
+
+    assert res.status_code == 200
+    assert status['mode'] == settings.database_pool_mode
+    assert status['checkouts'] >= 0
+    assert status['wait_seconds_max'] >= status['wait_seconds_total'] / max(status['checkouts'], 1)
+
+# Repeated requests of a user are served from the user cache
+def test_cache_status(authorized_client):
+    before = authorized_client.get("/status/cache").json()['users']
+    authorized_client.get("/comments/")
+    authorized_client.get("/comments/")
+    after = authorized_client.get("/status/cache").json()['users']
+
+    assert after['misses'] - before['misses'] <= 1
+    assert after['hits'] - before['hits'] >= 1
+    assert after['size'] >= 1
+
+# Checkout waits are recorded
+def test_pool_checkout_metrics():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=database.TimedQueuePool, pool_size=1)
+    checkouts = database.checkout_metrics.checkouts
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+    assert database.checkout_metrics.checkouts == checkouts + 1
+    engine.dispose()
+
+# statement_timeout is applied to new connections
+def test_statement_timeout(monkeypatch):
+    monkeypatch.setattr(settings, 'database_statement_timeout', 1500)
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **database.engine_options(is_async=False))
+    database.set_statement_timeout(engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SHOW statement_timeout")).scalar() == '1500ms'
+    engine.dispose()
+
+# pgbouncer mode; no client-side pool, timeout set per transaction
+def test_null_pool_mode(monkeypatch):
+    monkeypatch.setattr(settings, 'database_pool_mode', 'null')
+    monkeypatch.setattr(settings, 'database_statement_timeout', 2500)
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **database.engine_options(is_async=False))
+    database.set_statement_timeout(engine)
+
+    with engine.begin() as conn:
+        assert conn.execute(text("SHOW statement_timeout")).scalar() == '2500ms'
+    assert engine.pool.status() == 'NullPool'
+    engine.dispose()
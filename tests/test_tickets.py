@@ -1,5 +1,10 @@
 # Tests should be independable of one another
 
+import base64
+import json
+from app import models
+from app.response_cache import detail_cache
+
 # Get all tickets
 def test_get_all(client, dummy_tickets):
     res = client.get("/tickets/")
@@ -12,6 +17,69 @@ def test_get_all(client, dummy_tickets):
         assert tickets[i]['priority'] == dummy_tickets[i]['priority']
         assert tickets[i]['category'] == dummy_tickets[i]['category']
 
+# Get all tickets [paginated]
+def test_get_all_paginated(client, dummy_tickets):
+    res = client.get("/tickets/?limit=2")
+    first_page = res.json()
+    cursor = res.headers['X-Next-Cursor']
+
+    assert res.status_code == 200
+    assert [ticket['id'] for ticket in first_page] == ['1', '2']
+
+    res = client.get(f"/tickets/?limit=2&cursor={cursor}")
+
+    assert res.status_code == 200
+    assert [ticket['id'] for ticket in res.json()] == ['3']
+    assert 'X-Next-Cursor' not in res.headers
+
+# Get all tickets [sparse fieldset]
+def test_get_all_fields(client, dummy_tickets, count_queries):
+    with count_queries() as queries:
+        res = client.get("/tickets/?fields=id,caption&limit=2")
+    tickets = res.json()
+
+    assert res.status_code == 200
+    assert tickets == [{'id': '1', 'caption': 'ticket1'}, {'id': '2', 'caption': 'ticket2'}]
+    assert 'X-Next-Cursor' in res.headers
+    assert 'projects' not in queries[0] and 'description' not in queries[0]
+
+    res = client.get("/tickets/?fields=caption&search=weird")
+
+    assert res.json() == [{'caption': 'ticket2'}]
+    assert client.get("/tickets/?fields=password").status_code == 400
+
+# Get all tickets [compact view]
+def test_get_all_compact(client, dummy_tickets, count_queries):
+    # Tickets, their projects, users
+    with count_queries() as queries:
+        res = client.get("/tickets/?view=compact&fields=caption")
+    body = res.json()
+
+    assert res.status_code == 200
+    assert len(queries) == 3
+    assert body['items'] == [{'caption': ticket['caption'], 'project_id': 1, 'creator_id': 1} for ticket in dummy_tickets]
+    assert list(body['projects']) == ['1']
+    assert body['projects']['1']['name'] == dummy_tickets[0]['project']['name']
+    assert body['projects']['1']['id'] == '1'
+    assert list(body['users']) == ['1']
+    assert body['users']['1']['id'] == '1'
+    assert 'password' not in body['users']['1']
+
+# Get all tickets [invalid cursor]
+def test_get_all_wrong_cursor(client, dummy_tickets):
+    res = client.get("/tickets/?cursor=wrong")
+
+    assert res.status_code == 400
+
+# Get all tickets [cursor values of the wrong type]
+def test_get_all_wrong_cursor_types(client, dummy_tickets):
+    for values in (["2022-01-01T00:00:00", "x"], [1, 1], ["2022-01-01T00:00:00", True], ["2022-01-01T00:00:00", 1.5]):
+        cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+        assert client.get("/tickets/", params={'cursor': cursor}).status_code == 400
+
+    cursor = base64.urlsafe_b64encode(json.dumps(["2022-01-01T00:00:00+00:00", 1]).encode()).decode()
+    assert client.get("/tickets/", params={'cursor': cursor}).status_code == 200
+
 # Get all tickets [filtered: priority]
 def test_get_all_priority_filtered(client, dummy_tickets):
     res = client.get("/tickets?priority=1")
@@ -40,16 +108,78 @@ def test_get_all_search(client, dummy_tickets):
     assert res.status_code == 200
     assert len(res.json()) == 2
 
+# Get all tickets [search; ranked, exactly 'limit' rows]
+def test_get_all_search_ranked(authorized_client, dummy_tickets):
+    # Caption match ranks above description matches
+    data = {'caption': 'description', 'description': 'other', 'priority': 0, 'category': 'bug'}
+    res = authorized_client.post('/projects/1/newticket', json=data)
+    assert res.status_code == 201
+
+    res = authorized_client.get("/tickets?search=descr")
+
+    assert res.status_code == 200
+    assert [ticket['id'] for ticket in res.json()] == ['4', '1', '3']
+
+    res = authorized_client.get("/tickets?search=ticket&limit=2")
+    cursor = res.headers['X-Next-Cursor']
+
+    assert res.status_code == 200
+    assert [ticket['id'] for ticket in res.json()] == ['1', '2']
+
+    res = authorized_client.get(f"/tickets?search=ticket&limit=2&cursor={cursor}")
+
+    assert [ticket['id'] for ticket in res.json()] == ['3']
+
 # Get one ticket
 def test_get_one(client, dummy_tickets):
     res = client.get("/tickets/1")
     ticket = res.json()
 
     assert res.status_code == 200
-    assert ticket['ticket']['caption'] == dummy_tickets[2]['caption']
-    assert ticket['ticket']['description'] == dummy_tickets[2]['description']
-    assert ticket['ticket']['priority'] == dummy_tickets[2]['priority']
-    assert ticket['ticket']['category'] == dummy_tickets[2]['category']
+    assert ticket['ticket']['caption'] == dummy_tickets[0]['caption']
+    assert ticket['ticket']['description'] == dummy_tickets[0]['description']
+    assert ticket['ticket']['priority'] == dummy_tickets[0]['priority']
+    assert ticket['ticket']['category'] == dummy_tickets[0]['category']
+
+# Nested project/creator objects are loaded with the tickets
+def test_query_count(client, dummy_tickets, count_queries):
+    with count_queries() as queries:
+        res = client.get("/tickets/")
+    assert res.status_code == 200
+    assert len(queries) == 1
+
+    # Ticket, comments, update history and the values it's rebuilt from
+    with count_queries() as queries:
+        res = client.get("/tickets/1")
+    assert res.status_code == 200
+    assert len(queries) == 4
+
+# Without the response cache, polling an unchanged ticket costs one query; comments and edits change its ETag
+def test_get_one_etag(authorized_client, dummy_tickets, count_queries, monkeypatch):
+    # Version lookups; cached responses are tested in test_cache
+    monkeypatch.setattr(detail_cache, 'endpoints', set())
+    res = authorized_client.get("/tickets/1")
+    etag = res.headers['ETag']
+
+    with count_queries() as queries:
+        res = authorized_client.get("/tickets/1", headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.headers['ETag'] == etag
+    assert len(queries) == 1
+
+    # Another representation
+    assert authorized_client.get("/tickets/1?include=comments", headers={'If-None-Match': etag}).status_code == 200
+
+    authorized_client.post("/tickets/1/comment", json={'body_text': 'new'})
+    res = authorized_client.get("/tickets/1", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    etag = res.headers['ETag']
+
+    authorized_client.put("/projects/1", json={'name': 'renamed'})
+    res = authorized_client.get("/tickets/1", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.json()['ticket']['project']['name'] == 'renamed'
 
 # Get non-existent ticket
 def test_get_one_wrong_id(client, dummy_tickets):
@@ -76,6 +206,56 @@ def test_edit(dummy_tickets, authorized_client):
     assert ticket['category'] == data['category']
     assert ticket['status'] == data['status']
 
+# History rows hold the changed fields only; responses still show every field before and after each edit
+def test_edit_history(dummy_tickets, authorized_client, session):
+    authorized_client.put("/tickets/2", json={'status': 'closed'})
+    authorized_client.put("/tickets/2", json={'caption': 'edited', 'priority': 2})
+    authorized_client.put("/tickets/2", json={'status': 'reopened'})
+
+    rows = session.query(models.TicketUpdateHistory.changes).filter(models.TicketUpdateHistory.ticket_id == 2).order_by(models.TicketUpdateHistory.id).all()
+    assert [row.changes for row in rows] == [{'status': ['new', 'closed']}, {'caption': ['ticket2', 'edited'], 'priority': [1, 2]}, {'status': ['closed', 'reopened']}]
+
+    first = authorized_client.get("/tickets/2?include=update_history&limit=2").json()
+    second = authorized_client.get(f"/tickets/2?include=update_history&limit=2&cursor={first['next_cursors']['update_history']}").json()
+    history = first['update_history'] + second['update_history']
+
+    assert [(entry['old_status'], entry['new_status']) for entry in history] == [('new', 'closed'), ('closed', 'closed'), ('closed', 'reopened')]
+    assert [(entry['old_caption'], entry['new_caption']) for entry in history] == [('ticket2', 'ticket2'), ('ticket2', 'edited'), ('edited', 'edited')]
+    assert [(entry['old_priority'], entry['new_priority']) for entry in history] == [('1', '1'), ('1', '2'), ('2', '2')]
+    assert {entry['old_description'] for entry in history} == {'weird3'}
+
+# Re-sending current values only reads the locked ticket: no update, no history row
+def test_edit_unchanged(dummy_tickets, authorized_client, count_queries, session):
+    history = session.query(models.TicketUpdateHistory).count()
+    with count_queries() as queries:
+        res = authorized_client.put("/tickets/1", json={'caption': dummy_tickets[0]['caption'], 'status': 'closed'})
+
+    assert res.status_code == 205
+    assert res.headers['X-Unchanged'] == 'true'
+    assert res.json()['caption'] == dummy_tickets[0]['caption']
+    assert len(queries) == 1 and 'FOR UPDATE' in queries[0]
+    assert session.query(models.TicketUpdateHistory).count() == history
+
+    res = authorized_client.put("/tickets/1", json={'status': 'reopened'})
+    assert 'X-Unchanged' not in res.headers and res.json()['status'] == 'reopened'
+
+# Edit is one transaction: locked ticket, update, project version, history entry (the current user is cached)
+def test_edit_query_count(dummy_tickets, authorized_client, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.put("/tickets/1", json={'caption': 'edited'})
+    assert res.status_code == 205
+    assert res.json()['caption'] == 'edited'
+    assert res.json()['description'] == dummy_tickets[0]['description']
+
+    assert len(queries) == 4
+    assert 'FOR UPDATE' in queries[0]
+    assert queries[1].startswith('UPDATE tickets') and 'RETURNING' in queries[1]
+    assert queries[2].startswith('UPDATE projects')
+    assert queries[3].startswith('INSERT INTO ticket_updates')
+
+    ticket = authorized_client.get("/tickets/1").json()
+    assert ticket['update_history'][-1]['new_caption'] == 'edited'
+
 # Edit non-existent ticket
 def test_edit_wrong_id(dummy_tickets, authorized_client):
     data = {
@@ -1,5 +1,9 @@
 # Tests should be independable of one another
 
+import json
+from app.oauth2 import create_access_token
+from app.response_cache import detail_cache
+
 # Get all users
 def test_get_all(client, dummy_users):
     
@@ -13,6 +17,30 @@ def test_get_all(client, dummy_users):
     assert new_users[1]['email'] == dummy_users[1]['email']
     assert new_users[2]['email'] == dummy_users[2]['email']
 
+# Get all users [paginated]
+def test_get_all_paginated(client, dummy_users):
+    res = client.get("/users/?limit=2")
+    cursor = res.headers['X-Next-Cursor']
+
+    assert res.status_code == 200
+    assert [user['username'] for user in res.json()] == [dummy_users[0]['username'], dummy_users[1]['username']]
+
+    res = client.get(f"/users/?limit=2&cursor={cursor}")
+
+    assert res.status_code == 200
+    assert [user['username'] for user in res.json()] == [dummy_users[2]['username']]
+    assert 'X-Next-Cursor' not in res.headers
+
+# Get all users [NDJSON export]
+def test_get_all_ndjson(client, dummy_users):
+    res = client.get("/users/?format=ndjson&limit=1")
+    users = [json.loads(line) for line in res.text.splitlines()]
+
+    assert res.status_code == 200
+    assert res.headers['content-type'] == 'application/x-ndjson'
+    assert [user['username'] for user in users] == [user['username'] for user in dummy_users]
+    assert 'password' not in users[0]
+
 # Get one user
 def test_get_one(client, dummy_users):
     res = client.get("/users/1")
@@ -25,6 +53,20 @@ def test_get_one(client, dummy_users):
     assert user['tickets'] == []
     assert user['projects'] == []
 
+# Nested objects are loaded with the user's tickets/projects
+def test_query_count(authorized_client, dummy_tickets, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.get("/users/")
+    assert res.status_code == 200
+    assert len(queries) == 1
+
+    # User, tickets, projects
+    with count_queries() as queries:
+        res = authorized_client.get("/users/1")
+    assert res.status_code == 200
+    assert len(res.json()['tickets']) == 3
+    assert len(queries) == 3
+
 # Get non-existent user
 def test_get_one_wrong_id(client):
     res = client.get("/users/4")
@@ -50,6 +92,16 @@ def test_edit_user(authorized_client):
     assert user['surname'] == update_data['surname']
     assert user['access'] == 'user'
 
+# User re-sends their current profile
+def test_edit_user_unchanged(authorized_client, test_user, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.put(f"/users/{test_user['id']}", json={'username': test_user['username']})
+
+    assert res.status_code == 205
+    assert res.headers['X-Unchanged'] == 'true'
+    assert res.json()['username'] == test_user['username']
+    assert not any(query.startswith('UPDATE') for query in queries)
+
 # Admin attempts to edit someone else's profile
 def test_edit_user_from_admin(dummy_users, authorized_client_admin):
     update_data={
@@ -139,12 +191,44 @@ def test_delete_by_unathorized_user(dummy_users, authorized_client):
 
     assert res.status_code == 403
 
+# Access granted by an admin applies to the user's next request, cached or not
+def test_access_change_not_cached(client, dummy_users, test_user, token, admin_token):
+    user = {"Authorization": f"Bearer {token}"}
+    admin = {"Authorization": f"Bearer {admin_token}"}
+    other_id = dummy_users[0]['id']
+
+    assert client.delete(f"/users/{other_id}", headers=user).status_code == 403
+
+    res = client.put(f"/users/{test_user['id']}", json={'access': 'admin'}, headers=admin)
+    assert res.status_code == 205
+
+    assert client.delete(f"/users/{other_id}", headers=user).status_code == 204
+
 # Delete non-existent user
 def test_delete_wrong_id(authorized_client_admin):
     res = authorized_client_admin.delete("/users/10")
 
     assert res.status_code == 404
 
+# Deleting a user changes the ETags of project and ticket pages that showed their personnel rows and comments
+def test_delete_changes_etags(authorized_client, dummy_tickets, dummy_users, monkeypatch):
+    monkeypatch.setattr(detail_cache, 'endpoints', set())
+    assert authorized_client.post("users/2/assign", json={'ids': [1]}).status_code == 201
+    headers = {**authorized_client.headers, "Authorization": f"Bearer {create_access_token({'user_id': 2})}"}
+    assert authorized_client.post("/tickets/1/comment", json={'body_text': 'by user 2'}, headers=headers).status_code == 201
+
+    project_etag = authorized_client.get("/projects/1").headers['ETag']
+    ticket_etag = authorized_client.get("/tickets/1").headers['ETag']
+
+    assert authorized_client.delete("/users/2", headers=headers).status_code == 204
+
+    res = authorized_client.get("/projects/1", headers={'If-None-Match': project_etag})
+    assert res.status_code == 200
+    assert [user['id'] for user in res.json()['personnel']] == ['1']
+    res = authorized_client.get("/tickets/1", headers={'If-None-Match': ticket_etag})
+    assert res.status_code == 200
+    assert res.json()['comments'] == []
+
 # Assign user 2 to projects 1, 2 by creator of these projects
 def test_assign(authorized_client, dummy_projects, dummy_users):
     data = {'ids': [1, 2]}
@@ -160,6 +244,50 @@ def test_assign(authorized_client, dummy_projects, dummy_users):
     assert project_b['personnel'][1]['id'] == '2'
     assert res.status_code == 201
 
+# Every affected project logs the assignment
+def test_assign_history(authorized_client, dummy_projects, dummy_users):
+    res = authorized_client.post("users/2/assign", json={'ids': [1, 2]})
+    assert res.status_code == 201
+
+    for project_id in [1, 2]:
+        project = authorized_client.get(f"/projects/{project_id}").json()
+        assert project['update_history'][0]['personnel_change'] == 'a;2'
+
+    res = authorized_client.post("users/2/remove", json={'ids': [1, 2]})
+    assert res.status_code == 204
+
+    for project_id in [1, 2]:
+        project = authorized_client.get(f"/projects/{project_id}").json()
+        assert project['update_history'][1]['personnel_change'] == 'r;2'
+
+# Assigning to many projects costs the same number of queries as assigning to one
+def test_assign_query_count(authorized_client, dummy_projects, dummy_users, count_queries):
+    with count_queries() as queries:
+        res = authorized_client.post("users/2/assign", json={'ids': [1]})
+    assert res.status_code == 201
+    single = len(queries)
+
+    with count_queries() as queries:
+        res = authorized_client.post("users/3/assign", json={'ids': [1, 2, 3]})
+    assert res.status_code == 201
+    assert len(queries) == single
+
+# Nothing is assigned when the user has no access to one of the projects
+def test_assign_partially_forbidden(authorized_client, dummy_projects, dummy_users):
+    res = authorized_client.post("/projects/", json={'name': 'project4', 'description': 'description4'})
+    assert res.status_code == 201
+
+    client = authorized_client
+    client.headers = {**client.headers, "Authorization": f"Bearer {create_access_token({'user_id': 2})}"}
+    res = client.post("/projects/", json={'name': 'project5', 'description': 'description5'})
+    assert res.status_code == 201
+
+    res = client.post("users/3/assign", json={'ids': [5, 1]})
+    project = client.get("/projects/5").json()
+
+    assert res.status_code == 403
+    assert len(project['personnel']) == 1
+
 # Assign user 2 to non-existent projects
 def test_assign_wrong_project_ids(authorized_client, dummy_projects, dummy_users):
     data = {'ids': [5, 6]}
@@ -232,4 +360,45 @@ def test_remove_conflict(authorized_client, dummy_projects, dummy_users):
     data = {'ids': [1]}
     res = authorized_client.post('users/2/remove', json=data)
 
-    assert res.status_code == 409
\ No newline at end of file
+    assert res.status_code == 409
+
+# Assignments and removals are listed in the user's personnel history, oldest first
+def test_personnel_history(authorized_client, dummy_projects, dummy_users):
+    assert authorized_client.post("users/2/assign", json={'ids': [1, 2]}).status_code == 201
+    assert authorized_client.post("users/2/remove", json={'ids': [1]}).status_code == 204
+
+    res = authorized_client.get("/users/2/personnel-history")
+    assert res.status_code == 200
+    events = res.json()
+    assert [event['action'] for event in events] == ['assign', 'assign', 'remove']
+    assert {event['project_id'] for event in events[:2]} == {1, 2}
+    assert events[2]['project_id'] == 1
+    assert all(event['user_id'] == 2 and event['editor_id'] == 1 for event in events)
+
+    res = authorized_client.get("/users/2/personnel-history?action=assign")
+    assert [event['action'] for event in res.json()] == ['assign', 'assign']
+
+# Events are paginated with a cursor and filtered by time
+def test_personnel_history_pages(authorized_client, dummy_projects, dummy_users):
+    assert authorized_client.post("users/2/assign", json={'ids': [1, 2, 3]}).status_code == 201
+
+    res = authorized_client.get("/users/2/personnel-history?limit=2")
+    first = res.json()
+    assert len(first) == 2
+    res = authorized_client.get("/users/2/personnel-history", params={'limit': 2, 'cursor': res.headers['X-Next-Cursor']})
+    assert len(res.json()) == 1
+    assert 'X-Next-Cursor' not in res.headers
+    assert res.json()[0]['id'] not in {event['id'] for event in first}
+
+    at = first[0]['at']
+    assert authorized_client.get("/users/2/personnel-history", params={'until': at}).json() == []
+    assert len(authorized_client.get("/users/2/personnel-history", params={'since': at}).json()) == 3
+
+# Personnel history of a user without events, and of a non-existent user
+def test_personnel_history_empty(authorized_client, dummy_projects, dummy_users):
+    res = authorized_client.get("/users/2/personnel-history")
+    assert res.status_code == 200
+    assert res.json() == []
+
+    res = authorized_client.get("/users/10/personnel-history")
+    assert res.status_code == 404